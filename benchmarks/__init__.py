@@ -0,0 +1 @@
+# Бенчмарки ETL-процесса. Запуск из корня репозитория: python -m benchmarks.<имя>
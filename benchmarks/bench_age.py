@@ -0,0 +1,62 @@
+import argparse
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import transform as tr
+
+
+def make_patients(n, seed=0):
+    """
+    Генерирует даты рождения и смерти: ~5% пустых дат рождения, ~10% умерших.
+    """
+    rng = np.random.default_rng(seed)
+    birthdate = pd.Series(pd.Timestamp('1920-01-01') + pd.to_timedelta(rng.integers(0, 38000, n), unit='D'))
+    birthdate[rng.random(n) < 0.05] = pd.NaT
+    death_dat = pd.Series(pd.Timestamp('1990-01-01') + pd.to_timedelta(rng.integers(0, 12000, n), unit='D'))
+    death_dat[rng.random(n) >= 0.10] = pd.NaT
+    return pd.DataFrame({'birthdate': birthdate, 'death_dat': death_dat})
+
+
+def legacy_age(df, current_date):
+    """
+    Прежний построчный расчет возраста через df.apply (для сравнения).
+    """
+    def calculate_age(row):
+        if pd.isnull(row['birthdate']):
+            return None
+        end_date = row['death_dat'] if pd.notnull(row['death_dat']) else current_date
+        return end_date.year - row['birthdate'].year - (
+            (end_date.month, end_date.day) < (row['birthdate'].month, row['birthdate'].day)
+        )
+    return df.apply(calculate_age, axis=1).astype(pd.Int64Dtype())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк расчета возраста пациентов")
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--legacy-max-rows', type=int, default=10_000_000,
+                        help="Максимальный размер, на котором запускается построчный расчет")
+    args = parser.parse_args()
+
+    current_date = datetime.now()
+    for n in args.rows:
+        df = make_patients(n)
+
+        start = time.perf_counter()
+        vectorized = tr.calculate_age(df['birthdate'], df['death_dat'], current_date)
+        vectorized_time = time.perf_counter() - start
+        line = f"{n:>12,} строк: векторный {vectorized_time:8.3f} с"
+
+        if n <= args.legacy_max_rows:
+            start = time.perf_counter()
+            legacy = legacy_age(df, current_date)
+            legacy_time = time.perf_counter() - start
+            if not legacy.equals(vectorized):
+                raise AssertionError(f"Результаты расчета возраста различаются на {n} строках")
+            line += f", построчный {legacy_time:8.3f} с, ускорение x{legacy_time / vectorized_time:.0f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
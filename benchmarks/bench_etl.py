@@ -0,0 +1,162 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import load as l
+import metrics
+import transform as tr
+from benchmarks.synthetic import generate_tables
+
+# Сохраненные результаты, с которыми сравнивается запуск
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# Допустимое замедление относительно базовой линии (доля) и абсолютный запас на шум таймера (с)
+TOLERANCE = 0.25
+MIN_SLACK_SECONDS = 0.05
+# Допустимый рост пикового RSS (доля)
+MEMORY_TOLERANCE = 0.25
+
+
+def run_cases(tables, output_dir, repeat=3):
+    """
+    Замеряет все transform.process_* и load.save_to_csv на синтетических таблицах.
+    Каждая функция вызывается repeat раз на свежей копии входа (функции меняют
+    таблицы на месте); в результат идет лучшее время и наибольший пик RSS.
+    :return: Словарь {функция: {'seconds', 'peak_rss_mb', 'rows_in', 'rows_out', 'dropped'}}.
+    """
+    patient_index = tr.PatientIndex.from_frame(tr.process_patient_data(tables['patient'].copy()))
+    processed_visits = tr.process_visits_data(tables['amb_visit'].copy(), patient_index)
+    csv_path = os.path.join(output_dir, 'amb_visit.csv')
+
+    cases = [
+        ('process_patient_data', tr.process_patient_data, lambda: (tables['patient'].copy(),)),
+        ('process_doc_data', tr.process_doc_data, lambda: (tables['doc'].copy(),)),
+        ('process_visits_data', tr.process_visits_data, lambda: (tables['amb_visit'].copy(), patient_index)),
+        ('process_diagnoses_data', tr.process_diagnoses_data, lambda: (tables['diap'].copy(), patient_index)),
+        ('process_hospital_visits', tr.process_hospital_visits, lambda: (tables['stac_visit'].copy(), patient_index)),
+        ('process_po_visit_data', tr.process_po_visit_data, lambda: (tables['po'].copy(), patient_index)),
+        ('save_to_csv', l.save_to_csv, lambda: (processed_visits, csv_path)),
+    ]
+
+    results = {}
+    for name, func, make_args in cases:
+        report = metrics.RunReport(name)
+        for _ in range(repeat):
+            args = make_args()
+            # save_to_csv печатает сообщение о сохранении
+            with contextlib.redirect_stdout(io.StringIO()):
+                report.track(name, 'load' if func is l.save_to_csv else 'transform', func, *args)
+        steps = report.steps
+        results[name] = {
+            'seconds': min(step['seconds'] for step in steps),
+            'peak_rss_mb': max(step['peak_rss_mb'] for step in steps),
+            'rows_in': steps[0]['rows_in'],
+            'rows_out': steps[0]['rows_out'],
+            'dropped': steps[0]['dropped'],
+        }
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    """
+    Сравнивает результаты с базовой линией.
+    Замедлением считается время больше baseline * (1 + tolerance) + MIN_SLACK_SECONDS,
+    ростом памяти - пик RSS больше baseline * (1 + memory_tolerance).
+    :return: (строки текстового отчета, список регрессий).
+    """
+    lines = [f"{'функция':<26} {'время, с':>10} {'база, с':>10} {'изм.':>8} {'пик, МБ':>10} {'база, МБ':>10}"]
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            lines.append(f"{name:<26} {result['seconds']:>10.3f} {'-':>10} {'':>8} {result['peak_rss_mb']:>10.1f} {'-':>10}")
+            continue
+        change = (result['seconds'] - base['seconds']) / base['seconds'] if base['seconds'] else 0.0
+        flag = ''
+        if result['seconds'] > base['seconds'] * (1 + tolerance) + MIN_SLACK_SECONDS:
+            regressions.append(f"{name}: время {base['seconds']:.3f} -> {result['seconds']:.3f} с")
+            flag = '  [ЗАМЕДЛЕНИЕ]'
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + memory_tolerance):
+            regressions.append(f"{name}: пик RSS {base['peak_rss_mb']:.1f} -> {result['peak_rss_mb']:.1f} МБ")
+            flag += '  [ПАМЯТЬ]'
+        if result['rows_out'] != base.get('rows_out'):
+            # Тот же генератор и seed дают те же данные: другое число строк - изменение поведения
+            regressions.append(f"{name}: строк на выходе {base.get('rows_out')} -> {result['rows_out']}")
+            flag += '  [СТРОКИ]'
+        lines.append(f"{name:<26} {result['seconds']:>10.3f} {base['seconds']:>10.3f} {change:>+8.0%} "
+                     f"{result['peak_rss_mb']:>10.1f} {base['peak_rss_mb']:>10.1f}{flag}")
+    return lines, regressions
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(path, baseline, rows, results, seed):
+    """
+    Записывает результаты для размера rows в файл базовой линии (остальные размеры сохраняются).
+    """
+    baseline[str(rows)] = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'seed': seed,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'results': results,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк преобразований и сохранения на синтетических данных")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000],
+                        help="Количество амбулаторных визитов (100 тыс. - 50 млн); остальные таблицы - пропорционально")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="Сохранить результаты как базовую линию")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE)
+    args = parser.parse_args()
+
+    # Предупреждения об отброшенных строках ожидаемы: ошибки заложены в данные
+    logging.disable(logging.WARNING)
+    baseline = load_baseline(args.baseline)
+    regressions = []
+    for rows in args.rows:
+        tables = generate_tables(rows, seed=args.seed)
+        with tempfile.TemporaryDirectory() as output_dir:
+            results = run_cases(tables, output_dir, repeat=args.repeat)
+        del tables
+
+        print(f"\n{rows:,} амбулаторных визитов:")
+        base = baseline.get(str(rows), {})
+        if base.get('seed', args.seed) != args.seed:
+            print(f"Базовая линия построена с seed={base['seed']}, сравнение пропущено.")
+            base = {}
+        lines, found = compare(results, base.get('results', {}), args.tolerance, args.memory_tolerance)
+        print('\n'.join(lines))
+        regressions += [f"{rows}: {item}" for item in found]
+
+        if args.save_baseline:
+            save_baseline(args.baseline, baseline, rows, results, args.seed)
+            print(f"Базовая линия сохранена: {args.baseline}")
+
+    if regressions and not args.save_baseline:
+        print("\nРегрессии:\n" + '\n'.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
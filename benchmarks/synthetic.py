@@ -0,0 +1,257 @@
+import numpy as np
+import pandas as pd
+from validation import SENTINEL_DATES
+
+# Доли строк с ошибками, которые встречаются в источнике
+ANOMALY_RATES = {
+    'sentinel_dates': 0.01,   # даты-заглушки (30.12.1899 и др.)
+    'future_dates': 0.005,    # даты позже текущего момента
+    'missing_dates': 0.005,   # пустые даты
+    'orphan_ids': 0.005,      # ссылки на несуществующих пациентов
+    'missing_ids': 0.01,      # пустые ссылки на пациентов
+    'duplicates': 0.02,       # повторы идентификатора (соединение с patdiag)
+}
+
+# Размер таблиц относительно числа амбулаторных визитов
+TABLE_RATIOS = {
+    'patient': 0.2,
+    'diap': 0.5,
+    'stac_visit': 0.1,
+    'po': 0.1,
+}
+
+SEX = ['М', 'Ж']
+SOCIAL_STATUS = ['Работает', 'Пенсионер', 'Не работает', 'Учащийся', 'Инвалид']
+BLOOD_GROUPS = ['O(I)', 'A(II)', 'B(III)', 'AB(IV)', None]
+RHESUS = ['Положительный', 'Отрицательный', None]
+DEPARTMENTS = ['Терапия', 'Хирургия', 'Кардиология', 'Неврология', 'Педиатрия', 'Гинекология', 'Травматология']
+POSITIONS = ['Врач-терапевт', 'Врач-хирург', 'Врач-кардиолог', 'Врач-невролог', 'Медицинская сестра']
+AGREEMENTS = ['ОМС', 'ДМС', 'Платно']
+OUTCOMES = ['Выписан', 'Переведен', 'Умер']
+VMP_TYPES = ['Сердечно-сосудистая хирургия', 'Нейрохирургия', 'Онкология']
+REFUSALS = ['Отказ пациента', 'Нет показаний', 'Нет мест']
+FORM_HELP = ['Экстренная', 'Плановая', 'Неотложная', None]
+WHO_SENT = ['СМП', 'Поликлиника', 'Самообращение', None]
+DIAGNOSES = [f"{letter}{code:02d}" for letter in 'IJKMN' for code in range(0, 100, 7)]
+
+
+def _choice(rng, values, n):
+    """
+    Случайные значения из списка в виде массива object (как текст из PostgreSQL).
+    """
+    return np.array(values, dtype=object)[rng.integers(0, len(values), n)]
+
+
+def _mask(rng, n, rate):
+    return rng.random(n) < rate
+
+
+def _timestamps(rng, n, start, days, time=True):
+    """
+    Случайные даты (со временем или без) в интервале [start, start + days).
+    """
+    if time:
+        offsets = rng.integers(0, days * 86400, n).astype('timedelta64[s]')
+    else:
+        offsets = rng.integers(0, days, n).astype('timedelta64[D]')
+    return np.datetime64(start, 's') + offsets
+
+
+def _with_anomalies(rng, values, rates, sentinels=SENTINEL_DATES):
+    """
+    Добавляет в столбец дат заглушки, будущие и пустые даты.
+    """
+    values = pd.Series(values.astype('datetime64[ns]'))
+    n = len(values)
+    if sentinels:
+        sentinel = _mask(rng, n, rates['sentinel_dates'])
+        values[sentinel] = pd.to_datetime(_choice(rng, list(sentinels), int(sentinel.sum())))
+    future = _mask(rng, n, rates['future_dates'])
+    values[future] = pd.Timestamp.now().normalize() + pd.to_timedelta(rng.integers(1, 365, int(future.sum())), unit='D')
+    values[_mask(rng, n, rates['missing_dates'])] = pd.NaT
+    return values
+
+
+def _date_strings(values):
+    """
+    Даты в виде текста 'dd.mm.yyyy' (to_char в запросе диагнозов).
+    Форматируются только различные значения, поэтому генерация быстрая и на десятках миллионов строк.
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    formatted = np.append(pd.DatetimeIndex(uniques).strftime('%d.%m.%Y').to_numpy(dtype=object), None)
+    return formatted[codes]
+
+
+def _patient_refs(rng, n, patients, rates, nullable=True):
+    """
+    Ссылки на пациентов: существующие ключи, несуществующие (orphan) и, если nullable, пустые.
+    Столбец с пустыми значениями извлекается из PostgreSQL как float64.
+    """
+    refs = rng.integers(1, patients + 1, n).astype(np.int64)
+    orphan = _mask(rng, n, rates['orphan_ids'])
+    refs[orphan] = patients + rng.integers(1, patients + 1, int(orphan.sum()))
+    if not nullable:
+        return refs
+    refs = refs.astype(np.float64)
+    refs[_mask(rng, n, rates['missing_ids'])] = np.nan
+    return refs
+
+
+def _visit_ids(rng, n, rates):
+    """
+    Идентификаторы визитов с повторами: визит с несколькими диагнозами дает несколько строк.
+    """
+    ids = np.arange(1, n + 1, dtype=np.int64)
+    duplicate = np.flatnonzero(_mask(rng, n, rates['duplicates']))
+    ids[duplicate] = ids[np.maximum(duplicate - rng.integers(1, 100, len(duplicate)), 0)]
+    return ids
+
+
+def _frame(columns):
+    """
+    DataFrame из списка (имя, значения): в запросах имена столбцов могут повторяться.
+    """
+    df = pd.DataFrame({i: values for i, (_, values) in enumerate(columns)})
+    df.columns = [name for name, _ in columns]
+    return df
+
+
+def generate_patients(rng, n, rates):
+    birthdate = pd.Series(_timestamps(rng, n, '1925-01-01', 36000, time=False).astype('datetime64[ns]'))
+    birthdate[_mask(rng, n, rates['missing_dates'])] = pd.NaT
+    death_dat = pd.Series(_timestamps(rng, n, '2000-01-01', 9000, time=False).astype('datetime64[ns]'))
+    death_dat[rng.random(n) >= 0.08] = pd.NaT
+    return _frame([
+        ('keyid', np.arange(1, n + 1, dtype=np.int64)),
+        ('sex', _choice(rng, SEX, n)),
+        ('birthdate', birthdate),
+        ('death_dat', death_dat),
+        ('social_status', _choice(rng, SOCIAL_STATUS, n)),
+        ('prikrep', _choice(rng, ['0', '1'], n)),
+        ('group_lu', _choice(rng, BLOOD_GROUPS, n)),
+        ('rezus_lu', _choice(rng, RHESUS, n)),
+    ])
+
+
+def generate_doctors(rng, n):
+    return _frame([
+        ('keyid', np.arange(1, n + 1, dtype=np.int64)),
+        ('positionid', rng.integers(1, len(POSITIONS) + 1, n)),
+        ('text', _choice(rng, DEPARTMENTS, n)),
+        ('text', _choice(rng, POSITIONS, n)),
+        ('status', rng.integers(0, 2, n)),
+    ])
+
+
+def generate_dolznost():
+    return _frame([
+        ('keyid', np.arange(1, len(POSITIONS) + 1, dtype=np.int64)),
+        ('text', np.array(POSITIONS, dtype=object)),
+    ])
+
+
+def generate_amb_visits(rng, n, patients, doctors, rates):
+    return _frame([
+        ('keyid', _visit_ids(rng, n, rates)),
+        ('patientid', _patient_refs(rng, n, patients, rates)),
+        ('num', rng.integers(1, 100000, n).astype(str).astype(object)),
+        ('dat', _with_anomalies(rng, _timestamps(rng, n, '2015-01-01', 3500), rates, sentinels=())),
+        ('agrid', rng.integers(1, len(AGREEMENTS) + 1, n)),
+        ('doctorid', rng.integers(1, doctors + 1, n)),
+        ('diagnoz', _choice(rng, DIAGNOSES, n)),
+        ('text', _choice(rng, DEPARTMENTS, n)),
+    ])
+
+
+def generate_diagnoses(rng, n, patients, doctors, rates):
+    reg_dat = _with_anomalies(rng, _timestamps(rng, n, '2005-01-01', 7000, time=False), rates)
+    confirm_dat = _with_anomalies(rng, _timestamps(rng, n, '2005-01-01', 7000, time=False), rates)
+    end_dat = pd.Series(_timestamps(rng, n, '2010-01-01', 5000, time=False).astype('datetime64[ns]'))
+    end_dat[rng.random(n) >= 0.3] = pd.NaT
+    return _frame([
+        ('keyid', np.arange(1, n + 1, dtype=np.int64)),
+        ('patient_id', _patient_refs(rng, n, patients, rates, nullable=False)),
+        ('ill_type', _choice(rng, ['Острый', 'Хронический', 'Без указания'], n)),
+        ('disp_status', _choice(rng, ['Состоит', 'Не состоит', 'Неизвестно'], n)),
+        ('diag_code', _choice(rng, DIAGNOSES, n)),
+        ('diag_text', _choice(rng, [f"Диагноз {code}" for code in DIAGNOSES], n)),
+        ('reg_dat', _date_strings(reg_dat)),
+        ('reg_by', rng.integers(1, doctors + 1, n)),
+        ('confirm_dat', _date_strings(confirm_dat)),
+        ('confirm_by', rng.integers(1, doctors + 1, n)),
+        ('end_dat', _date_strings(end_dat)),
+        # pf_docdep.get_text возвращает ФИО врача, а не идентификатор
+        ('end_by', _choice(rng, ['Иванов И.И.', 'Петров П.П.', 'Сидорова А.В.', None], n)),
+    ])
+
+
+def generate_hospital_visits(rng, n, patients, doctors, rates):
+    dat = _with_anomalies(rng, _timestamps(rng, n, '2015-01-01', 3500), rates, sentinels=())
+    dat1 = dat + pd.to_timedelta(rng.integers(0, 30 * 86400, n), unit='s')
+    vmp = _choice(rng, VMP_TYPES, n)
+    vmp[rng.random(n) >= 0.05] = None
+    return _frame([
+        ('visitid', _visit_ids(rng, n, rates)),
+        ('patientid', _patient_refs(rng, n, patients, rates, nullable=False)),
+        ('num_b', rng.integers(1, 100000, n).astype(str).astype(object)),
+        ('text', _choice(rng, AGREEMENTS, n)),
+        ('doctorid', rng.integers(1, doctors + 1, n)),
+        ('diagnoz', _choice(rng, DIAGNOSES, n)),
+        ('ishod', _choice(rng, OUTCOMES, n)),
+        ('dat', dat),
+        ('dat1', dat1),
+        ('count_day', (dat1.dt.normalize() - dat.dt.normalize()).dt.days),
+        ('department', _choice(rng, DEPARTMENTS, n)),
+        ('vmp', vmp),
+    ])
+
+
+def generate_po_visits(rng, n, patients, rates):
+    dat_st = _with_anomalies(rng, _timestamps(rng, n, '2015-01-01', 3500), rates, sentinels=SENTINEL_DATES[:1])
+    dat_fin = dat_st + pd.to_timedelta(rng.integers(0, 6 * 3600, n), unit='s')
+    # Конец раньше начала (некорректный интервал) и пустой конец
+    reversed_interval = _mask(rng, n, rates['future_dates'])
+    dat_fin[reversed_interval] = dat_st[reversed_interval] - pd.Timedelta(days=1)
+    dat_fin[_mask(rng, n, 0.3)] = pd.NaT
+    refused = rng.random(n) < 0.2
+    department = _choice(rng, DEPARTMENTS, n)
+    return _frame([
+        ('id', _visit_ids(rng, n, rates)),
+        ('dat_st', dat_st),
+        ('dat_fin', dat_fin),
+        ('depgosp', np.where(refused, 'Отказ от госпитализации', department)),
+        ('result', np.where(refused, _choice(rng, REFUSALS, n), 'Госпитализация')),
+        ('pat', _patient_refs(rng, n, patients, rates)),
+        ('giag_code', _choice(rng, DIAGNOSES, n)),
+        ('diag_text', _choice(rng, [f"Диагноз {code}" for code in DIAGNOSES], n)),
+        ('form_help', _choice(rng, FORM_HELP, n)),
+        ('who', _choice(rng, WHO_SENT, n)),
+    ])
+
+
+def generate_tables(rows, seed=0, rates=None):
+    """
+    Генерирует синтетические таблицы в том виде, в котором их возвращают запросы
+    sql_scripts (имена, порядок и типы столбцов после extract_data), с ошибками
+    источника: даты-заглушки, будущие и пустые даты, ссылки на несуществующих
+    пациентов, пустые ссылки и повторы идентификаторов.
+    :param rows: Количество амбулаторных визитов; размер остальных таблиц - по TABLE_RATIOS.
+    :param seed: Начальное значение генератора случайных чисел.
+    :param rates: Доли строк с ошибками (по умолчанию ANOMALY_RATES).
+    :return: Словарь {таблица: DataFrame} с ключами как в etl_proc: patient, doc, dol,
+             amb_visit, diap, stac_visit, po.
+    """
+    rates = {**ANOMALY_RATES, **(rates or {})}
+    rng = np.random.default_rng(seed)
+    patients = max(int(rows * TABLE_RATIOS['patient']), 1)
+    doctors = max(rows // 20000, 50)
+    return {
+        'patient': generate_patients(rng, patients, rates),
+        'doc': generate_doctors(rng, doctors),
+        'dol': generate_dolznost(),
+        'amb_visit': generate_amb_visits(rng, rows, patients, doctors, rates),
+        'diap': generate_diagnoses(rng, max(int(rows * TABLE_RATIOS['diap']), 1), patients, doctors, rates),
+        'stac_visit': generate_hospital_visits(rng, max(int(rows * TABLE_RATIOS['stac_visit']), 1),
+                                               patients, doctors, rates),
+        'po': generate_po_visits(rng, max(int(rows * TABLE_RATIOS['po']), 1), patients, rates),
+    }
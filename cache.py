@@ -0,0 +1,194 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import pandas as pd
+
+# Каталог кеша извлеченных данных
+CACHE_DIR = '.extract_cache'
+# Время жизни снимка (с) и максимальный размер кеша (байт)
+CACHE_TTL_SECONDS = 24 * 3600
+CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+
+class ExtractCache:
+    """
+    Локальный кеш результатов запросов к PostgreSQL.
+    Ключ снимка - хеш текста запроса и параметров, поэтому любое
+    изменение запроса в sql_scripts автоматически дает новый снимок.
+    Данные хранятся в Feather (Arrow IPC, lz4): чтение в разы быстрее
+    повторной выгрузки и сохраняет типы столбцов. Рядом с файлом данных
+    лежит JSON с метаданными (запрос, исходные имена столбцов, время создания).
+    Устаревшие (старше ttl_seconds) снимки удаляются, а при превышении
+    max_bytes удаляются самые давно использованные.
+    Кеш относится к одному источнику: для другой БД используйте другой каталог.
+    Требует установленного pyarrow.
+    """
+
+    def __init__(self, directory=CACHE_DIR, ttl_seconds=CACHE_TTL_SECONDS, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(query, params=None):
+        """
+        Хеш текста запроса и параметров.
+        """
+        payload = json.dumps({'query': str(query), 'params': params},
+                             sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + '.feather', base + '.json'
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _entries(self):
+        """
+        Список снимков: (ключ, метаданные, размер в байтах, время последнего использования).
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            data_path, meta_path = self._paths(key)
+            try:
+                with open(meta_path, encoding='utf-8') as f:
+                    meta = json.load(f)
+                entries.append((key, meta, os.path.getsize(data_path), os.path.getmtime(meta_path)))
+            except (OSError, ValueError):
+                # Неполный снимок (например, прерванная запись)
+                self._remove(key)
+        return entries
+
+    def get(self, query, params=None):
+        """
+        Возвращает DataFrame из кеша или None, если снимка нет или он устарел.
+        """
+        key = self.key(query, params)
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - meta['created'] > self.ttl_seconds:
+            logging.info(f"Снимок {key[:12]} устарел и будет удален.")
+            self._remove(key)
+            return None
+
+        df = pd.read_feather(data_path)
+        df.columns = meta['columns']
+        # Отмечаем использование для вытеснения по давности
+        os.utime(meta_path)
+        logging.info(f"Данные взяты из кеша: снимок {key[:12]}, {len(df)} строк.")
+        return df
+
+    def put(self, df, query, params=None):
+        """
+        Сохраняет DataFrame в кеш и при необходимости вытесняет старые снимки.
+        """
+        key = self.key(query, params)
+        data_path, meta_path = self._paths(key)
+        # Имена столбцов могут повторяться (например, два столбца "text"), поэтому
+        # в файле столбцы позиционные, а исходные имена хранятся в метаданных
+        stored = df.reset_index(drop=True)
+        stored.columns = [f'c{i}' for i in range(len(df.columns))]
+        stored.to_feather(data_path + '.tmp', compression='lz4')
+        os.replace(data_path + '.tmp', data_path)
+
+        meta = {'query': str(query), 'params': params, 'columns': list(df.columns),
+                'rows': len(df), 'created': time.time()}
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, default=str)
+        os.replace(meta_path + '.tmp', meta_path)
+        logging.info(f"Данные сохранены в кеш: снимок {key[:12]}, {len(df)} строк.")
+        self.evict()
+
+    def invalidate(self, query=None, params=None):
+        """
+        Удаляет снимок запроса или, если запрос не указан, весь кеш.
+        :return: Количество удаленных снимков.
+        """
+        with self._lock:
+            if query is not None:
+                key = self.key(query, params)
+                existed = os.path.exists(self._paths(key)[1])
+                self._remove(key)
+                return int(existed)
+            entries = self._entries()
+            for key, *_ in entries:
+                self._remove(key)
+            logging.info(f"Кеш очищен: удалено {len(entries)} снимков.")
+            return len(entries)
+
+    def evict(self):
+        """
+        Удаляет устаревшие снимки, затем самые давно использованные, пока размер
+        кеша превышает max_bytes.
+        """
+        with self._lock:
+            now = time.time()
+            entries = []
+            for key, meta, size, used in self._entries():
+                if now - meta['created'] > self.ttl_seconds:
+                    self._remove(key)
+                else:
+                    entries.append((used, size, key))
+            total = sum(size for _, size, _ in entries)
+            for used, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                logging.info(f"Снимок {key[:12]} вытеснен из кеша (размер кеша {total} байт).")
+                self._remove(key)
+                total -= size
+
+    def describe(self):
+        """
+        Сводка по снимкам: ключ, строки, размер, возраст и начало запроса.
+        """
+        now = time.time()
+        lines = []
+        for key, meta, size, _ in self._entries():
+            query = ' '.join(meta['query'].split())[:60]
+            lines.append(f"{key[:12]}  {meta['rows']:>10} строк  {size / 1024 ** 2:8.1f} МБ  "
+                         f"{(now - meta['created']) / 3600:6.1f} ч  {query}")
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Управление кешем извлеченных данных")
+    parser.add_argument('command', choices=['list', 'invalidate', 'evict'])
+    parser.add_argument('--dir', default=CACHE_DIR, help="Каталог кеша")
+    parser.add_argument('--query', help="Имя запроса из sql_scripts (например, query_get_patient); "
+                                        "без него invalidate очищает весь кеш")
+    args = parser.parse_args()
+
+    cache = ExtractCache(args.dir)
+    if args.command == 'list':
+        print(cache.describe())
+    elif args.command == 'invalidate':
+        if args.query is not None:
+            import sql_scripts as sql
+            print(f"Удалено снимков: {cache.invalidate(getattr(sql, args.query))}")
+        else:
+            print(f"Удалено снимков: {cache.invalidate()}")
+    else:
+        cache.evict()
+
+
+if __name__ == "__main__":
+    main()
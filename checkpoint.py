@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import threading
+from datetime import datetime
+import pandas as pd
+from dag import TaskGraph
+
+# Каталог контрольных точек основного ETL-процесса
+CHECKPOINT_DIR = '.checkpoints'
+MANIFEST_NAME = 'manifest.json'
+
+
+class CheckpointStore:
+    """
+    Контрольные точки запуска ETL: результат каждой задачи графа (dag.TaskGraph)
+    сохраняется на диск, а состояние задач - в манифест (<directory>/manifest.json):
+    статус (done/failed), файл результата, количество строк, ключ задачи и время.
+    DataFrame хранятся в Feather (lz4), как в ExtractCache; если таблицу нельзя
+    записать в Arrow (например, смешанные типы в столбце), - в pickle.
+    При возобновлении (resume=True) выполненные задачи берутся из контрольных точек,
+    а заново выполняются только упавшие, не начатые, явно сброшенные (invalidate),
+    задачи с изменившимся ключом (например, текстом запроса) и все, что от них зависит.
+    """
+
+    def __init__(self, directory=CHECKPOINT_DIR, resume=False):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.manifest = self._read_manifest() if resume else None
+        if self.manifest is None:
+            # Новый запуск: контрольные точки предыдущего больше не нужны
+            shutil.rmtree(directory, ignore_errors=True)
+            self.manifest = {'run_id': datetime.now().strftime('%Y%m%d_%H%M%S'), 'stages': {}}
+        else:
+            logging.info(f"Возобновление запуска {self.manifest['run_id']} из {self.manifest_path}.")
+        os.makedirs(directory, exist_ok=True)
+        self.manifest['status'] = 'running'
+        self.manifest['updated'] = datetime.now().isoformat(timespec='seconds')
+        self._write_manifest()
+
+    @staticmethod
+    def key(value):
+        """
+        Ключ задачи: хеш параметров, от которых зависит ее результат (запрос, настройки).
+        """
+        payload = json.dumps(value, sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logging.warning(f"Манифест {self.manifest_path} не найден, запуск начинается заново.")
+            return None
+
+    def _write_manifest(self):
+        """
+        Записывает манифест атомарно (вызывается под блокировкой или до запуска графа).
+        """
+        self.manifest['updated'] = datetime.now().isoformat(timespec='seconds')
+        with open(self.manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def _path(self, name, extension):
+        safe = ''.join(ch if ch.isalnum() or ch in '-_' else '_' for ch in name)
+        return os.path.join(self.directory, f"{safe}.{extension}")
+
+    def save(self, name, result, key):
+        """
+        Сохраняет результат задачи и отмечает ее выполненной.
+        Результат None (например, у задач записи файлов) не сохраняется; другие
+        результаты, кроме DataFrame (например, PatientIndex), при возобновлении
+        вычисляются заново.
+        """
+        record = {'status': 'done', 'key': key, 'file': None, 'rows': None, 'kind': 'none',
+                  'finished': datetime.now().isoformat(timespec='seconds')}
+        if isinstance(result, pd.DataFrame):
+            record.update(kind='frame', rows=len(result), columns=list(result.columns))
+            path = self._path(name, 'feather')
+            stored = result.reset_index(drop=True)
+            stored.columns = [f'c{i}' for i in range(len(result.columns))]
+            try:
+                stored.to_feather(path + '.tmp', compression='lz4')
+            except Exception as e:
+                logging.warning(f"Контрольная точка '{name}' сохраняется в pickle: {e}")
+                path = self._path(name, 'pkl')
+                with open(path + '.tmp', 'wb') as f:
+                    pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            record['file'] = os.path.basename(path)
+        elif result is not None:
+            record['kind'] = 'memory'
+        with self._lock:
+            self.manifest['stages'][name] = record
+            self._write_manifest()
+
+    def fail(self, name, error, key):
+        with self._lock:
+            self.manifest['stages'][name] = {'status': 'failed', 'key': key, 'error': str(error),
+                                             'finished': datetime.now().isoformat(timespec='seconds')}
+            self._write_manifest()
+
+    def load(self, name):
+        """
+        Загружает результат выполненной задачи из контрольной точки.
+        """
+        record = self.manifest['stages'][name]
+        if record['kind'] == 'none':
+            return None
+        path = os.path.join(self.directory, record['file'])
+        try:
+            if path.endswith('.feather'):
+                df = pd.read_feather(path)
+            else:
+                with open(path, 'rb') as f:
+                    df = pickle.load(f)
+            df.columns = record['columns']
+        except Exception as e:
+            logging.error(f"Ошибка при загрузке контрольной точки '{name}': {e}")
+            raise
+        logging.info(f"Задача '{name}' взята из контрольной точки: {len(df)} строк.")
+        return df
+
+    def _done(self, name, key):
+        record = self.manifest['stages'].get(name)
+        return record is not None and record['status'] == 'done' and record['key'] == key
+
+    def _loadable(self, name):
+        record = self.manifest['stages'][name]
+        if record['kind'] == 'none':
+            return True
+        return record['kind'] == 'frame' and record['file'] is not None and \
+            os.path.exists(os.path.join(self.directory, record['file']))
+
+    def wrap(self, graph, keys=None, invalidate=()):
+        """
+        Строит граф с контрольными точками.
+        Задачи, которые нужно выполнить, сохраняют результат после успешного
+        выполнения; выполненные ранее задачи, результаты которых нужны другим,
+        загружаются из контрольных точек; остальные выполненные задачи пропускаются.
+        :param graph: Исходный граф задач.
+        :param keys: {задача: ключ} (см. key); задача с другим ключом выполняется заново.
+        :param invalidate: Задачи, которые нужно выполнить заново вместе с зависимыми.
+        :return: Новый TaskGraph.
+        """
+        keys = keys or {}
+        tasks = graph.tasks
+        order = _topological_order(tasks)
+
+        # Устаревшие задачи: не выполнены, сброшены, с другим ключом или зависят от устаревших
+        stale = set()
+        for name in order:
+            task = tasks[name]
+            if name in invalidate or not self._done(name, keys.get(name)) or \
+                    any(dep in stale for dep in task['inputs']):
+                stale.add(name)
+
+        # Входы устаревших задач: загружаются или, если результата нет на диске, вычисляются заново
+        run, load = set(stale), set()
+        for name in reversed(order):
+            if name not in run:
+                continue
+            for dep in tasks[name]['inputs']:
+                if dep in run or dep in load:
+                    continue
+                if self._loadable(dep):
+                    load.add(dep)
+                else:
+                    run.add(dep)
+
+        wrapped = TaskGraph()
+        for name in order:
+            task = tasks[name]
+            if name in run:
+                wrapped.add(name, self._saving(name, task['func'], keys.get(name)), task['inputs'],
+                            group=task['group'], keep=task['keep'])
+            elif name in load:
+                wrapped.add(name, self._loader(name), keep=task['keep'])
+        skipped = len(tasks) - len(run) - len(load)
+        logging.info(f"Контрольные точки: выполнить {len(run)} задач, загрузить {len(load)}, пропустить {skipped}.")
+        return wrapped
+
+    def _saving(self, name, func, key):
+        def run(*args):
+            try:
+                result = func(*args)
+            except Exception as e:
+                self.fail(name, e, key)
+                raise
+            self.save(name, result, key)
+            return result
+        return run
+
+    def _loader(self, name):
+        return lambda: self.load(name)
+
+    def finish(self, errors, keep=False):
+        """
+        Отмечает завершение запуска в манифесте.
+        После успешного запуска (и если не задан keep) файлы контрольных точек удаляются,
+        а манифест остается: повторный --resume ничего не выполняет.
+        :param errors: Словарь ошибок из TaskGraph.run.
+        """
+        with self._lock:
+            self.manifest['status'] = 'failed' if errors else 'done'
+            if not errors and not keep:
+                for record in self.manifest['stages'].values():
+                    if record.get('file'):
+                        try:
+                            os.remove(os.path.join(self.directory, record['file']))
+                        except FileNotFoundError:
+                            pass
+                        record['file'] = None
+            self._write_manifest()
+        if errors:
+            logging.error(f"Запуск {self.manifest['run_id']} можно продолжить: python etl_proc.py --resume")
+
+
+def _topological_order(tasks):
+    order = []
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        visited.add(name)
+        for dep in tasks[name]['inputs']:
+            visit(dep)
+        order.append(name)
+
+    for name in tasks:
+        visit(name)
+    return order
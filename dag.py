@@ -0,0 +1,134 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class TaskGraph:
+    """
+    Простой исполнитель графа задач.
+    Каждая задача объявляет имена задач-входов; результаты входов передаются
+    ей позиционными аргументами в порядке объявления. Задача запускается,
+    как только готовы все ее входы, поэтому независимые ветки выполняются
+    параллельно и общее время определяется критическим путем графа.
+    Используется пул потоков: извлечение ждет PostgreSQL, а pandas и запись
+    файлов в основном отпускают GIL, при этом большие DataFrame не копируются
+    между процессами.
+    Если задача завершилась ошибкой, все зависящие от нее задачи пропускаются,
+    а независимые ветки продолжают выполняться.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, func, inputs=(), group=None, keep=False):
+        """
+        Добавляет задачу в граф.
+        :param name: Уникальное имя задачи.
+        :param func: Функция, принимающая результаты входов.
+        :param inputs: Имена задач-входов.
+        :param group: Группа для ограничения параллелизма (например, 'extract').
+        :param keep: Вернуть результат задачи после выполнения графа.
+        """
+        if name in self.tasks:
+            raise ValueError(f"Задача '{name}' уже добавлена в граф.")
+        self.tasks[name] = {'func': func, 'inputs': tuple(inputs), 'group': group, 'keep': keep}
+
+    def _check(self):
+        """
+        Проверяет, что все входы существуют и в графе нет циклов.
+        """
+        for name, task in self.tasks.items():
+            for dep in task['inputs']:
+                if dep not in self.tasks:
+                    raise ValueError(f"Задача '{name}' зависит от неизвестной задачи '{dep}'.")
+        visited = {}
+
+        def visit(name, path):
+            state = visited.get(name)
+            if state == 'done':
+                return
+            if state == 'active':
+                raise ValueError(f"Цикл в графе задач: {' -> '.join(path + [name])}")
+            visited[name] = 'active'
+            for dep in self.tasks[name]['inputs']:
+                visit(dep, path + [name])
+            visited[name] = 'done'
+
+        for name in self.tasks:
+            visit(name, [])
+
+    def run(self, max_workers=4, limits=None):
+        """
+        Выполняет граф.
+        Промежуточные результаты освобождаются, как только их получили все
+        зависимые задачи (если у задачи не указан keep=True).
+        :param max_workers: Размер пула потоков.
+        :param limits: Ограничения параллелизма по группам, например {'extract': 4}.
+        :return: (словарь {имя: результат} для задач с keep=True,
+                  словарь {имя: исключение} для упавших и пропущенных задач).
+        """
+        self._check()
+        limits = limits or {}
+        consumers = {name: 0 for name in self.tasks}
+        for task in self.tasks.values():
+            for dep in task['inputs']:
+                consumers[dep] += 1
+
+        pending = dict(self.tasks)
+        results = {}
+        errors = {}
+        running = {}
+        running_groups = {}
+        start = time.perf_counter()
+
+        def release(name):
+            consumers[name] -= 1
+            if consumers[name] == 0 and not self.tasks[name]['keep']:
+                results.pop(name, None)
+
+        def submit_ready(executor):
+            changed = True
+            while changed:
+                changed = False
+                for name, task in list(pending.items()):
+                    failed_inputs = [dep for dep in task['inputs'] if dep in errors]
+                    if failed_inputs:
+                        errors[name] = RuntimeError(f"Пропущена из-за ошибки в задачах: {', '.join(failed_inputs)}")
+                        logging.error(f"Задача '{name}' пропущена: не выполнены входы {failed_inputs}.")
+                        del pending[name]
+                        for dep in task['inputs']:
+                            release(dep)
+                        changed = True
+                        continue
+                    if not all(dep in results for dep in task['inputs']):
+                        continue
+                    group = task['group']
+                    if group in limits and running_groups.get(group, 0) >= limits[group]:
+                        continue
+                    future = executor.submit(task['func'], *[results[dep] for dep in task['inputs']])
+                    running[future] = name
+                    running_groups[group] = running_groups.get(group, 0) + 1
+                    del pending[name]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            submit_ready(executor)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    task = self.tasks[name]
+                    running_groups[task['group']] -= 1
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        errors[name] = e
+                        logging.error(f"Ошибка в задаче '{name}': {e}")
+                    for dep in task['inputs']:
+                        release(dep)
+                    if consumers[name] == 0 and not task['keep']:
+                        results.pop(name, None)
+                submit_ready(executor)
+
+        logging.info(f"Граф из {len(self.tasks)} задач выполнен за {time.perf_counter() - start:.2f} с "
+                     f"(ошибок: {len(errors)}).")
+        return {name: value for name, value in results.items() if self.tasks[name]['keep']}, errors
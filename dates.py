@@ -0,0 +1,139 @@
+import logging
+import threading
+import numpy as np
+import pandas as pd
+
+# Формат дат и времени, которые PostgreSQL отдает текстом (2024-01-31, 2024-01-31 10:15:00)
+ISO_FORMAT = 'ISO8601'
+# Максимальное количество запомненных значений для одного формата
+DATE_CACHE_SIZE = 1_000_000
+
+
+class DateParser:
+    """
+    Разбор столбцов с датами по явному формату.
+    Даты в таблицах сильно повторяются (одна дата визита - у сотен строк), поэтому
+    разбираются только различные значения, а результат раскладывается обратно по
+    кодам pd.factorize. Проверки дат (заглушки, допустимый диапазон лет) выполняются
+    в том же проходе - тоже только для различных значений.
+    Разобранные текстовые значения запоминаются по формату (не больше cache_size на формат),
+    поэтому при потоковой обработке следующие чанки разбирают только новые даты.
+    Экземпляр можно использовать из нескольких потоков.
+    """
+
+    def __init__(self, cache_size=DATE_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _parse_text(self, values, format):
+        """
+        Разбирает различные текстовые значения, используя запомненные результаты.
+        """
+        with self._lock:
+            cached = self._cache.get(format)
+        if cached is None:
+            parsed = pd.to_datetime(values, format=format, errors='coerce')
+            self._remember(format, cached, pd.Series(parsed, index=values))
+            return parsed
+
+        positions = cached.index.get_indexer(values)
+        missing = positions < 0
+        result = cached.to_numpy()[positions]
+        if missing.any():
+            # Единица времени новых значений - как у уже запомненных
+            parsed = pd.to_datetime(values[missing], format=format, errors='coerce').as_unit(cached.dt.unit)
+            result[missing] = parsed.to_numpy()
+            self._remember(format, cached, pd.Series(parsed, index=values[missing]))
+        return pd.DatetimeIndex(result)
+
+    def _remember(self, format, cached, new_values):
+        with self._lock:
+            current = self._cache.get(format)
+            if current is not cached:
+                return  # кеш уже обновил другой поток
+            if current is None or len(current) + len(new_values) > self.cache_size:
+                self._cache[format] = new_values.iloc[:self.cache_size]
+            else:
+                self._cache[format] = pd.concat([current, new_values])
+
+    def parse(self, values, format=None, sentinels=(), min_year=None, max_year=None):
+        """
+        Преобразует значения в datetime и заменяет недопустимые даты на NaT.
+        Уже разобранный столбец (datetime64) повторно не разбирается, только проверяется.
+        :param values: Series с датами (текст, date/datetime или datetime64).
+        :param format: Формат текста ('%d.%m.%Y', ISO_FORMAT; None - определяется pandas).
+        :param sentinels: Даты-заглушки, которые заменяются на NaT (например, validation.SENTINEL_DATES).
+        :param min_year: Даты с годом меньше заменяются на NaT (None - без проверки).
+        :param max_year: Даты с годом больше заменяются на NaT (None - без проверки).
+        :return: Series datetime64 с тем же индексом.
+        """
+        try:
+            if pd.api.types.is_datetime64_any_dtype(values):
+                if not len(sentinels) and min_year is None and max_year is None:
+                    return values
+                return values.mask(self._invalid(values, sentinels, min_year, max_year))
+
+            codes, uniques = pd.factorize(values)
+            if not len(uniques):
+                return pd.to_datetime(values, format=format, errors='coerce')
+            is_text = pd.api.types.is_string_dtype(uniques) and all(isinstance(value, str) for value in uniques[:100])
+            if is_text and format is not None:
+                parsed = self._parse_text(pd.Index(uniques), format)
+            else:
+                parsed = pd.DatetimeIndex(pd.to_datetime(uniques, format=format, errors='coerce'))
+            parsed = parsed.where(~self._invalid(parsed, sentinels, min_year, max_year))
+
+            # Код -1 у пустых значений: берем NaT из добавленного в конец элемента
+            result = np.append(parsed.to_numpy(), np.array(['NaT'], dtype=parsed.dtype))[codes]
+            return pd.Series(result, index=values.index, name=values.name)
+
+        except Exception as e:
+            logging.error(f"Ошибка при разборе дат '{values.name}': {e}")
+            raise
+
+    @staticmethod
+    def _invalid(values, sentinels, min_year, max_year):
+        """
+        Булев массив недопустимых дат: заглушки и годы вне диапазона.
+        """
+        invalid = np.zeros(len(values), dtype=bool)
+        if len(sentinels):
+            invalid |= np.asarray(values.isin(pd.to_datetime(list(sentinels))), dtype=bool)
+        if min_year is not None or max_year is not None:
+            years = np.asarray(values.year if isinstance(values, pd.Index) else values.dt.year)
+            if min_year is not None:
+                invalid |= years < min_year
+            if max_year is not None:
+                invalid |= years > max_year
+        return invalid
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+# Общий для процесса разборщик дат
+_parser = DateParser()
+
+
+def parse(values, format=None, sentinels=(), min_year=None, max_year=None):
+    """
+    Разбирает столбец с датами общим DateParser (см. DateParser.parse).
+    """
+    return _parser.parse(values, format, sentinels, min_year, max_year)
+
+
+def parse_columns(df, formats, sentinels=(), min_year=None, max_year=None):
+    """
+    Разбирает столбцы с датами на месте.
+    :param df: DataFrame.
+    :param formats: {столбец: формат} (например, schema.SCHEMAS[таблица]['dates'])
+                    или список столбцов (формат определяется pandas).
+    :return: df.
+    """
+    if not isinstance(formats, dict):
+        formats = dict.fromkeys(formats)
+    for col, fmt in formats.items():
+        df[col] = parse(df[col], fmt, sentinels, min_year, max_year)
+    return df
@@ -0,0 +1,178 @@
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Бюджет памяти множества ключей (байт): при превышении ключи выгружаются на диск
+DEDUP_MEMORY_BYTES = 256 * 1024 * 1024
+# Количество хеш-разделов на диске (степень двойки)
+SPILL_PARTITIONS = 64
+# Мультипликативный хеш (Фибоначчи) для распределения ключей по разделам
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+class KeySet:
+    """
+    Множество идентификаторов для дедупликации (keep='first') между чанками
+    при потоковой обработке, с ограниченным потреблением памяти.
+    Целочисленные ключи хранятся в отсортированных массивах int64 (8 байт на ключ
+    вместо ~70 у set Python); новые массивы сливаются со старыми по мере роста,
+    поэтому проверка чанка - несколько двоичных поисков (np.searchsorted).
+    Когда массивы превышают memory_bytes, ключи раскладываются по хеш-разделам
+    в отсортированные файлы на диске, а память освобождается. Проверка чанка
+    читает через memmap только нужные страницы разделов.
+    Ключи других типов (строки, дробные числа, пустые значения) хранятся в обычном
+    множестве, поэтому результат проверки совпадает с Series.isin(set).
+    Используйте как контекстный менеджер: по выходу файлы на диске удаляются.
+    """
+
+    def __init__(self, memory_bytes=DEDUP_MEMORY_BYTES, directory=None, partitions=SPILL_PARTITIONS):
+        """
+        :param memory_bytes: Бюджет памяти для целочисленных ключей (байт).
+        :param directory: Каталог для временных файлов (None - системный временный каталог).
+        :param partitions: Количество хеш-разделов на диске (степень двойки).
+        """
+        if partitions < 1 or partitions & (partitions - 1):
+            raise ValueError(f"Количество разделов должно быть степенью двойки: {partitions}")
+        self.memory_bytes = memory_bytes
+        self.directory = directory
+        self.partitions = partitions
+        self._shift = np.uint64(64 - (partitions.bit_length() - 1))
+        self._runs = []
+        self._other = set()
+        self._spill_dir = None
+        self._spilled = np.zeros(partitions, dtype=np.int64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return int(sum(len(run) for run in self._runs) + self._spilled.sum() + len(self._other))
+
+    def close(self):
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+        self._runs = []
+        self._other = set()
+        self._spilled[:] = 0
+
+    @staticmethod
+    def _split(keys):
+        """
+        Разделяет ключи на целочисленные и остальные.
+        :return: (булев массив целочисленных ключей, их значения int64).
+        """
+        values = keys.to_numpy()
+        if pd.api.types.is_integer_dtype(keys.dtype) and values.dtype.kind in 'iu':
+            return np.ones(len(values), dtype=bool), values.astype(np.int64, copy=False)
+        if values.dtype.kind == 'f':
+            with np.errstate(invalid='ignore'):
+                integral = np.isfinite(values) & (np.floor(values) == values) & \
+                    (np.abs(values) < 2.0 ** 63)
+            return integral, values[integral].astype(np.int64)
+        return np.zeros(len(values), dtype=bool), np.empty(0, dtype=np.int64)
+
+    def _partition(self, values):
+        return ((values.view(np.uint64) * _HASH_MULTIPLIER) >> self._shift).astype(np.intp)
+
+    def _partition_path(self, partition):
+        return os.path.join(self._spill_dir, f"part-{partition:04d}.bin")
+
+    def contains(self, keys):
+        """
+        Проверяет, встречались ли ключи (аналог keys.isin(множество)).
+        :param keys: Series с ключами.
+        :return: Булев массив numpy.
+        """
+        keys = pd.Series(keys) if not isinstance(keys, pd.Series) else keys
+        integral, values = self._split(keys)
+        found = np.zeros(len(values), dtype=bool)
+        for run in self._runs:
+            positions = np.searchsorted(run, values)
+            found |= run[np.minimum(positions, len(run) - 1)] == values
+        if self._spilled.any() and len(values):
+            parts = self._partition(values)
+            for partition in np.unique(parts):
+                size = self._spilled[partition]
+                if not size:
+                    continue
+                selected = parts == partition
+                stored = np.memmap(self._partition_path(partition), dtype=np.int64, mode='r', shape=(size,))
+                positions = np.searchsorted(stored, values[selected])
+                found[selected] |= stored[np.minimum(positions, size - 1)] == values[selected]
+                del stored
+
+        result = np.zeros(len(keys), dtype=bool)
+        result[integral] = found
+        if self._other and not integral.all():
+            result[~integral] = keys[~integral].isin(self._other).to_numpy()
+        return result
+
+    def update(self, keys):
+        """
+        Добавляет ключи в множество.
+        :param keys: Series, массив или список ключей.
+        """
+        keys = pd.Series(keys) if not isinstance(keys, pd.Series) else keys
+        integral, values = self._split(keys)
+        if not integral.all():
+            self._other.update(keys[~integral].tolist())
+        if not len(values):
+            return
+        self._runs.append(np.unique(values))
+        # Слияние как в LSM-дереве: размеры массивов убывают, массивов - O(log n)
+        while len(self._runs) > 1 and len(self._runs[-1]) * 2 >= len(self._runs[-2]):
+            last = self._runs.pop()
+            self._runs[-1] = np.union1d(self._runs[-1], last)
+        if sum(run.nbytes for run in self._runs) > self.memory_bytes:
+            self._spill()
+
+    def _spill(self):
+        """
+        Выгружает ключи из памяти в хеш-разделы на диске (каждый раздел - отсортированный файл int64).
+        """
+        try:
+            if self._spill_dir is None:
+                self._spill_dir = tempfile.mkdtemp(prefix='dedup_', dir=self.directory)
+            values = self._runs[0] if len(self._runs) == 1 else np.unique(np.concatenate(self._runs))
+            parts = self._partition(values)
+            order = np.argsort(parts, kind='stable')
+            bounds = np.searchsorted(parts[order], np.arange(self.partitions + 1))
+            for partition in range(self.partitions):
+                new = values[order[bounds[partition]:bounds[partition + 1]]]
+                if not len(new):
+                    continue
+                path = self._partition_path(partition)
+                if self._spilled[partition]:
+                    new = np.union1d(np.fromfile(path, dtype=np.int64), new)
+                new.tofile(path + '.tmp')
+                os.replace(path + '.tmp', path)
+                self._spilled[partition] = len(new)
+            self._runs = []
+            logging.info(f"Дедупликация: {len(values)} ключей выгружено на диск ({self._spill_dir}), "
+                         f"всего на диске {int(self._spilled.sum())}.")
+        except Exception as e:
+            logging.error(f"Ошибка при выгрузке ключей дедупликации на диск: {e}")
+            raise
+
+
+def isin(keys, seen_ids):
+    """
+    Булев массив ключей, которые уже есть в seen_ids (set или KeySet).
+    """
+    if isinstance(seen_ids, KeySet):
+        return seen_ids.contains(keys)
+    return np.asarray(keys.isin(seen_ids), dtype=bool)
+
+
+def add(seen_ids, keys):
+    """
+    Добавляет ключи (Series) в seen_ids (set или KeySet).
+    """
+    seen_ids.update(keys if isinstance(seen_ids, KeySet) else keys.tolist())
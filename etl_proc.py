@@ -1,3 +1,4 @@
+import argparse
 import pandas as pd
 import numpy as np
 from sqlalchemy import create_engine
@@ -5,9 +6,19 @@ import psycopg2
 import logging
 import sql_scripts as sql
 from datetime import datetime
-from extract import extract_data
+from extract import extract_data, extract_chunks
 import transform as tr
 import load as l
+import incremental as inc
+import metrics
+import schema
+import quarantine
+import lookups
+import parallel
+import checkpoint
+import dedup
+from dag import TaskGraph
+from cache import ExtractCache
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,57 +34,454 @@ SQLSERVER_CONN_STRING = 'mssql+pyodbc://user:password@:1433/mydatabase?driver=OD
 #     "driver=ODBC+Driver+17+for+SQL+Server"
 # )
 
+# Максимальное количество одновременных запросов к PostgreSQL
+EXTRACT_WORKERS = 4
+# Количество потоков для графа задач основного ETL-процесса
+ETL_WORKERS = 8
+
+# Брать результаты запросов из локального кеша (.extract_cache), если снимок есть.
+# Удобно при отладке преобразований: повторный запуск не обращается к PostgreSQL.
+# Очистка кеша: python cache.py invalidate [--query query_get_patient]
+USE_EXTRACT_CACHE = False
+
+# Приводить извлеченные таблицы к компактным типам (schema.optimize_dtypes)
+OPTIMIZE_DTYPES = True
+
+# Параллельная выгрузка больших таблиц по диапазонам ключа или даты (extract.extract_chunks):
+# {таблица: параметры}, например {'amb_visit': {'partition_column': 'keyid', 'partitions': 8}}
+# или {'stac_visit': {'partition_column': 'dat', 'bounds': ['2020-01-01', '2023-01-01']}}.
+PARTITIONED_EXTRACT = {}
+
+# Режим справочников: lu, dep и agr выгружаются один раз и кешируются (lookups.DimensionCache),
+# а тексты подставляются в pandas вместо коррелированных подзапросов в PostgreSQL.
+USE_LOOKUPS = False
+
+# Таблицы, для которых функции на каждую строку (ответы протокола, тексты docdep)
+# заменяются пакетными запросами и соединением в pandas (sql_scripts.bulk_queries),
+# например ('diap',). Пустой кортеж - исходные запросы.
+BULK_QUERIES = ()
+
+# Режим pushdown: очистка дат и проверка ссылок на пациентов выполняются в PostgreSQL
+# (sql_scripts.pushdown_queries), а гарантированные запросом правила в Python пропускаются.
+# Инкрементальный процесс использует обычные запросы.
+SQL_PUSHDOWN = False
+
+# Количество процессов для проверок визитов и диагнозов (parallel.process_parallel):
+# таблица делится на шарды, индекс пациентов передается через разделяемую память,
+# дедупликация выполняется по всей таблице. 0 - обработка в основном процессе.
+PARALLEL_TRANSFORM_WORKERS = 0
+
+# Формат выходных файлов: 'csv', 'parquet' или 'feather'
+OUTPUT_FORMAT = 'csv'
+# Разбивать таблицы визитов по году даты визита
+PARTITION_BY_YEAR = False
+# Запись CSV (load.write_csv): сжатие (None, 'gzip' или 'zstd'; к имени файла добавляется .gz/.zst)
+# и количество процессов, форматирующих блоки строк. 0 - запись одним вызовом to_csv.
+CSV_COMPRESSION = None
+CSV_WORKERS = 0
+
+# Карантин отброшенных строк с кодом правила: каталог (None - не сохранять) и формат файлов.
+# Если задана строка подключения, строки дописываются в таблицы quarantine_<таблица> вместо файлов.
+QUARANTINE_DIR = 'quarantine'
+QUARANTINE_FORMAT = 'csv'
+QUARANTINE_CONN_STRING = None
+
+# Контрольные точки основного ETL-процесса (checkpoint.CheckpointStore): результат каждой задачи
+# сохраняется на диск, и упавший запуск можно продолжить (python etl_proc.py --resume). None - отключено.
+# CHECKPOINT_KEEP - не удалять файлы контрольных точек после успешного запуска.
+CHECKPOINT_DIR = checkpoint.CHECKPOINT_DIR
+CHECKPOINT_KEEP = False
+
+# Дедупликация визитов между чанками в потоковом режиме (dedup.KeySet): бюджет памяти
+# множества идентификаторов (МБ) и каталог для выгрузки ключей сверх бюджета (None - временный каталог)
+DEDUP_MEMORY_MB = 256
+DEDUP_SPILL_DIR = None
+
+# Отчет о запуске: JSON (машиночитаемый) и текстовая сводка (None - не сохранять)
+REPORT_JSON_PATH = 'etl_report.json'
+REPORT_TEXT_PATH = 'etl_report.txt'
+
 # Основной ETL-процесс
-def etl_process():
+def etl_process(max_workers=ETL_WORKERS, use_cache=USE_EXTRACT_CACHE, resume=False, invalidate=()):
     """
     Основной ETL-процесс:
     1. Извлечение данных из PostgreSQL.
     2. Преобразование данных.
     3. Выгрузка данных в в csv файлах 
     4. Загрузка данных в SQL Server. (В разработке)
+    Шаги выполняются как граф задач (dag.TaskGraph): каждый шаг запускается,
+    как только готовы его входы. Например, справочник врачей преобразуется и
+    сохраняется, не дожидаясь выгрузки визитов, а визиты обрабатываются сразу
+    после построения индекса пациентов.
+    По каждому шагу собирается отчет (время, строки, удаленные строки, память).
+    Отброшенные проверками строки сохраняются в карантин (QUARANTINE_*).
+    Результаты задач сохраняются в контрольные точки (CHECKPOINT_DIR): при resume=True
+    выполняются только упавшие, не выполненные и сброшенные задачи и зависящие от них.
+    :param max_workers: Количество потоков для выполнения графа.
+    :param use_cache: Использовать локальный кеш извлеченных данных (ExtractCache).
+    :param resume: Продолжить предыдущий запуск по манифесту контрольных точек.
+    :param invalidate: Задачи, которые нужно выполнить заново (например, ['raw_po']).
     """
-    
-    # Извлечение данных
-    try:
-        # Шаг 1: Извлечение данных
-        raw_data_patient = extract_data(sql.query_get_patient, POSTGRES_CONN_STRING)
-        raw_data_stac_visit = extract_data(sql.stac_query_get_visit, POSTGRES_CONN_STRING)
-        raw_data_amb_visit = extract_data(sql.amb_query_get_visit, POSTGRES_CONN_STRING)
-        raw_data_dol = extract_data(sql.query_get_dolznost, POSTGRES_CONN_STRING)
-        raw_data_doc = extract_data(sql.query_get_doctor, POSTGRES_CONN_STRING)
-        raw_data_diap = extract_data(sql.amb_query_get_diagn_pat, POSTGRES_CONN_STRING)
-        raw_data_po = extract_data(sql.stac_query_get_PO_visit , POSTGRES_CONN_STRING)
-        logging.info("Выгрузка данных успешно завершена.")
-    except Exception as e:
-        logging.error(f"Ошибка в ETL-процессе: {e}")
+    report = metrics.RunReport('etl_process')
+    graph = TaskGraph()
+    cache = ExtractCache() if use_cache else None
+
+    def fetch(step_name, query, **partition):
+        return lambda: report.track(step_name, 'extract', extract_data, query, POSTGRES_CONN_STRING,
+                                    pool_size=EXTRACT_WORKERS, cache=cache, **partition)
+
+    def prepare(name):
+        # Подстановка справочников и пакетных значений, затем оптимизация типов
+        def run(df, *bulk_frames):
+            if name in resolve:
+                dimensions = lookups.get_dimension_cache(POSTGRES_CONN_STRING, EXTRACT_WORKERS)
+                df = report.track(f"resolve lookups {name}", 'transform', dimensions.resolve, df, resolve[name])
+            for (_, key), bulk_df in zip(bulk.get(name, ()), bulk_frames):
+                df = report.track(f"join bulk {name} {key}", 'transform', lookups.join_bulk, df, bulk_df, key)
+            if OPTIMIZE_DTYPES and name in schema.SCHEMAS:
+                df = report.track(f"optimize_dtypes {name}", 'transform', schema.optimize_dtypes, df, name)
+            return df
+        return run
+
+    def extract(name, query):
+        return lambda: prepare(name)(fetch(f"extract {name}", query, **PARTITIONED_EXTRACT.get(name, {}))())
+
+    def transform(func, **kwargs):
+        return lambda *args: report.track(func.__name__, 'transform', func, *args, **kwargs)
+
+    def check(func, **kwargs):
+        # Проверки ссылок на пациентов: в пуле процессов, если задан PARALLEL_TRANSFORM_WORKERS
+        if PARALLEL_TRANSFORM_WORKERS < 2:
+            return transform(func, **kwargs)
+        return lambda *args: report.track(func.__name__, 'transform', parallel.process_parallel, func, *args,
+                                          workers=PARALLEL_TRANSFORM_WORKERS, **kwargs)
+
+    def save(base_path, date_column):
+        def run(df):
+            with report.step(f"save {base_path}", 'load', len(df)) as step:
+                l.save_table(df, base_path, OUTPUT_FORMAT,
+                             compression=CSV_COMPRESSION if OUTPUT_FORMAT == 'csv' else 'default',
+                             partition_by_year=date_column if PARTITION_BY_YEAR else None, workers=CSV_WORKERS)
+                step['rows_out'] = len(df)
+        return run
+
+    queries, guaranteed, resolve, bulk = _source_queries()
+
+    # Извлечение данных (одновременно не больше EXTRACT_WORKERS запросов).
+    # В пакетном режиме основной и пакетные запросы выполняются параллельно, а соединяются отдельной задачей.
+    for name, query in queries.items():
+        if name not in bulk:
+            graph.add(f"raw_{name}", extract(name, query), group='extract')
+            continue
+        inputs = [f"main_{name}"]
+        graph.add(f"main_{name}", fetch(f"extract {name}", query, **PARTITIONED_EXTRACT.get(name, {})),
+                  group='extract')
+        for i, (bulk_query, key) in enumerate(bulk[name]):
+            inputs.append(f"bulk_{name}_{i}")
+            graph.add(inputs[-1], fetch(f"extract bulk {name} {key}", bulk_query), group='extract')
+        graph.add(f"raw_{name}", prepare(name), inputs)
+
+    # Преобразование: от пациентов зависят только визиты, диагнозы и визиты приемного отделения
+    graph.add('doc', transform(tr.process_doc_data), ['raw_doc'])
+    graph.add('patient', transform(tr.process_patient_data), ['raw_patient'])
+    # Индекс пациентов строится один раз и используется всеми проверками ссылок;
+    # from_frame строит его сразу, до того как его начнут читать параллельные задачи
+    graph.add('patient_index', tr.PatientIndex.from_frame, ['patient'])
+    graph.add('stac_visit', check(tr.process_hospital_visits, guaranteed=guaranteed['stac_visit']),
+              ['raw_stac_visit', 'patient_index'])
+    graph.add('diap', check(tr.process_diagnoses_data, guaranteed=guaranteed['diap']),
+              ['raw_diap', 'patient_index'])
+    graph.add('amb_visit', check(tr.process_visits_data, guaranteed=guaranteed['amb_visit']),
+              ['raw_amb_visit', 'patient_index'])
+    graph.add('po', check(tr.process_po_visit_data, guaranteed=guaranteed['po']),
+              ['raw_po', 'patient_index'])
+
+    # Выгрузка в файлы (формат OUTPUT_FORMAT): (вход, имя файла без расширения, столбец даты для разбиения по годам)
+    for node, base_path, date_column in [
+        ('patient', 'Patient_f', None),
+        ('amb_visit', "AMB visit", 'dat'),
+        ('raw_dol', "dols", None),
+        ('diap', "AMB diap", None),
+        ('stac_visit', "STAC visit", 'dat'),
+        ('doc', "doc", None),
+        ('po', "po_visit", 'dat_st'),
+    ]:
+        graph.add(f"save {base_path}", save(base_path, date_column), [node])
+
+    store = None
+    if CHECKPOINT_DIR is not None:
+        store = checkpoint.CheckpointStore(CHECKPOINT_DIR, resume=resume)
+        graph = store.wrap(graph, _checkpoint_keys(graph, queries, guaranteed, resolve, bulk), invalidate)
+
+    with quarantine.session(_quarantine()):
+        _, errors = graph.run(max_workers=max_workers, limits={'extract': EXTRACT_WORKERS})
+    if store is not None:
+        store.finish(errors, keep=CHECKPOINT_KEEP)
+    if errors:
+        logging.error(f"ETL-процесс завершен с ошибками в задачах: {', '.join(errors)}")
+    else:
+        logging.info("ETL-процесс успешно завершен.")
+
+    _write_report(report)
+
+
+def _checkpoint_keys(graph, queries, guaranteed, resolve, bulk):
+    """
+    Ключи задач основного графа для контрольных точек: задача выполняется заново,
+    если изменились ее запрос или влияющие на результат настройки.
+    """
+    key = checkpoint.CheckpointStore.key
+    keys = {}
+    for name, query in queries.items():
+        keys[f"raw_{name}"] = keys[f"main_{name}"] = key(
+            [query, PARTITIONED_EXTRACT.get(name), resolve.get(name), OPTIMIZE_DTYPES])
+        for i, (bulk_query, _) in enumerate(bulk.get(name, ())):
+            keys[f"bulk_{name}_{i}"] = key(bulk_query)
+        keys[name] = key(list(guaranteed[name]))
+    for name in graph.tasks:
+        if name.startswith('save '):
+            keys[name] = key([OUTPUT_FORMAT, PARTITION_BY_YEAR, CSV_COMPRESSION])
+    return keys
+
+
+def _write_report(report):
+    """
+    Сохраняет отчет о запуске и выводит текстовую сводку в лог.
+    """
+    if REPORT_JSON_PATH is not None:
+        report.write(REPORT_JSON_PATH, REPORT_TEXT_PATH)
+    logging.info("Сводка по шагам ETL:\n" + report.summary())
+
+
+def _source_queries(pushdown=None, use_lookups=None, bulk_tables=None):
+    """
+    Запросы к источнику, коды правил, которые они гарантируют, столбцы
+    для подстановки текстов из справочников и пакетные запросы.
+    :param pushdown: Использовать запросы режима pushdown (None - по настройке SQL_PUSHDOWN).
+    :param use_lookups: Использовать запросы режима справочников (None - по настройке USE_LOOKUPS).
+    :param bulk_tables: Таблицы в пакетном режиме (None - по настройке BULK_QUERIES).
+    :return: (словарь {имя таблицы: запрос}, словарь {имя таблицы: кортеж правил},
+              словарь {имя таблицы: столбцы для DimensionCache.resolve},
+              словарь {имя таблицы: [(пакетный запрос, столбец-ключ), ...]}).
+    """
+    queries = {
+        'patient': sql.query_get_patient,
+        'stac_visit': sql.stac_query_get_visit,
+        'amb_visit': sql.amb_query_get_visit,
+        'dol': sql.query_get_dolznost,
+        'doc': sql.query_get_doctor,
+        'diap': sql.amb_query_get_diagn_pat,
+        'po': sql.stac_query_get_PO_visit,
+    }
+    guaranteed = {name: () for name in queries}
+    resolve = {}
+    bulk = {}
+    for name in BULK_QUERIES if bulk_tables is None else bulk_tables:
+        queries[name], bulk[name] = sql.bulk_queries[name]
+    if USE_LOOKUPS if use_lookups is None else use_lookups:
+        for name, (query, columns) in sql.lookup_queries.items():
+            queries[name] = query
+            resolve[name] = columns
+    if SQL_PUSHDOWN if pushdown is None else pushdown:
+        for name, (query, rules) in sql.pushdown_queries(queries).items():
+            queries[name] = query
+            guaranteed[name] = rules
+    return queries, guaranteed, resolve, bulk
+
+
+def _prepare_chunks(process, name, resolve, bulk):
+    """
+    Добавляет к преобразованию чанка подстановку текстов из справочников и
+    значений пакетных запросов. Пакетные запросы выполняются один раз, до первого чанка.
+    """
+    columns = resolve.get(name)
+    parts = [(extract_data(query, POSTGRES_CONN_STRING, pool_size=EXTRACT_WORKERS), key)
+             for query, key in bulk.get(name, ())]
+    if columns is None and not parts:
+        return process
+    dimensions = lookups.get_dimension_cache(POSTGRES_CONN_STRING, EXTRACT_WORKERS) if columns is not None else None
+
+    def run(chunk):
+        if dimensions is not None:
+            chunk = dimensions.resolve(chunk, columns)
+        for bulk_df, key in parts:
+            chunk = lookups.join_bulk(chunk, bulk_df, key)
+        return chunk if process is None else process(chunk)
+    return run
+
+
+def _quarantine():
+    """
+    Карантин для запуска по настройкам QUARANTINE_* (None, если он отключен).
+    """
+    if QUARANTINE_DIR is None and QUARANTINE_CONN_STRING is None:
+        return None
+    return quarantine.QuarantineSink(QUARANTINE_DIR, QUARANTINE_FORMAT, QUARANTINE_CONN_STRING)
+
+
+def _stream(query, process=None, batch_size=100000, step=None, partition=None):
+    """
+    Извлекает данные чанками и применяет к каждому чанку функцию преобразования.
+    Если передан шаг отчета, в нем накапливается количество извлеченных строк.
+    """
+    for chunk in extract_chunks(query, POSTGRES_CONN_STRING, batch_size, EXTRACT_WORKERS, **(partition or {})):
+        if step is not None:
+            step['rows_in'] += len(chunk)
+        yield chunk if process is None else process(chunk)
+
+
+def _stream_table(report, name, query, process, file_path, batch_size):
+    """
+    Потоковая обработка одной таблицы как один шаг отчета (извлечение, преобразование и запись).
+    """
+    with report.step(name, 'stream', rows_in=0) as step:
+        chunks = _stream(query, process, batch_size, step, PARTITIONED_EXTRACT.get(name))
+        step['rows_out'] = l.save_chunks_to_csv(chunks, l.csv_path(file_path, CSV_COMPRESSION),
+                                                compression=CSV_COMPRESSION, workers=CSV_WORKERS)
+
+
+def _seen_ids():
+    """
+    Множество идентификаторов визитов, общее для всех чанков таблицы (дедупликация keep='first').
+    """
+    return dedup.KeySet(DEDUP_MEMORY_MB * 1024 * 1024, DEDUP_SPILL_DIR)
+
+
+# Потоковый ETL-процесс
+def etl_process_streaming(batch_size=100000):
+    """
+    Потоковый ETL-процесс: каждый чанк извлекается, преобразуется и
+    дописывается в csv сразу после поступления. Пиковое потребление памяти
+    ограничено размером чанка, а не размером таблицы.
+    Целиком в памяти держится только индекс keyid пациентов (PatientIndex),
+    нужный для проверки ссылок в визитах и диагнозах. Идентификаторы визитов для
+    дедупликации между чанками занимают не больше DEDUP_MEMORY_MB, остальное выгружается на диск.
+    :param batch_size: Количество строк в одном чанке.
+    """
+    report = metrics.RunReport('etl_process_streaming')
+    queries, guaranteed, resolve, bulk = _source_queries()
+
+    def prepared(name, process):
+        return _prepare_chunks(process, name, resolve, bulk)
 
-    # Преобразование
     try:
-        new_data_doc = tr.process_doc_data(raw_data_doc)
-        new_data_patient = tr.process_patient_data(raw_data_patient)
-        new_data_stac_visit = tr.process_hospital_visits(raw_data_stac_visit, new_data_patient)
-        new_data_diap = tr.process_diagnoses_data(raw_data_diap, new_data_patient)
-        new_data_visit = tr.process_visits_data(raw_data_amb_visit, new_data_patient)
-        new_data_po = tr.process_po_visit_data(raw_data_po, new_data_patient)
+        with quarantine.session(_quarantine()):
+            # Справочники
+            _stream_table(report, 'dols', queries['dol'], None, "dols.csv", batch_size)
+            _stream_table(report, 'doc', queries['doc'], prepared('doc', tr.process_doc_data),
+                          "doc.csv", batch_size)
+
+            # Пациенты: сохраняем чанками и пополняем индекс keyid для проверки ссылок
+            patient_index = tr.PatientIndex()
 
+            def process_patient_chunk(chunk):
+                chunk = tr.process_patient_data(chunk)
+                patient_index.add(chunk['keyid'])
+                return chunk
+
+            _stream_table(report, 'patient', queries['patient'],
+                          prepared('patient', process_patient_chunk), 'Patient_f.csv', batch_size)
+
+            # Факты: дедупликация по идентификатору визита общая для всех чанков
+            with _seen_ids() as seen_amb_visits:
+                _stream_table(report, 'amb_visit', queries['amb_visit'],
+                              prepared('amb_visit',
+                                       lambda chunk: tr.process_visits_data(chunk, patient_index,
+                                                                            seen_ids=seen_amb_visits,
+                                                                            guaranteed=guaranteed['amb_visit'])),
+                              "AMB visit.csv", batch_size)
+            _stream_table(report, 'diap', queries['diap'],
+                          prepared('diap',
+                                   lambda chunk: tr.process_diagnoses_data(chunk, patient_index,
+                                                                           guaranteed=guaranteed['diap'])),
+                          "AMB diap.csv", batch_size)
+            _stream_table(report, 'stac_visit', queries['stac_visit'],
+                          prepared('stac_visit',
+                                   lambda chunk: tr.process_hospital_visits(chunk, patient_index,
+                                                                            guaranteed=guaranteed['stac_visit'])),
+                          "STAC visit.csv", batch_size)
+            with _seen_ids() as seen_po_visits:
+                _stream_table(report, 'po', queries['po'],
+                              prepared('po',
+                                       lambda chunk: tr.process_po_visit_data(chunk, patient_index,
+                                                                              seen_ids=seen_po_visits,
+                                                                              guaranteed=guaranteed['po'])),
+                              "po_visit.csv", batch_size)
+
+            logging.info("Потоковый ETL-процесс успешно завершен.")
     except Exception as e:
-        logging.error(f"Ошибка в ETL-процессе - преобразование: {e}")
+        logging.error(f"Ошибка в потоковом ETL-процессе: {e}")
+        raise
+    finally:
+        _write_report(report)
 
-    # Выгрузка в csv
+# Инкрементальный ETL-процесс
+def etl_process_incremental(state_path=inc.STATE_FILE):
+    """
+    Инкрементальный ETL-процесс:
+    1. Справочники и пациенты выгружаются полностью.
+    2. Визиты, диагнозы и визиты приемного отделения выгружаются только
+       начиная с отметки предыдущего запуска (файл состояния state_path).
+    3. Новые строки проходят преобразование и сливаются с предыдущими csv по ключу.
+    4. Отметки вычисляются по строкам, прошедшим проверки, и сохраняются только
+       после успешной записи всех файлов.
+    Изменения уже выгруженных строк находятся только для диагнозов с позже
+    заполненными датами подтверждения и снятия (см. incremental.INCREMENTAL_QUERIES).
+    """
+    outputs = {
+        'amb_visit': (tr.process_visits_data, "AMB visit.csv"),
+        'stac_visit': (tr.process_hospital_visits, "STAC visit.csv"),
+        'diap': (tr.process_diagnoses_data, "AMB diap.csv"),
+        'po': (tr.process_po_visit_data, "po_visit.csv"),
+    }
+    report = metrics.RunReport('etl_process_incremental')
     try:
-        l.save_to_csv(new_data_patient, 'Patient_f.csv')
-        l.save_to_csv(new_data_visit, "AMB visit.csv")
-        l.save_to_csv(raw_data_dol, "dols.csv")
-        l.save_to_csv(raw_data_doc, "doc.csv")
-        l.save_to_csv(new_data_diap, "AMB diap.csv")
-        l.save_to_csv(new_data_stac_visit, "STAC visit.csv")
-        l.save_to_csv(new_data_doc, "doc.csv")
-        l.save_to_csv(new_data_po, "po_visit.csv")
+        with quarantine.session(_quarantine()):
+            state = inc.load_state(state_path)
+
+            raw_data_dol = report.track('extract dol', 'extract', extract_data, sql.query_get_dolznost, POSTGRES_CONN_STRING)
+            raw_data_doc = report.track('extract doc', 'extract', extract_data, sql.query_get_doctor, POSTGRES_CONN_STRING)
+            raw_data_patient = report.track('extract patient', 'extract',
+                                            extract_data, sql.query_get_patient, POSTGRES_CONN_STRING)
+            report.track('save dols', 'load', l.save_to_csv, raw_data_dol, "dols.csv")
+            new_data_doc = report.track('process_doc_data', 'transform', tr.process_doc_data, raw_data_doc)
+            report.track('save doc', 'load', l.save_to_csv, new_data_doc, "doc.csv")
+            new_data_patient = report.track('process_patient_data', 'transform', tr.process_patient_data, raw_data_patient)
+            report.track('save Patient_f', 'load', l.save_to_csv, new_data_patient, 'Patient_f.csv')
+            patient_index = tr.PatientIndex.from_frame(new_data_patient)
+
+            new_state = dict(state)
+            # Дата начала запуска: строки, измененные во время выгрузки, попадут в следующий запуск
+            new_state[inc.LAST_RUN_KEY] = datetime.now().date().isoformat()
+            for name, (process, file_path) in outputs.items():
+                config = inc.INCREMENTAL_QUERIES[name]
+                watermark = state.get(name)
+                query, params = inc.build_incremental_query(config['query'], config['column'], watermark,
+                                                            config['inclusive'], config.get('changed'),
+                                                            state.get(inc.LAST_RUN_KEY))
+                raw_data = report.track(f"extract {name}", 'extract', extract_data, query, POSTGRES_CONN_STRING, params=params)
+                logging.info(f"'{name}': выгружено {len(raw_data)} строк после отметки {watermark}.")
+                if raw_data.empty:
+                    continue
+                new_data = report.track(process.__name__, 'transform', process, raw_data, patient_index)
+                # Отметка - по строкам, прошедшим проверки
+                new_state[name] = inc.next_watermark(new_data, config['column'], watermark)
+                report.track(f"merge {name}", 'load', l.merge_into_csv, new_data, file_path, config['key'])
+
+            inc.save_state(new_state, state_path)
+            logging.info("Инкрементальный ETL-процесс успешно завершен.")
     except Exception as e:
-        logging.error(f"Ошибка в ETL-процессе - csv: {e}")
-        
-        logging.info("ETL-процесс успешно завершен.")
+        logging.error(f"Ошибка в инкрементальном ETL-процессе: {e}")
+        raise
+    finally:
+        _write_report(report)
 
 # Запуск ETL-процесса
 if __name__ == "__main__":
-    etl_process()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="ETL-процесс PostgreSQL -> csv")
+    parser.add_argument('--resume', action='store_true',
+                        help="Продолжить упавший запуск: выполненные задачи берутся из контрольных точек")
+    parser.add_argument('--invalidate', nargs='+', default=(), metavar='TASK',
+                        help="Задачи, которые нужно выполнить заново вместе с зависимыми (например, raw_po)")
+    args = parser.parse_args()
+    etl_process(resume=args.resume, invalidate=args.invalidate)
\ No newline at end of file
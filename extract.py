@@ -1,31 +1,382 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
 import logging
+import numbers
+import time
+import os
+from decimal import Decimal
+import numpy as np
 import pandas as pd
 
+# Общие пулы подключений: один engine на строку подключения и размер пула
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(conn_string, pool_size=5):
+    """
+    Возвращает общий engine для строки подключения.
+    Пул ограничен pool_size соединениями (без overflow), поэтому
+    параллельные запросы не открывают лишних подключений к серверу:
+    запрос, которому не хватило соединения, ждет освобождения (без таймаута).
+    :param conn_string: Строка подключения.
+    :param pool_size: Максимальное количество соединений в пуле.
+    :return: SQLAlchemy Engine.
+    """
+    key = (conn_string, pool_size)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = create_engine(conn_string, pool_size=pool_size, max_overflow=0, pool_timeout=None,
+                                   pool_pre_ping=True)
+            _engines[key] = engine
+        return engine
+
+
+# Типы PostgreSQL (OID) -> типы pandas для движка COPY
+_PG_INT_TYPES = {20, 21, 23}
+_PG_FLOAT_TYPES = {700, 701}
+# numeric: разбирается в Decimal, как у psycopg2 (float64 потерял бы точность)
+_PG_NUMERIC_TYPES = {1700}
+_PG_BOOL_TYPES = {16}
+_PG_DATE_TYPES = {1082, 1114, 1184}
+
+# Представление NULL в потоке COPY: пустое поле без кавычек pandas не отличает
+# от пустой строки в кавычках, поэтому NULL передается отдельной меткой
+_COPY_NULL = '\\N'
+
+# Доступные движки извлечения
+EXTRACT_METHODS = ('read_sql', 'copy')
+
+# Количество чанков одной части (выгрузка по диапазонам), которые могут ждать передачи дальше
+PARTITION_QUEUE_CHUNKS = 2
+
+
+def _copy_dtypes(description):
+    """
+    Строит типы столбцов по описанию курсора PostgreSQL.
+    :return: (словарь dtype, список столбцов с датами, список столбцов numeric).
+    """
+    dtypes = {}
+    parse_dates = []
+    numeric = []
+    for i, column in enumerate(description):
+        name = f'c{i}'
+        if column.type_code in _PG_INT_TYPES:
+            dtypes[name] = 'Int64'
+        elif column.type_code in _PG_FLOAT_TYPES:
+            dtypes[name] = 'float64'
+        elif column.type_code in _PG_BOOL_TYPES:
+            dtypes[name] = 'boolean'
+        elif column.type_code in _PG_DATE_TYPES:
+            parse_dates.append(name)
+        elif column.type_code in _PG_NUMERIC_TYPES:
+            dtypes[name] = str
+            numeric.append(name)
+        else:
+            dtypes[name] = str
+    return dtypes, parse_dates, numeric
+
+
+def _read_copy_csv(reader, names, dtypes, parse_dates, numeric, batch_size):
+    """
+    Разбирает поток CSV от COPY (query) TO STDOUT в чанки DataFrame.
+    :param names: Исходные имена столбцов (в том числе повторяющиеся).
+    :param dtypes: Типы столбцов c0, c1, ... (см. _copy_dtypes).
+    """
+    for chunk in pd.read_csv(reader, header=0, names=[f'c{i}' for i in range(len(names))],
+                             dtype=dtypes, parse_dates=parse_dates, chunksize=batch_size,
+                             keep_default_na=False, na_values=[_COPY_NULL]):
+        for name in numeric:
+            chunk[name] = chunk[name].astype(object).map(Decimal, na_action='ignore')
+        # Возвращаем исходные имена (в том числе повторяющиеся)
+        chunk.columns = names
+        yield chunk
+
+
+def _copy_chunks(query, engine, batch_size, params=None):
+    """
+    Извлекает данные через COPY (query) TO STDOUT.
+    Поток CSV от сервера передается через pipe напрямую в pd.read_csv,
+    который сразу строит типизированные чанки без промежуточных
+    Python-кортежей. Типы столбцов берутся из описания запроса.
+    NULL передается меткой \\N, поэтому пустые строки и тексты вроде 'NA' или 'NULL'
+    остаются строками, как при read_sql.
+    """
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        if params:
+            # COPY не поддерживает bind-параметры: подставляем их на стороне клиента
+            if hasattr(query, 'compile'):
+                query = query.compile(dialect=engine.dialect)
+            query = cursor.mogrify(str(query), params).decode()
+        else:
+            query = str(query)
+        cursor.execute(f"select * from ({query}) q limit 0")
+        names = [column.name for column in cursor.description]
+        dtypes, parse_dates, numeric = _copy_dtypes(cursor.description)
+        cursor.close()
+
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def produce():
+            try:
+                with os.fdopen(write_fd, 'wb') as writer:
+                    copy_cursor = raw.cursor()
+                    copy_cursor.copy_expert(
+                        f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '{_COPY_NULL}')", writer)
+                    copy_cursor.close()
+            except Exception as e:
+                errors.append(e)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            with os.fdopen(read_fd, 'rb') as reader:
+                yield from _read_copy_csv(reader, names, dtypes, parse_dates, numeric, batch_size)
+        except Exception:
+            producer.join()
+            if errors:
+                raise errors[0]
+            raise
+        producer.join()
+        if errors:
+            raise errors[0]
+    finally:
+        raw.close()
+
+
 # Слой извлечения данных
-def extract_data(query, source_conn_string, batch_size=100000):
+def _query_text(query):
+    return query.text if hasattr(query, 'text') else str(query)
+
+
+def partition_bounds(query, column, source_conn_string, partitions, params=None, pool_size=5):
     """
-    Извлекает данные из PostgreSQL.
+    Делит диапазон значений столбца на равные части по min/max результата запроса.
+    :param query: SQL-запрос.
+    :param column: Столбец результата для разбиения (например, 'keyid' или 'dat').
+    :param partitions: Количество частей.
+    :return: Отсортированный список внутренних границ (partitions - 1 значений или меньше).
+    """
+    engine = get_engine(source_conn_string, pool_size)
+    bounds_query = text(f"select min(q.{column}) as lower, max(q.{column}) as upper from ({_query_text(query)}) q")
+    with engine.connect() as conn:
+        lower, upper = conn.execute(bounds_query, params or {}).one()
+    if lower is None or partitions < 2:
+        return []
+    if isinstance(lower, numbers.Number):
+        points = np.linspace(float(lower), float(upper), partitions + 1)[1:-1]
+        if isinstance(lower, numbers.Integral):
+            points = np.ceil(points).astype(np.int64)
+        return sorted(set(points.tolist()))
+    points = pd.date_range(pd.Timestamp(lower), pd.Timestamp(upper), periods=partitions + 1)[1:-1]
+    return sorted(set(points.to_pydatetime().tolist()))
+
+
+def partition_queries(query, column, bounds, params=None):
+    """
+    Строит запросы по диапазонам столбца: (-inf, b1), [b1, b2), ..., [bn, +inf).
+    Строки с пустым значением столбца попадают в первый диапазон, поэтому
+    объединение частей совпадает с результатом исходного запроса.
+    :return: Список (запрос, параметры).
+    """
+    if not bounds:
+        return [(query, params)]
+    base = f"select * from ({_query_text(query)}) q where "
+    parts = [(text(base + f"(q.{column} < :part_upper or q.{column} is null)"),
+              {**(params or {}), 'part_upper': bounds[0]})]
+    for lower, upper in zip(bounds[:-1], bounds[1:]):
+        parts.append((text(base + f"q.{column} >= :part_lower and q.{column} < :part_upper"),
+                      {**(params or {}), 'part_lower': lower, 'part_upper': upper}))
+    parts.append((text(base + f"q.{column} >= :part_lower"), {**(params or {}), 'part_lower': bounds[-1]}))
+    return parts
+
+
+def _put(target, item, stop):
+    """
+    Кладет элемент в очередь, пока потребитель не прекратил чтение (stop).
+    :return: False, если чтение прекращено.
+    """
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _partitioned_chunks(query, source_conn_string, batch_size, pool_size, params, method, partition_column,
+                        partitions, bounds, ordered):
+    """
+    Выполняет запросы по диапазонам параллельно в общем пуле соединений вызывающего
+    (get_engine(source_conn_string, pool_size)): одновременно выполняется не больше
+    pool_size частей. Чанки передаются через очереди ограниченного размера: часть,
+    чанки которой еще не забрали, приостанавливается, поэтому в памяти держится не больше
+    PARTITION_QUEUE_CHUNKS чанков на выполняемую часть.
+    Возвращает пары (номер части, чанк): по порядку диапазонов (ordered=True) или по мере
+    готовности частей (ordered=False). При ordered=True приостановленные части держат
+    соединения, пока не дойдет их очередь, поэтому пул не должен быть занят другими
+    запросами того же потребителя.
+    """
+    if bounds is None:
+        bounds = partition_bounds(query, partition_column, source_conn_string, partitions, params, pool_size)
+    parts = partition_queries(query, partition_column, bounds, params)
+    workers = min(len(parts), pool_size)
+    logging.info(f"Запрос разбит на {len(parts)} частей по столбцу '{partition_column}', "
+                 f"одновременно выполняется {workers}.")
+
+    if ordered:
+        queues = [queue.Queue(PARTITION_QUEUE_CHUNKS) for _ in parts]
+    else:
+        queues = [queue.Queue(PARTITION_QUEUE_CHUNKS * workers)] * len(parts)
+    stop = threading.Event()
+    done = object()
+
+    def produce(part, part_query, part_params):
+        chunks = extract_chunks(part_query, source_conn_string, batch_size, pool_size, part_params, method)
+        try:
+            for chunk in chunks:
+                if not _put(queues[part], (part, chunk), stop):
+                    return
+            _put(queues[part], (part, done), stop)
+        except Exception as e:
+            _put(queues[part], (part, e), stop)
+        finally:
+            chunks.close()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for part, (part_query, part_params) in enumerate(parts):
+            executor.submit(produce, part, part_query, part_params)
+        # При ordered=True части читаются по очереди; иначе все части пишут в одну очередь
+        remaining = len(parts)
+        current = 0
+        while remaining:
+            part, item = queues[current].get()
+            if item is done:
+                remaining -= 1
+                if ordered:
+                    current += 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            yield part, item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+def extract_chunks(query, source_conn_string, batch_size=100000, pool_size=5, params=None, method='read_sql',
+                   partition_column=None, partitions=1, bounds=None, ordered=True):
+    """
+    Извлекает данные из PostgreSQL порциями (генератор).
+    Использует серверный курсор (stream_results), поэтому в памяти
+    одновременно находится не больше одного чанка.
+    Если указан partition_column, запрос делится на диапазоны значений этого
+    столбца, которые выгружаются параллельно в соединениях того же пула
+    (не больше pool_size одновременно; в памяти держится не больше
+    PARTITION_QUEUE_CHUNKS еще не переданных дальше чанков на часть).
     :param query: SQL-запрос для извлечения данных.
     :param source_conn_string: Строка подключения к PostgreSQL.
-    :return: DataFrame с данными.
+    :param batch_size: Количество строк в одном чанке.
+    :param pool_size: Размер общего пула соединений.
+    :param params: Параметры запроса (для запросов с bind-параметрами).
+    :param method: Движок извлечения: 'read_sql' (pd.read_sql) или
+                   'copy' (COPY TO STDOUT с типизированным разбором CSV).
+    :param partition_column: Столбец для разбиения (например, 'keyid' или 'dat').
+    :param partitions: Количество диапазонов, если границы считаются по min/max.
+    :param bounds: Явные внутренние границы диапазонов (вместо min/max).
+    :param ordered: Возвращать части по порядку диапазонов (иначе - по мере готовности).
+    :return: Итератор DataFrame-ов.
     """
+    if partition_column is not None and (partitions > 1 or bounds):
+        for _, chunk in _partitioned_chunks(query, source_conn_string, batch_size, pool_size, params, method,
+                                            partition_column, partitions, bounds, ordered):
+            yield chunk
+        return
     try:
-        engine = create_engine(source_conn_string)
+        if method not in EXTRACT_METHODS:
+            raise ValueError(f"Неизвестный движок извлечения: {method}")
+        engine = get_engine(source_conn_string, pool_size)
         logging.info("Подключение к PostgreSQL установлено.")
 
-        # Читаем данные чанками и собираем в список
-        chunks = []
-        for chunk in pd.read_sql(query, engine, chunksize=batch_size):
-            chunks.append(chunk)
-            logging.info(f"Выгружено {len(chunk)} строк (всего: {sum(len(c) for c in chunks)})")
+        total = 0
+        if method == 'copy':
+            for chunk in _copy_chunks(query, engine, batch_size, params):
+                total += len(chunk)
+                logging.info(f"Выгружено {len(chunk)} строк (всего: {total})")
+                yield chunk
+        else:
+            with engine.connect().execution_options(stream_results=True) as conn:
+                for chunk in pd.read_sql(query, conn, params=params, chunksize=batch_size):
+                    total += len(chunk)
+                    logging.info(f"Выгружено {len(chunk)} строк (всего: {total})")
+                    yield chunk
 
-        # Объединяем все чанки в один DataFrame
-        full_df = pd.concat(chunks, ignore_index=True)
-        logging.info(f"Итоговый размер данных: {len(full_df)} строк.")
-        
-        return full_df
+        logging.info(f"Итоговый размер данных: {total} строк.")
 
     except Exception as e:
         logging.error(f"Ошибка при извлечении данных: {e}")
-        raise
\ No newline at end of file
+        raise
+
+
+def extract_data(query, source_conn_string, batch_size=100000, pool_size=5, params=None, method='read_sql',
+                 cache=None, partition_column=None, partitions=1, bounds=None):
+    """
+    Извлекает данные из PostgreSQL.
+    :param query: SQL-запрос для извлечения данных.
+    :param source_conn_string: Строка подключения к PostgreSQL.
+    :param params: Параметры запроса (для запросов с bind-параметрами).
+    :param method: Движок извлечения ('read_sql' или 'copy').
+    :param cache: ExtractCache; если снимок запроса есть в кеше, БД не запрашивается.
+    :param partition_column: Столбец для параллельной выгрузки по диапазонам (см. extract_chunks).
+                             Части склеиваются по порядку диапазонов.
+    :param partitions: Количество диапазонов, если границы считаются по min/max.
+    :param bounds: Явные внутренние границы диапазонов.
+    :return: DataFrame с данными.
+    """
+    if cache is not None:
+        df = cache.get(query, params)
+        if df is not None:
+            return df
+
+    # Читаем данные чанками и объединяем в один DataFrame
+    if partition_column is not None and (partitions > 1 or bounds):
+        # Части забираются по мере готовности (не ожидая друг друга с занятыми соединениями)
+        # и склеиваются по порядку диапазонов
+        parts = {}
+        for part, chunk in _partitioned_chunks(query, source_conn_string, batch_size, pool_size, params, method,
+                                               partition_column, partitions, bounds, ordered=False):
+            parts.setdefault(part, []).append(chunk)
+        chunks = [chunk for part in sorted(parts) for chunk in parts[part]]
+    else:
+        chunks = list(extract_chunks(query, source_conn_string, batch_size, pool_size, params, method))
+    df = pd.concat(chunks, ignore_index=True)
+
+    if cache is not None:
+        cache.put(df, query, params)
+    return df
+
+
+def compare_extract_methods(query, source_conn_string, methods=EXTRACT_METHODS, batch_size=100000):
+    """
+    Сравнивает движки извлечения на одном запросе.
+    Для каждого движка логируются время, количество строк и объем DataFrame в памяти.
+    :return: Словарь {движок: {'seconds': ..., 'rows': ..., 'memory_mb': ...}}.
+    """
+    report = {}
+    for method in methods:
+        start = time.perf_counter()
+        df = extract_data(query, source_conn_string, batch_size, method=method)
+        elapsed = time.perf_counter() - start
+        memory_mb = df.memory_usage(deep=True).sum() / 1024 ** 2
+        report[method] = {'seconds': elapsed, 'rows': len(df), 'memory_mb': memory_mb}
+        logging.info(f"Движок '{method}': {len(df)} строк за {elapsed:.2f} с, {memory_mb:.1f} МБ.")
+        del df
+    return report
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+from datetime import date, datetime
+from sqlalchemy import text
+import pandas as pd
+import sql_scripts as sql
+
+# Файл состояния с отметками последней выгрузки (high-water mark)
+STATE_FILE = 'etl_state.json'
+
+# Настройки инкрементальной выгрузки:
+#   column    - столбец результата запроса, по которому ведется отметка;
+#   inclusive - сравнение '>=' (для дат, чтобы не потерять строки с той же датой)
+#               вместо '>' (для монотонных идентификаторов);
+#   key       - естественный ключ для слияния с предыдущей выгрузкой;
+#   changed   - текстовые столбцы дат {столбец: формат to_date}, которые заполняются позже
+#               вставки строки: строки с такой датой не раньше даты предыдущего запуска
+#               выгружаются повторно и заменяют прежние по ключу.
+# В источнике нет столбца времени изменения строки, поэтому отметка по keyid/id находит
+# только новые строки: изменения уже выгруженных визитов (amb_visit, po) не отслеживаются,
+# а у диагнозов отслеживается только заполнение дат подтверждения и снятия (confirm_dat, end_dat).
+INCREMENTAL_QUERIES = {
+    'amb_visit': {'query': sql.amb_query_get_visit, 'column': 'keyid', 'inclusive': False, 'key': 'keyid'},
+    'stac_visit': {'query': sql.stac_query_get_visit, 'column': 'dat1', 'inclusive': True, 'key': 'visitid'},
+    'diap': {'query': sql.amb_query_get_diagn_pat, 'column': 'keyid', 'inclusive': False, 'key': 'keyid',
+             'changed': {'confirm_dat': 'dd.mm.yyyy', 'end_dat': 'dd.mm.yyyy'}},
+    'po': {'query': sql.stac_query_get_PO_visit, 'column': 'id', 'inclusive': False, 'key': 'id'},
+}
+# Ключ файла состояния с датой начала последнего успешного запуска (для столбцов changed)
+LAST_RUN_KEY = 'last_run'
+
+
+def load_state(path=STATE_FILE):
+    """
+    Загружает отметки последней выгрузки из файла состояния.
+    :param path: Путь к файлу состояния.
+    :return: Словарь {имя запроса: значение отметки}.
+    """
+    if not os.path.exists(path):
+        logging.info(f"Файл состояния {path} не найден. Будет выполнена полная выгрузка.")
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_FILE):
+    """
+    Атомарно сохраняет отметки последней выгрузки в файл состояния.
+    :param state: Словарь {имя запроса: значение отметки}.
+    :param path: Путь к файлу состояния.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def build_incremental_query(query, column, watermark, inclusive=False, changed=None, changed_since=None):
+    """
+    Оборачивает запрос условием на отметку последней выгрузки.
+    :param query: Исходный SQL-запрос.
+    :param column: Столбец результата, по которому ведется отметка.
+    :param watermark: Значение отметки (None - полная выгрузка).
+    :param inclusive: Использовать '>=' вместо '>'.
+    :param changed: Текстовые столбцы дат {столбец: формат to_date}, по которым
+                    дополнительно выбираются измененные строки (см. INCREMENTAL_QUERIES).
+    :param changed_since: Дата предыдущего запуска ('YYYY-MM-DD'; None - без измененных строк).
+    :return: (запрос, параметры запроса).
+    """
+    if watermark is None:
+        return query, None
+    op = '>=' if inclusive else '>'
+    conditions = [f"q.{column} {op} :watermark"]
+    params = {'watermark': watermark}
+    if changed and changed_since is not None:
+        conditions += [f"to_date(q.{col}, '{fmt}') >= cast(:changed_since as date)" for col, fmt in changed.items()]
+        params['changed_since'] = changed_since
+    return text(f"select * from ({query}) q where {' or '.join(conditions)}"), params
+
+
+def next_watermark(df, column, watermark):
+    """
+    Вычисляет новую отметку по данным, прошедшим проверки (результат transform.process_*):
+    строка, отброшенная проверками (например, с датой в будущем), не должна сдвигать отметку.
+    Даты позже текущего момента не учитываются.
+    Если подходящих строк нет, возвращается прежняя отметка.
+    """
+    values = df[column].dropna()
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values[values <= pd.Timestamp.now()]
+    if values.empty:
+        return watermark
+    value = values.max()
+    if isinstance(value, (pd.Timestamp, datetime, date)):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
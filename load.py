@@ -1,41 +1,745 @@
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text, types
+from sqlalchemy.engine import make_url
+from pandas.io.common import infer_compression
 import logging
+import time
+import io
+import os
+import shutil
+import gzip
+import functools
+import math
+from collections import deque
+import metrics
+import parallel
 
-def load_data(df, table_name, target_conn_string, chunksize=10000, if_exists='replace'):
+# Способы загрузки в SQL Server:
+#   'to_sql' - стандартный df.to_sql;
+#   'fast'   - пакетная вставка через pyodbc fast_executemany с явными типами столбцов.
+LOAD_METHODS = ('to_sql', 'fast')
+
+# Запас длины строковых столбцов при потоковой загрузке 'fast': NVARCHAR(n) создается по первому
+# чанку с длиной max * STRING_LENGTH_HEADROOM (не больше 4000), чтобы следующие чанки поместились
+STRING_LENGTH_HEADROOM = 2
+# Наибольшая длина NVARCHAR(n) в SQL Server; длиннее - NVARCHAR(max)
+_MAX_NVARCHAR_LENGTH = 4000
+
+# Запись CSV (write_csv): количество строк в блоке, который форматирует один процесс
+CSV_BLOCK_ROWS = 100000
+# Потоковое сжатие CSV: способ -> (расширение файла, уровень сжатия)
+CSV_COMPRESSIONS = {'gzip': ('.gz', 6), 'zstd': ('.zst', 3)}
+# Единиц времени в секунде для datetime64
+_TICKS_PER_SECOND = {'s': 1, 'ms': 10 ** 3, 'us': 10 ** 6, 'ns': 10 ** 9}
+# Количество знаков дробной части секунд -> единица numpy для np.datetime_as_string
+_DATETIME_UNITS = {None: 'D', 0: 's', 3: 'ms', 6: 'us', 9: 'ns'}
+# Порядок видов по точности (только дата - грубее всего)
+_LAYOUT_PRECISION = {None: -1, 0: 0, 3: 3, 6: 6, 9: 9}
+
+
+def _target_engine(target_conn_string, method):
+    """
+    Создает подключение к целевой БД.
+    Для 'fast' и драйвера pyodbc включается fast_executemany:
+    параметры всех строк пакета передаются серверу одним массивом
+    вместо отдельного вызова на каждую строку.
+    """
+    if method not in LOAD_METHODS:
+        raise ValueError(f"Неизвестный способ загрузки: {method}")
+    url = make_url(target_conn_string)
+    if method == 'fast' and url.get_backend_name() == 'mssql' and url.get_driver_name() == 'pyodbc':
+        return create_engine(target_conn_string, fast_executemany=True)
+    return create_engine(target_conn_string)
+
+
+def sql_column_types(df, fixed_strings=True, headroom=1, lengths=None):
+    """
+    Определяет явные SQL-типы столбцов по типам DataFrame.
+    Строки загружаются как NVARCHAR (поддержка кириллицы). При fixed_strings=True
+    длина берется по максимальной длине значения в столбце: fast_executemany
+    выделяет буфер под NVARCHAR(max) на каждую строку пакета, что резко
+    увеличивает потребление памяти. При потоковой загрузке длины следующих
+    чанков неизвестны: длина по первому чанку умножается на headroom,
+    а для известных столбцов задается явно в lengths.
+    :param df: DataFrame с данными.
+    :param fixed_strings: Вычислять длину строковых столбцов по данным
+                          (False - NVARCHAR(max) для столбцов не из lengths).
+    :param headroom: Множитель длины, вычисленной по данным.
+    :param lengths: Явные длины строковых столбцов {столбец: длина} (None - NVARCHAR(max)).
+    :return: Словарь {столбец: тип SQLAlchemy} для параметра dtype в to_sql.
+    """
+    lengths = lengths or {}
+    column_types = {}
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_bool_dtype(dtype):
+            column_types[col] = types.Boolean()
+        elif pd.api.types.is_integer_dtype(dtype):
+            column_types[col] = types.BigInteger()
+        elif pd.api.types.is_float_dtype(dtype):
+            column_types[col] = types.Float(precision=53)
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            column_types[col] = types.DateTime()
+        else:
+            if col in lengths:
+                length = lengths[col]
+            else:
+                length = df[col].dropna().astype(str).str.len().max() if fixed_strings else None
+                if length is not None and length <= _MAX_NVARCHAR_LENGTH:
+                    length = min(math.ceil(length * headroom), _MAX_NVARCHAR_LENGTH)
+            if length is None or pd.isna(length) or length > _MAX_NVARCHAR_LENGTH:
+                column_types[col] = types.UnicodeText()
+            else:
+                column_types[col] = types.Unicode(length=max(int(length), 1))
+    return column_types
+
+
+def _check_string_lengths(chunk, dtype, table_name):
+    """
+    Проверяет, что строки чанка помещаются в NVARCHAR(n), заданный по первому чанку:
+    иначе SQL Server прервет загрузку ошибкой усечения строки посреди пакета.
+    """
+    for col, sql_type in (dtype or {}).items():
+        if isinstance(sql_type, types.Unicode) and sql_type.length and col in chunk:
+            longest = chunk[col].dropna().astype(str).str.len().max()
+            if longest > sql_type.length:
+                raise ValueError(f"{table_name}: значение длиной {longest} в столбце {col} не помещается "
+                                 f"в NVARCHAR({sql_type.length}); задайте длину в string_lengths.")
+
+
+def load_data(df, table_name, target_conn_string, chunksize=10000, if_exists='replace', method='to_sql',
+              key=None, delete_missing=False, string_lengths=None):
     """
     Загружает данные в SQL Server 2022.
     :param df: DataFrame с данными.
     :param table_name: Имя целевой таблицы.
     :param target_conn_string: Строка подключения к SQL Server.
     :param chunksize: Количество строк для загрузки за один запрос.
-    :param if_exists: 'replace' - перезаписать таблицу, 'append' - добавить данные.
+    :param if_exists: 'replace' - перезаписать таблицу, 'append' - добавить данные,
+                      'upsert' - обновить по ключу через промежуточную таблицу (upsert_chunks).
+    :param method: 'to_sql' - стандартная загрузка, 'fast' - fast_executemany с явными типами.
+    :param key: Естественный ключ для 'upsert' (например, 'keyid').
+    :param delete_missing: Для 'upsert': удалить строки таблицы, которых нет в df.
+    :param string_lengths: Для 'fast': явные длины строковых столбцов {столбец: длина}.
+    :return: Для 'upsert' - словарь с количеством добавленных, обновленных, неизмененных и удаленных строк.
     """
+    if if_exists == 'upsert':
+        return upsert_chunks([df], table_name, target_conn_string, key, chunksize, method, delete_missing,
+                             string_lengths)
     try:
         # Создаем подключение к SQL Server
-        engine = create_engine(target_conn_string)
+        engine = _target_engine(target_conn_string, method)
         logging.info("Подключение к SQL Server установлено.")
 
         # Загружаем данные порциями
-        df.to_sql(table_name, engine, if_exists=if_exists, index=False, chunksize=chunksize)
-        logging.info(f"Данные успешно загружены в таблицу {table_name}.")
+        start = time.perf_counter()
+        dtype = sql_column_types(df, lengths=string_lengths) if method == 'fast' else None
+        df.to_sql(table_name, engine, if_exists=if_exists, index=False, chunksize=chunksize, dtype=dtype)
+        elapsed = time.perf_counter() - start
+        logging.info(f"Данные успешно загружены в таблицу {table_name}: {len(df)} строк за {elapsed:.2f} с "
+                     f"({len(df) / max(elapsed, 1e-9):.0f} строк/с).")
+
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке данных: {e}")
+        raise
+
+
+def load_data_chunks(chunks, table_name, target_conn_string, chunksize=10000, if_exists='replace', method='to_sql',
+                     key=None, delete_missing=False, string_lengths=None):
+    """
+    Загружает поток чанков в SQL Server по мере их поступления.
+    Первый чанк загружается с if_exists, остальные дописываются в таблицу.
+    :param chunks: Итератор DataFrame-ов.
+    :param table_name: Имя целевой таблицы.
+    :param target_conn_string: Строка подключения к SQL Server.
+    :param chunksize: Количество строк для загрузки за один запрос.
+    :param if_exists: Режим для первого чанка ('replace' или 'append'); 'upsert' - все чанки
+                      загружаются в промежуточную таблицу и сливаются с целевой по ключу (upsert_chunks).
+    :param method: 'to_sql' - стандартная загрузка, 'fast' - fast_executemany с явными типами.
+    :param key: Естественный ключ для 'upsert'.
+    :param delete_missing: Для 'upsert': удалить строки таблицы, которых нет в чанках.
+    :param string_lengths: Для 'fast': явные длины строковых столбцов {столбец: длина};
+                           длины остальных - по первому чанку с запасом STRING_LENGTH_HEADROOM.
+    """
+    if if_exists == 'upsert':
+        return upsert_chunks(chunks, table_name, target_conn_string, key, chunksize, method, delete_missing,
+                             string_lengths)
+    try:
+        engine = _target_engine(target_conn_string, method)
+        logging.info("Подключение к SQL Server установлено.")
+
+        total = 0
+        dtype = None
+        start = time.perf_counter()
+        for chunk in chunks:
+            # Типы фиксируются по первому чанку, при создании таблицы
+            if method == 'fast' and dtype is None:
+                dtype = sql_column_types(chunk, headroom=STRING_LENGTH_HEADROOM, lengths=string_lengths)
+            _check_string_lengths(chunk, dtype, table_name)
+            chunk.to_sql(table_name, engine, if_exists=if_exists, index=False, chunksize=chunksize, dtype=dtype)
+            if_exists = 'append'
+            total += len(chunk)
+        elapsed = time.perf_counter() - start
+        logging.info(f"Данные успешно загружены в таблицу {table_name}: {total} строк за {elapsed:.2f} с "
+                     f"({total / max(elapsed, 1e-9):.0f} строк/с).")
 
     except Exception as e:
         logging.error(f"Ошибка при загрузке данных: {e}")
         raise
 
 
-def save_to_csv(df, file_path, index=False):
+def _changed_condition(columns, quote):
+    """
+    Условие "значение изменилось" для неключевых столбцов с учетом NULL.
+    """
+    conditions = []
+    for col in columns:
+        t, s = f"t.{quote(col)}", f"s.{quote(col)}"
+        conditions.append(f"({t} <> {s} OR ({t} IS NULL AND {s} IS NOT NULL) OR ({t} IS NOT NULL AND {s} IS NULL))")
+    return ' OR '.join(conditions)
+
+
+def _merge_mssql(conn, target, staging, columns, keys, delete_missing, quote):
+    """
+    Один MERGE в SQL Server; действия собираются через OUTPUT $action.
+    """
+    values = [col for col in columns if col not in keys]
+    on = ' AND '.join(f"t.{quote(k)} = s.{quote(k)}" for k in keys)
+    clauses = []
+    if values:
+        clauses.append(f"WHEN MATCHED AND ({_changed_condition(values, quote)}) THEN UPDATE SET "
+                       + ', '.join(f"t.{quote(col)} = s.{quote(col)}" for col in values))
+    clauses.append(f"WHEN NOT MATCHED BY TARGET THEN INSERT ({', '.join(quote(col) for col in columns)}) "
+                   f"VALUES ({', '.join(f's.{quote(col)}' for col in columns)})")
+    if delete_missing:
+        clauses.append("WHEN NOT MATCHED BY SOURCE THEN DELETE")
+    statement = (
+        "SET NOCOUNT ON;\n"
+        "DECLARE @actions TABLE (action NVARCHAR(10));\n"
+        f"MERGE {target} WITH (HOLDLOCK) AS t\nUSING {staging} AS s ON {on}\n"
+        + '\n'.join(clauses)
+        + "\nOUTPUT $action INTO @actions;\n"
+        "SELECT action, COUNT(*) FROM @actions GROUP BY action;"
+    )
+    actions = dict(conn.execute(text(statement)).fetchall())
+    return {'inserted': actions.get('INSERT', 0), 'updated': actions.get('UPDATE', 0),
+            'deleted': actions.get('DELETE', 0)}
+
+
+def _merge_generic(conn, target, staging, columns, keys, delete_missing, quote):
+    """
+    То же слияние для БД без MERGE (SQLite, PostgreSQL): UPDATE ... FROM, INSERT ... SELECT
+    и DELETE ... NOT EXISTS - тоже по множеству строк, без построчных запросов.
+    Используется для проверки загрузки на локальной БД вместо SQL Server.
+    """
+    values = [col for col in columns if col not in keys]
+    on = ' AND '.join(f"t.{quote(k)} = s.{quote(k)}" for k in keys)
+    updated = 0
+    if values:
+        updated = conn.execute(text(
+            f"UPDATE {target} AS t SET " + ', '.join(f"{quote(col)} = s.{quote(col)}" for col in values)
+            + f" FROM {staging} AS s WHERE {on} AND ({_changed_condition(values, quote)})"
+        )).rowcount
+    inserted = conn.execute(text(
+        f"INSERT INTO {target} ({', '.join(quote(col) for col in columns)}) "
+        f"SELECT {', '.join(f's.{quote(col)}' for col in columns)} FROM {staging} AS s "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {target} AS t WHERE {on})"
+    )).rowcount
+    deleted = 0
+    if delete_missing:
+        deleted = conn.execute(text(
+            f"DELETE FROM {target} WHERE NOT EXISTS (SELECT 1 FROM {staging} AS s WHERE "
+            + ' AND '.join(f"{target}.{quote(k)} = s.{quote(k)}" for k in keys) + ")"
+        )).rowcount
+    return {'inserted': inserted, 'updated': updated, 'deleted': deleted}
+
+
+def upsert_chunks(chunks, table_name, target_conn_string, key, chunksize=10000, method='to_sql', delete_missing=False,
+                  string_lengths=None):
+    """
+    Загрузка с обновлением по естественному ключу (upsert) вместо перезаписи таблицы.
+    1. Чанки пакетами загружаются в промежуточную таблицу <table_name>_staging.
+    2. Промежуточная таблица сливается с целевой одним запросом по множеству строк:
+       в SQL Server - MERGE, в других БД (SQLite, PostgreSQL) - UPDATE ... FROM и INSERT ... SELECT.
+       Обновляются только строки, в которых изменилось хотя бы одно значение.
+    3. При delete_missing удаляются строки целевой таблицы, ключей которых нет в загрузке
+       (только для полной выгрузки таблицы, не для инкрементальной).
+    Если целевой таблицы нет, она создается по структуре первого чанка.
+    Повторы ключа внутри чанка схлопываются (остается последняя строка); повтор ключа
+    в разных чанках - ошибка, так как MERGE не может обновить строку дважды.
+    :param chunks: Итератор DataFrame-ов (или список из одного DataFrame).
+    :param table_name: Имя целевой таблицы.
+    :param target_conn_string: Строка подключения к SQL Server (или к локальной БД для проверки).
+    :param key: Столбец или список столбцов естественного ключа (keyid, visitid, id).
+    :param chunksize: Количество строк для загрузки за один запрос.
+    :param method: 'to_sql' - стандартная загрузка, 'fast' - fast_executemany с явными типами.
+    :param delete_missing: Удалить строки, которых нет в загрузке.
+    :param string_lengths: Для 'fast': явные длины строковых столбцов {столбец: длина};
+                           длины остальных - по первому чанку с запасом STRING_LENGTH_HEADROOM.
+    :return: Словарь {'inserted', 'updated', 'unchanged', 'deleted'}.
+    """
+    if key is None:
+        raise ValueError("Для загрузки в режиме upsert нужен ключ (key).")
+    keys = [key] if isinstance(key, str) else list(key)
+    staging_name = f"{table_name}_staging"
+    try:
+        engine = _target_engine(target_conn_string, method)
+        quote = engine.dialect.identifier_preparer.quote
+        target, staging = quote(table_name), quote(staging_name)
+
+        start = time.perf_counter()
+        staged = 0
+        columns = None
+        dtype = None
+        try:
+            for chunk in chunks:
+                duplicated = chunk.duplicated(keys, keep='last')
+                if duplicated.any():
+                    logging.warning(f"{table_name}: {duplicated.sum()} повторов ключа {keys} в чанке, "
+                                    f"загружается последняя строка.")
+                    chunk = chunk[~duplicated]
+                if columns is None:
+                    columns = list(chunk.columns)
+                    if method == 'fast':
+                        dtype = sql_column_types(chunk, headroom=STRING_LENGTH_HEADROOM, lengths=string_lengths)
+                    if not inspect(engine).has_table(table_name):
+                        chunk.head(0).to_sql(table_name, engine, index=False, dtype=dtype)
+                        logging.info(f"Таблица {table_name} создана.")
+                _check_string_lengths(chunk, dtype, table_name)
+                chunk.to_sql(staging_name, engine, if_exists='replace' if staged == 0 else 'append',
+                             index=False, chunksize=chunksize, dtype=dtype)
+                staged += len(chunk)
+            if columns is None:
+                logging.info(f"{table_name}: нет строк для загрузки.")
+                return {'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+            staged_seconds = time.perf_counter() - start
+
+            with engine.begin() as conn:
+                key_list = ', '.join(quote(k) for k in keys)
+                repeated = conn.execute(text(
+                    f"SELECT COUNT(*) FROM (SELECT {key_list} FROM {staging} GROUP BY {key_list} "
+                    f"HAVING COUNT(*) > 1) d"
+                )).scalar()
+                if repeated:
+                    raise ValueError(f"{table_name}: {repeated} ключей {keys} повторяются в разных чанках.")
+                merge = _merge_mssql if engine.dialect.name == 'mssql' else _merge_generic
+                counts = merge(conn, target, staging, columns, keys, delete_missing, quote)
+        finally:
+            # Промежуточная таблица удаляется и при ошибке (повтор ключа, сбой загрузки чанка)
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+        counts['unchanged'] = staged - counts['inserted'] - counts['updated']
+
+        elapsed = time.perf_counter() - start
+        for name in ('inserted', 'updated', 'unchanged', 'deleted'):
+            metrics.record(name, counts[name])
+        logging.info(f"Таблица {table_name} обновлена по ключу {keys} за {elapsed:.2f} с "
+                     f"(промежуточная таблица: {staged} строк за {staged_seconds:.2f} с): "
+                     f"добавлено {counts['inserted']}, обновлено {counts['updated']}, "
+                     f"без изменений {counts['unchanged']}, удалено {counts['deleted']}.")
+        return {name: counts[name] for name in ('inserted', 'updated', 'unchanged', 'deleted')}
+
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке данных в режиме upsert: {e}")
+        raise
+
+
+def _datetime_layout(values):
+    """
+    Вид, в котором to_csv пишет столбец datetime64 без часового пояса. pandas выбирает
+    его по всему столбцу: только дата (None), если все значения - полночь, иначе дата
+    и время с количеством знаков дробной части секунд (0, 3, 6 или 9), нужным самому
+    точному значению. Столбец без значений - 'empty' (пишется пустыми полями при любом виде).
+    """
+    ticks = values.to_numpy().view('i8')[values.notna().to_numpy()]
+    if not len(ticks):
+        return 'empty'
+    per_second = _TICKS_PER_SECOND[np.datetime_data(values.dtype)[0]]
+    if not (ticks % (86400 * per_second)).any():
+        return None
+    fraction = ticks % per_second
+    for digits in (0, 3, 6, 9):
+        if not (fraction % (per_second // 10 ** digits)).any():
+            return digits
+
+
+def _is_datetime_like(dtype):
+    return pd.api.types.is_datetime64_any_dtype(dtype) or pd.api.types.is_timedelta64_dtype(dtype) or \
+        isinstance(dtype, pd.PeriodDtype)
+
+
+def _csv_layouts(df, index):
+    """
+    Виды столбцов datetime64 всей таблицы (см. _datetime_layout), чтобы блоки писались так же,
+    как таблица целиком. None, если таблицу нельзя писать блоками: вид других столбцов
+    (с часовым поясом, timedelta, period, категории дат) тоже зависит от всего столбца.
+    """
+    if not df.columns.is_unique or (index and _is_datetime_like(df.index.dtype)):
+        return None
+    layouts = {}
+    for col, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            if _is_datetime_like(dtype.categories.dtype):
+                return None
+        elif pd.api.types.is_datetime64_dtype(dtype):
+            layouts[col] = _datetime_layout(df[col])
+        elif _is_datetime_like(dtype):
+            return None
+    return layouts
+
+
+def _apply_layouts(block, layouts):
+    """
+    Столбцы datetime64, которые в блоке записались бы в другом виде, чем задано
+    в layouts, заменяются текстом в этом виде. Вид не должен быть грубее
+    собственного вида блока (иначе время будет отброшено).
+    """
+    converted = {}
+    for col, layout in layouts.items():
+        if layout == 'empty' or _datetime_layout(block[col]) in ('empty', layout):
+            continue
+        values = block[col]
+        text = np.datetime_as_string(values.to_numpy(), unit=_DATETIME_UNITS[layout])
+        converted[col] = pd.Series(np.char.replace(text, 'T', ' '), index=block.index).where(values.notna())
+    if converted:
+        block = block.copy(deep=False)
+        for col, text in converted.items():
+            block[col] = text
+    return block
+
+
+def _format_block(block, index, layouts, compression, level):
+    """
+    Форматирует блок строк в байты CSV (без заголовка) - в процессе пула.
+    Столбцы datetime64, которые в блоке записались бы в другом виде, чем во всей
+    таблице, форматируются явно. При сжатии gzip блок сжимается здесь же
+    отдельным членом gzip: последовательность членов - корректный файл gzip.
+    """
+    block = _apply_layouts(block, layouts)
+    data = block.to_csv(None, index=index, header=False).encode('utf-8')
+    if compression == 'gzip':
+        data = gzip.compress(data, compresslevel=level, mtime=0)
+    return data
+
+
+def _csv_blocks(df, index, layouts, compression, level, workers, block_rows):
+    """
+    Байты CSV по блокам строк в исходном порядке. Блоки форматируются в пуле
+    процессов (parallel.get_pool), не больше 2 * workers блоков одновременно.
+    Таблица, которую нельзя писать блоками (layouts=None), форматируется целиком.
+    """
+    if layouts is None:
+        yield _format_block(df, index, {}, compression, level)
+        return
+    bounds = range(0, len(df), block_rows)
+    if workers < 2 or len(df) < 2 * block_rows:
+        for start in bounds:
+            yield _format_block(df.iloc[start:start + block_rows], index, layouts, compression, level)
+        return
+    pool = parallel.get_pool(workers)
+    pending = deque()
+    for start in bounds:
+        pending.append(pool.submit(_format_block, df.iloc[start:start + block_rows], index, layouts,
+                                   compression, level))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _open_csv(file_path, mode, compression, level, workers):
+    """
+    Открывает файл для записи байтов CSV. Для zstd - потоковый компрессор
+    (zstandard), который сжимает в workers потоках.
+    """
+    if compression == 'zstd':
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=level, threads=workers if workers > 1 else 0)
+        return compressor.stream_writer(open(file_path, mode + 'b'))
+    return open(file_path, mode + 'b')
+
+
+def _write_csv_frame(f, df, index, header, bom, compression, level, workers, block_rows):
+    """
+    Пишет таблицу в открытый файл (_open_csv): BOM, заголовок и блоки строк.
+    """
+    head = df.head(0).to_csv(None, index=index).encode('utf-8') if header else b''
+    if bom:
+        head = '\ufeff'.encode('utf-8') + head
+    if head:
+        f.write(gzip.compress(head, compresslevel=level, mtime=0) if compression == 'gzip' else head)
+    for data in _csv_blocks(df, index, _csv_layouts(df, index), compression, level, workers, block_rows):
+        f.write(data)
+
+
+def csv_path(file_path, compression):
+    """
+    Путь к CSV-файлу с расширением сжатия (например, 'AMB visit.csv.gz').
+    """
+    if compression in CSV_COMPRESSIONS:
+        return file_path + CSV_COMPRESSIONS[compression][0]
+    return file_path
+
+
+def _csv_compression(file_path, compression):
+    """
+    Способ сжатия для write_csv: 'infer' определяется по расширению файла, как в pandas.
+    """
+    if compression == 'infer':
+        return infer_compression(str(file_path), 'infer')
+    return compression
+
+
+def write_csv(df, file_path, index=False, mode='w', header=None, compression='infer', workers=0,
+              block_rows=CSV_BLOCK_ROWS):
+    """
+    Записывает DataFrame в CSV в кодировке utf-8-sig (BOM для корректной кириллицы в Excel).
+    Без сжатия результат побайтно совпадает с df.to_csv(..., encoding='utf-8-sig'):
+    при workers >= 2 блоки по block_rows строк форматируются параллельно в пуле
+    процессов и пишутся в исходном порядке. Сжатие gzip выполняется по блокам в тех же
+    процессах, zstd - потоковым компрессором в workers потоках.
+    :param df: DataFrame с данными.
+    :param file_path: Путь к файлу.
+    :param index: Сохранять ли индекс.
+    :param mode: 'w' - перезаписать файл, 'a' - дописать строки.
+    :param header: Писать ли заголовок (по умолчанию - только при mode='w').
+    :param compression: None, 'gzip', 'zstd' или 'infer' (по расширению .gz/.zst);
+                        другие способы pandas (bz2, xz, zip) - без распараллеливания.
+    :param workers: Количество процессов форматирования (0 - один вызов to_csv).
+    :param block_rows: Количество строк в блоке.
+    """
+    header = (mode == 'w') if header is None else header
+    compression = _csv_compression(file_path, compression)
+    if compression not in CSV_COMPRESSIONS and (compression is not None or workers < 2 or
+                                                len(df) < 2 * block_rows or _csv_layouts(df, index) is None):
+        df.to_csv(file_path, index=index, mode=mode, header=header, encoding='utf-8-sig',
+                  compression=compression)  # encoding для поддержки кириллицы
+        return
+
+    # BOM пишется в начало файла, но не при дописывании в непустой файл
+    bom = mode == 'w' or not os.path.exists(file_path) or os.path.getsize(file_path) == 0
+    level = CSV_COMPRESSIONS[compression][1] if compression in CSV_COMPRESSIONS else None
+    with _open_csv(file_path, mode, compression, level, workers) as f:
+        _write_csv_frame(f, df, index, header, bom, compression, level, workers, block_rows)
+
+
+def save_to_csv(df, file_path, index=False, mode='w', compression='infer', workers=0):
     """
     Сохраняет DataFrame в CSV-файл.
     :param df: DataFrame с данными.
     :param file_path: Путь к файлу (например, 'output.csv').
     :param index: Сохранять ли индекс (по умолчанию False).
+    :param mode: 'w' - перезаписать файл, 'a' - дописать строки без заголовка.
+    :param compression: Сжатие (см. write_csv; по умолчанию - по расширению файла).
+    :param workers: Количество процессов форматирования (см. write_csv).
     """
     try:
         # Сохранение данных в CSV
-        df.to_csv(file_path, index=index, encoding='utf-8-sig')  # encoding для поддержки кириллицы
+        write_csv(df, file_path, index=index, mode=mode, compression=compression, workers=workers)
         print(f"Данные успешно сохранены в файл: {file_path}")
     except Exception as e:
         print(f"Ошибка при сохранении данных в CSV: {e}")
         raise
+
+
+def _pin_layouts(chunk, layouts, file_path):
+    """
+    Закрепляет вид столбцов datetime64 для всего потока чанков: вид берется по первому
+    чанку, в котором у столбца есть значения, и передается следующим чанкам, чтобы
+    формат дат не менялся посреди файла. Если чанку нужен более точный вид (время
+    после чанка только с датами, больше знаков дробной части секунд), вид расширяется
+    с этого чанка: время не отбрасывается.
+    :param layouts: Закрепленные виды {столбец: вид}; дополняется на месте.
+    :return: Чанк с датами, отформатированными в закрепленном виде.
+    """
+    if not chunk.columns.is_unique:
+        return chunk
+    for col, dtype in chunk.dtypes.items():
+        if not pd.api.types.is_datetime64_dtype(dtype):
+            continue
+        layout = _datetime_layout(chunk[col])
+        if layout == 'empty':
+            continue
+        if col not in layouts:
+            layouts[col] = layout
+        elif _LAYOUT_PRECISION[layout] > _LAYOUT_PRECISION[layouts[col]]:
+            logging.warning(f"{file_path}: в столбце {col} значения точнее, чем в первом чанке; "
+                            f"вид дат расширен с этого чанка.")
+            layouts[col] = layout
+    return _apply_layouts(chunk, {col: layout for col, layout in layouts.items()
+                                  if col in chunk and pd.api.types.is_datetime64_dtype(chunk[col].dtype)})
+
+
+def save_chunks_to_csv(chunks, file_path, index=False, compression='infer', workers=0):
+    """
+    Сохраняет поток чанков в один CSV-файл по мере их поступления.
+    Заголовок пишется только для первого чанка.
+    Вид столбцов с датами закрепляется по первому чанку (_pin_layouts), как у
+    таблицы, записанной целиком.
+    При сжатии файл открывается один раз и все чанки пишутся в один поток.
+    :param chunks: Итератор DataFrame-ов.
+    :param file_path: Путь к файлу (например, 'output.csv').
+    :param index: Сохранять ли индекс (по умолчанию False).
+    :param compression: Сжатие (см. write_csv; по умолчанию - по расширению файла).
+    :param workers: Количество процессов форматирования (см. write_csv).
+    :return: Количество записанных строк.
+    """
+    try:
+        compression = _csv_compression(file_path, compression)
+        total = 0
+        layouts = {}
+        chunks = (_pin_layouts(chunk, layouts, file_path) for chunk in chunks)
+        if compression not in CSV_COMPRESSIONS:
+            mode = 'w'
+            for chunk in chunks:
+                write_csv(chunk, file_path, index=index, mode=mode, compression=compression, workers=workers)
+                mode = 'a'
+                total += len(chunk)
+        else:
+            level = CSV_COMPRESSIONS[compression][1]
+            f = None
+            try:
+                for chunk in chunks:
+                    first = f is None
+                    if first:
+                        f = _open_csv(file_path, 'w', compression, level, workers)
+                    _write_csv_frame(f, chunk, index, first, first, compression, level, workers, CSV_BLOCK_ROWS)
+                    total += len(chunk)
+            finally:
+                if f is not None:
+                    f.close()
+        print(f"Данные успешно сохранены в файл: {file_path} ({total} строк)")
+        return total
+    except Exception as e:
+        print(f"Ошибка при сохранении данных в CSV: {e}")
+        raise
+
+
+def merge_into_csv(df, file_path, key, index=False):
+    """
+    Сливает новые строки с ранее сохраненным CSV-файлом (инкрементальная выгрузка).
+    Строки с уже существующим ключом заменяются новыми, остальные дописываются.
+    Если пересечений по ключу нет, новые строки просто дописываются в конец файла,
+    и объем работы зависит только от количества новых строк.
+    :param df: DataFrame с новыми строками.
+    :param file_path: Путь к файлу (например, 'output.csv').
+    :param key: Столбец естественного ключа.
+    :param index: Сохранять ли индекс (по умолчанию False).
+    """
+    try:
+        if not os.path.exists(file_path):
+            save_to_csv(df, file_path, index=index)
+            return
+
+        # Приводим новые строки к тому же текстовому виду, в котором они были бы записаны в CSV
+        df_new = pd.read_csv(io.StringIO(df.to_csv(index=index)), dtype=str, keep_default_na=False)
+        columns = pd.read_csv(file_path, nrows=0, encoding='utf-8-sig').columns
+        previous_keys = pd.read_csv(file_path, usecols=[key], dtype=str, keep_default_na=False, encoding='utf-8-sig')[key]
+        df_new = df_new[columns]
+
+        updated = df_new[key].isin(previous_keys)
+        if not updated.any():
+            df_new.to_csv(file_path, index=False, mode='a', header=False, encoding='utf-8-sig')
+        else:
+            df_prev = pd.read_csv(file_path, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+            df_prev = df_prev[~df_prev[key].isin(df_new[key])]
+            pd.concat([df_prev, df_new], ignore_index=True).to_csv(file_path, index=False, encoding='utf-8-sig')
+        print(f"Данные успешно объединены с файлом: {file_path} "
+              f"(новых строк: {len(df_new) - updated.sum()}, обновлено: {updated.sum()})")
+    except Exception as e:
+        print(f"Ошибка при объединении данных с CSV: {e}")
+        raise
+
+
+# Слой записи файлов: формат -> (расширение, функция записи, сжатие по умолчанию).
+# Parquet и Feather требуют установленного pyarrow.
+def _write_csv(df, path, compression, workers=0):
+    write_csv(df, path, compression=compression, workers=workers)
+
+
+def _write_parquet(df, path, compression):
+    df.to_parquet(path, index=False, compression=compression)
+
+
+def _write_feather(df, path, compression):
+    # Feather требует RangeIndex, начинающийся с нуля
+    df.reset_index(drop=True).to_feather(path, compression=compression or 'uncompressed')
+
+
+WRITERS = {
+    'csv': ('csv', _write_csv, None),
+    'parquet': ('parquet', _write_parquet, 'zstd'),
+    'feather': ('feather', _write_feather, 'zstd'),
+}
+
+
+def _path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+
+def save_table(df, base_path, fmt='csv', compression='default', partition_by_year=None, workers=0):
+    """
+    Сохраняет DataFrame в выбранном формате.
+    Parquet и Feather сохраняют типы, выставленные преобразованиями
+    (Int64, datetime64), поэтому повторный разбор дат при чтении не нужен.
+    При partition_by_year файл разбивается по году указанного столбца с датой:
+    <base_path>.<fmt>/year=<год>/part.<fmt> (year=unknown для пустых дат).
+    :param df: DataFrame с данными.
+    :param base_path: Путь без расширения (например, 'AMB visit').
+    :param fmt: 'csv', 'parquet' или 'feather'.
+    :param compression: Сжатие ('default' - по умолчанию для формата, None - без сжатия).
+    :param partition_by_year: Столбец с датой для разбиения по годам (например, 'dat').
+    :param workers: Количество процессов форматирования CSV (см. write_csv).
+    :return: Словарь с форматом, путем, временем записи (с) и размером (байт).
+    """
+    try:
+        if fmt not in WRITERS:
+            raise ValueError(f"Неизвестный формат: {fmt}")
+        extension, writer, default_compression = WRITERS[fmt]
+        if compression == 'default':
+            compression = default_compression
+        path = f"{base_path}.{extension}"
+        part_name = f"part.{extension}"
+        if fmt == 'csv':
+            # Сжатый CSV: 'AMB visit.csv.gz', 'AMB visit.csv.zst'
+            if partition_by_year is None:
+                path = csv_path(path, compression)
+            part_name = csv_path(part_name, compression)
+            writer = functools.partial(writer, workers=workers)
+
+        start = time.perf_counter()
+        if partition_by_year is None:
+            writer(df, path, compression)
+        else:
+            # Удаляем разделы предыдущего запуска, чтобы не смешивать данные
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            years = df[partition_by_year].dt.year
+            for year, part in df.groupby(years.fillna(-1).astype(int), sort=True):
+                part_dir = os.path.join(path, f"year={'unknown' if year == -1 else year}")
+                os.makedirs(part_dir, exist_ok=True)
+                writer(part, os.path.join(part_dir, part_name), compression)
+        elapsed = time.perf_counter() - start
+
+        size = _path_size(path)
+        print(f"Данные успешно сохранены: {path} ({fmt}, сжатие: {compression}) "
+              f"за {elapsed:.2f} с, {size / 1024 ** 2:.1f} МБ")
+        return {'format': fmt, 'path': path, 'compression': compression, 'seconds': elapsed, 'bytes': size}
+    except Exception as e:
+        print(f"Ошибка при сохранении данных ({fmt}): {e}")
+        raise
+
+
+def compare_formats(df, base_path, formats=('csv', 'parquet', 'feather'), partition_by_year=None):
+    """
+    Сохраняет таблицу во всех указанных форматах и печатает время записи и размер,
+    чтобы выбрать формат для каждой таблицы.
+    :return: Список отчетов save_table.
+    """
+    reports = [save_table(df, base_path, fmt, partition_by_year=partition_by_year) for fmt in formats]
+    for report in reports:
+        print(f"{report['format']:>8}: {report['seconds']:8.2f} с, {report['bytes'] / 1024 ** 2:10.1f} МБ")
+    return reports
\ No newline at end of file
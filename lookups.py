@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+import pandas as pd
+from extract import extract_data
+from cache import ExtractCache, CACHE_DIR
+import sql_scripts as sql
+
+# Время, после которого справочник выгружается заново (с)
+LOOKUP_TTL_SECONDS = 6 * 3600
+
+# Общие кеши справочников: один на строку подключения
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class DimensionCache:
+    """
+    Кеш справочников (lu, dep, agr) для подстановки текстов в таблицы фактов.
+    Справочник выгружается один раз и хранится как Series keyid -> text;
+    подстановка выполняется векторно (Series.map) вместо коррелированного
+    подзапроса на каждую строку в PostgreSQL.
+    Справочники живут в памяти процесса и, если задан каталог, в ExtractCache
+    на диске, поэтому повторные запуски не обращаются к БД, пока снимок не
+    старше ttl_seconds. Устаревший справочник выгружается заново.
+    Дисковый кеш требует установленного pyarrow (directory=None - только в памяти).
+    """
+
+    def __init__(self, source_conn_string, ttl_seconds=LOOKUP_TTL_SECONDS, directory=CACHE_DIR, queries=None,
+                 pool_size=5):
+        self.source_conn_string = source_conn_string
+        self.pool_size = pool_size
+        self.ttl_seconds = ttl_seconds
+        self.queries = queries or sql.dimension_queries
+        self.disk = ExtractCache(directory, ttl_seconds=ttl_seconds) if directory is not None else None
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Возвращает справочник name как Series (индекс - keyid, значения - text).
+        """
+        with self._lock:
+            loaded = self._tables.get(name)
+            if loaded is not None and time.time() - loaded[0] <= self.ttl_seconds:
+                return loaded[1]
+            try:
+                df = extract_data(self.queries[name], self.source_conn_string, pool_size=self.pool_size,
+                                  cache=self.disk)
+                # keyid - ключ справочника; возможные дубли отбрасываются, чтобы map был однозначным
+                table = pd.Series(df.iloc[:, 1].to_numpy(), index=df.iloc[:, 0].to_numpy())
+                table = table[~table.index.duplicated(keep='first')]
+            except Exception as e:
+                logging.error(f"Ошибка при загрузке справочника '{name}': {e}")
+                raise
+            self._tables[name] = (time.time(), table)
+            logging.info(f"Справочник '{name}' загружен: {len(table)} значений.")
+            return table
+
+    def refresh(self, name=None):
+        """
+        Сбрасывает справочник (или все справочники) в памяти и на диске.
+        """
+        with self._lock:
+            names = [name] if name is not None else list(self.queries)
+            for item in names:
+                self._tables.pop(item, None)
+                if self.disk is not None:
+                    self.disk.invalidate(self.queries[item])
+
+    def resolve(self, df, columns):
+        """
+        Заменяет столбцы с идентификаторами на тексты из справочников.
+        Столбец с текстом встает на место столбца с идентификатором; идентификаторы
+        без значения в справочнике дают пустое значение (как подзапрос без строк).
+        :param df: DataFrame, извлеченный запросом режима справочников.
+        :param columns: [(столбец с идентификатором, справочник, имя столбца с текстом), ...].
+        :return: DataFrame с текстами.
+        """
+        names = list(df.columns)
+        for id_column, dimension, text_column in columns:
+            position = names.index(id_column)
+            df.isetitem(position, df.iloc[:, position].map(self.get(dimension)))
+            names[position] = text_column
+        df.columns = names
+        return df
+
+
+def get_dimension_cache(source_conn_string, pool_size=5):
+    """
+    Возвращает общий для процесса DimensionCache для строки подключения,
+    чтобы повторные запуски ETL в одном процессе не выгружали справочники заново.
+    :param pool_size: Размер общего пула соединений (extract.get_engine), в котором выгружаются справочники.
+    """
+    with _caches_lock:
+        dimensions = _caches.get(source_conn_string)
+        if dimensions is None:
+            dimensions = DimensionCache(source_conn_string, pool_size=pool_size)
+            _caches[source_conn_string] = dimensions
+        return dimensions
+
+
+def join_bulk(df, bulk, key):
+    """
+    Присоединяет результат пакетного запроса к таблице по ключу.
+    Первый столбец bulk - ключ, остальные - значения: столбец с именем,
+    уже существующим в df, заменяется на месте, новый добавляется в конец.
+    Строки без пары получают пустые значения (как функция, вернувшая NULL).
+    :param df: Основная таблица.
+    :param bulk: DataFrame пакетного запроса.
+    :param key: Столбец df со значением ключа.
+    :return: DataFrame с присоединенными значениями.
+    """
+    values = bulk.drop_duplicates(bulk.columns[0]).set_index(bulk.columns[0])
+    keys = df[key]
+    names = list(df.columns)
+    for col in values.columns:
+        mapped = keys.map(values[col])
+        if col in names:
+            df.isetitem(names.index(col), mapped)
+        else:
+            df[col] = mapped
+    return df
+
+
+def extract_bulk(name, source_conn_string, cache=None, pool_size=5):
+    """
+    Извлекает таблицу в пакетном режиме (sql_scripts.bulk_queries): основной
+    запрос и пакетные запросы, затем соединяет их в pandas.
+    :param pool_size: Размер общего пула соединений (extract.get_engine).
+    """
+    main_query, parts = sql.bulk_queries[name]
+    df = extract_data(main_query, source_conn_string, pool_size=pool_size, cache=cache)
+    for query, key in parts:
+        df = join_bulk(df, extract_data(query, source_conn_string, pool_size=pool_size, cache=cache), key)
+    return df
+
+
+def compare_bulk_extract(name, query, source_conn_string, pool_size=5):
+    """
+    Сравнивает исходный запрос (функции на каждую строку) с пакетным режимом.
+    :param name: Имя таблицы в sql_scripts.bulk_queries (например, 'diap').
+    :param query: Исходный запрос (например, sql_scripts.amb_query_get_diagn_pat).
+    :param pool_size: Размер общего пула соединений (extract.get_engine).
+    :return: Словарь {'row_calls': секунды, 'bulk': секунды, 'equal': совпадают ли результаты}.
+    """
+    start = time.perf_counter()
+    expected = extract_data(query, source_conn_string, pool_size=pool_size)
+    row_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = extract_bulk(name, source_conn_string, pool_size=pool_size)
+    bulk_seconds = time.perf_counter() - start
+
+    equal = expected.astype(str).equals(actual.astype(str))
+    logging.info(f"'{name}': функции на каждую строку {row_seconds:.2f} с, пакетный режим {bulk_seconds:.2f} с, "
+                 f"результаты {'совпадают' if equal else 'различаются'}.")
+    return {'row_calls': row_seconds, 'bulk': bulk_seconds, 'equal': equal}
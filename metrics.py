@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+
+# Текущий шаг для каждого потока: сюда transform.py сообщает об удаленных строках
+_local = threading.local()
+
+# Интервал (с), с которым фоновый поток читает RSS процесса, пока выполняются шаги
+RSS_SAMPLE_SECONDS = 0.01
+
+
+def _current_rss_mb():
+    """
+    Текущее RSS процесса в МБ (/proc/self/statm). Если оно недоступно
+    (не Linux) - пиковое RSS процесса.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError):
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb():
+    """
+    Пиковое RSS процесса в МБ: VmHWM из /proc/self/status, иначе ru_maxrss.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def record_drop(rule, count):
+    """
+    Учитывает строки, удаленные правилом очистки, в текущем шаге потока.
+    Вне шага (отчет не ведется) вызов ничего не делает.
+    :param rule: Код правила (например, 'future_dates').
+    :param count: Количество удаленных строк.
+    """
+    step = getattr(_local, 'step', None)
+    if step is not None and count:
+        step['dropped'][rule] = step['dropped'].get(rule, 0) + int(count)
+
+
+def record(name, value):
+    """
+    Добавляет произвольное значение в запись текущего шага потока
+    (например, объем памяти до и после оптимизации типов).
+    """
+    step = getattr(_local, 'step', None)
+    if step is not None:
+        step[name] = value
+
+
+class _RssSampler:
+    """
+    Фоновый поток, который, пока выполняется хотя бы один шаг, раз в RSS_SAMPLE_SECONDS
+    читает RSS процесса и обновляет максимум в записи каждого выполняемого шага.
+    Счетчики ядра не сбрасываются, поэтому параллельные шаги не искажают замеры друг друга.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_SECONDS):
+        self.interval = interval
+        self._records = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, record):
+        record['peak_rss_mb'] = _current_rss_mb()
+        with self._lock:
+            self._records[id(record)] = record
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+                self._thread.start()
+
+    def stop(self, record):
+        rss = _current_rss_mb()
+        with self._lock:
+            self._records.pop(id(record), None)
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], rss)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            rss = _current_rss_mb()
+            with self._lock:
+                if not self._records:
+                    self._thread = None
+                    return
+                for record in self._records.values():
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'], rss)
+
+
+_sampler = _RssSampler()
+
+
+def _rows(value):
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    return None
+
+
+class RunReport:
+    """
+    Отчет о запуске ETL: время, строки на входе и выходе и строки, удаленные
+    каждым правилом, для каждого шага извлечения, преобразования и записи.
+    Накладные расходы - несколько системных вызовов на шаг и одно чтение
+    /proc за интервал RSS_SAMPLE_SECONDS, поэтому отчет можно оставлять
+    включенным в продуктиве.
+    Память не делится между шагами: peak_rss_mb шага - наибольшее RSS всего
+    процесса за время шага (по выборкам), и оно включает память шагов,
+    выполнявшихся одновременно. Пик за весь запуск - peak_rss_mb отчета.
+    """
+
+    def __init__(self, name='etl'):
+        self.name = name
+        self.started = datetime.now()
+        self.steps = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def step(self, name, kind, rows_in=None):
+        """
+        Замеряет шаг. Внутри блока можно дополнить запись (например, rows_out).
+        :param name: Имя шага (например, 'process_visits_data').
+        :param kind: 'extract', 'transform' или 'load'.
+        :param rows_in: Количество строк на входе.
+        """
+        record = {'name': name, 'kind': kind, 'status': 'ok', 'seconds': None,
+                  'rows_in': rows_in, 'rows_out': None, 'dropped': {}, 'peak_rss_mb': None}
+        previous = getattr(_local, 'step', None)
+        _local.step = record
+        _sampler.start(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = str(e)
+            raise
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 3)
+            _sampler.stop(record)
+            record['peak_rss_mb'] = round(record['peak_rss_mb'], 1)
+            _local.step = previous
+            with self._lock:
+                self.steps.append(record)
+
+    def track(self, name, kind, func, *args, **kwargs):
+        """
+        Вызывает func(*args, **kwargs) как отдельный шаг.
+        Строки на входе берутся из первого аргумента-DataFrame, на выходе - из результата.
+        """
+        rows_in = next((_rows(arg) for arg in args if isinstance(arg, pd.DataFrame)), None)
+        with self.step(name, kind, rows_in) as record:
+            result = func(*args, **kwargs)
+            record['rows_out'] = _rows(result)
+        return result
+
+    def peak_rss_mb(self):
+        """
+        Пик RSS процесса за запуск: VmHWM (ru_maxrss), но не меньше пиков шагов -
+        они получены выборками statm и округлены отдельно.
+        """
+        with self._lock:
+            peaks = [step['peak_rss_mb'] for step in self.steps]
+        return round(max(_peak_rss_mb(), *peaks), 1)
+
+    def to_dict(self):
+        finished = datetime.now()
+        return {
+            'name': self.name,
+            'started': self.started.isoformat(timespec='seconds'),
+            'finished': finished.isoformat(timespec='seconds'),
+            'total_seconds': round((finished - self.started).total_seconds(), 3),
+            'peak_rss_mb': self.peak_rss_mb(),
+            'steps': self.steps,
+        }
+
+    def summary(self):
+        """
+        Текстовая сводка по шагам.
+        """
+        lines = [f"{'шаг':<32} {'тип':<10} {'время, с':>10} {'вход':>12} {'выход':>12} {'RSS, МБ':>10}  удалено"]
+        for step in self.steps:
+            dropped = ', '.join(f"{rule}={count}" for rule, count in step['dropped'].items())
+            lines.append(
+                f"{step['name']:<32} {step['kind']:<10} {step['seconds']:>10.2f} "
+                f"{'' if step['rows_in'] is None else step['rows_in']:>12} "
+                f"{'' if step['rows_out'] is None else step['rows_out']:>12} "
+                f"{step['peak_rss_mb']:>10.1f}  {dropped}"
+                + ('' if step['status'] == 'ok' else '  [ОШИБКА]')
+            )
+        lines.append(f"RSS, МБ - наибольшее RSS процесса за время шага, включая одновременные шаги; "
+                     f"пик процесса за запуск: {self.peak_rss_mb():.1f} МБ")
+        return '\n'.join(lines)
+
+    def write(self, json_path, text_path=None):
+        """
+        Сохраняет отчет в JSON и, при необходимости, текстовую сводку.
+        """
+        try:
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2, default=str)
+            if text_path is not None:
+                with open(text_path, 'w', encoding='utf-8') as f:
+                    f.write(self.summary() + '\n')
+            logging.info(f"Отчет о запуске сохранен в {json_path}.")
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении отчета о запуске: {e}")
+            raise
@@ -0,0 +1,176 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import dedup
+import metrics
+import quarantine
+import transform as tr
+import validation as val
+
+# Таблицы меньше этого размера обрабатываются в текущем процессе:
+# передача шардов в процессы дороже самой обработки
+MIN_PARALLEL_ROWS = 200000
+
+# Общие пулы процессов: один на количество процессов
+_pools = {}
+_pools_lock = threading.Lock()
+# Индексы пациентов, подключенные в процессе-исполнителе: имя блока памяти -> (блок, индекс)
+_attached = {}
+
+
+def get_pool(workers):
+    """
+    Возвращает общий пул процессов. Процессы запускаются через spawn: основной
+    процесс многопоточный (граф задач), и fork в нем небезопасен.
+    """
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pools[workers] = pool
+        return pool
+
+
+class SharedPatientIndex:
+    """
+    Ключи PatientIndex в разделяемой памяти. Процессы-исполнители подключают
+    блок по имени и проверяют ссылки по тому же массиву, без копии индекса
+    в каждом процессе. Используйте как контекстный менеджер: по выходу блок удаляется.
+    """
+
+    def __init__(self, patient_index):
+        keys = patient_index.keys
+        self._shm = shared_memory.SharedMemory(create=True, size=max(keys.nbytes, 1))
+        np.ndarray(keys.shape, dtype=keys.dtype, buffer=self._shm.buf)[:] = keys
+        self.handle = (self._shm.name, len(keys), keys.dtype.str, patient_index.method)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _attach(handle):
+    """
+    Подключает индекс пациентов из разделяемой памяти (один раз на процесс).
+    """
+    name, size, dtype, method = handle
+    attached = _attached.get(name)
+    if attached is None:
+        # Исполнители пула используют resource_tracker основного процесса,
+        # поэтому блок удаляется один раз - основным процессом (SharedPatientIndex.close)
+        shm = shared_memory.SharedMemory(name=name)
+        keys = np.ndarray((size,), dtype=np.dtype(dtype), buffer=shm.buf)
+        attached = (shm, tr.PatientIndex.from_sorted(keys, method))
+        _attached.clear()
+        _attached[name] = attached
+    return attached[1]
+
+
+def _process_shard(func, shard, handle, keep_rows, kwargs):
+    """
+    Выполняет преобразование шарда в процессе-исполнителе.
+    Дедупликация откладывается: возвращаются ключи строк, прошедших правила до нее.
+    """
+    with val.collect(keep_rows) as collector:
+        result = func(shard, _attach(handle), **kwargs)
+    return collector, result
+
+
+def process_parallel(func, df, patient_index, workers=4, shards=None, seen_ids=None, **kwargs):
+    """
+    Выполняет преобразование transform.process_* по шардам строк в пуле процессов.
+    Правила, не зависящие от других строк, проверяются в шардах; индекс пациентов
+    передается через разделяемую память. Дедупликация (keep='first') выполняется
+    в основном процессе по ключам всех шардов в исходном порядке строк, поэтому
+    результат и количество отброшенных строк по правилам совпадают с обработкой
+    всей таблицы в одном процессе.
+    :param func: Функция преобразования (например, transform.process_visits_data).
+    :param df: DataFrame для обработки.
+    :param patient_index: PatientIndex или DataFrame пациентов.
+    :param workers: Количество процессов.
+    :param shards: Количество шардов (по умолчанию равно workers).
+    :param seen_ids: Идентификаторы из предыдущих чанков (для потоковой обработки).
+    :param kwargs: Дополнительные аргументы func (например, guaranteed).
+    :return: Обработанный DataFrame.
+    """
+    patient_index = tr.as_patient_index(patient_index)
+    if len(df) < MIN_PARALLEL_ROWS or workers < 2 or patient_index.empty:
+        if seen_ids is not None:
+            kwargs['seen_ids'] = seen_ids
+        return func(df, patient_index, **kwargs)
+
+    try:
+        # Позиции строк: по ним склеиваются результаты шардов и определяется первое вхождение
+        original_index = df.index
+        df = df.reset_index(drop=True)
+        bounds = np.linspace(0, len(df), (shards or workers) + 1).astype(int)
+        keep_rows = quarantine.enabled()
+
+        pool = get_pool(workers)
+        with SharedPatientIndex(patient_index) as shared:
+            futures = [pool.submit(_process_shard, func, df.iloc[start:end], shared.handle, keep_rows, kwargs)
+                       for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+            outputs = [future.result() for future in futures]
+
+        collectors = [output[0] for output in outputs]
+        result = pd.concat([output[1] for output in outputs])
+        table = collectors[0].table
+        counts = {}
+        messages = {}
+        for collector in collectors:
+            for code, count in collector.counts.items():
+                counts[code] = counts.get(code, 0) + count
+            messages.update(collector.messages)
+
+        # Дедупликация по всей таблице среди строк, прошедших предшествующие правила
+        duplicated_index = None
+        dedup_rule = collectors[0].dedup
+        if dedup_rule is not None:
+            code, messages[code] = dedup_rule
+            candidates = pd.concat([collector.candidates for collector in collectors])
+            duplicated = candidates.duplicated(keep='first')
+            if seen_ids is not None:
+                duplicated |= dedup.isin(candidates, seen_ids)
+                dedup.add(seen_ids, candidates[~duplicated])
+            duplicated_index = candidates.index[duplicated.to_numpy()]
+            counts[code] = counts.get(code, 0) + len(duplicated_index)
+            # Дубликаты, отброшенные в шарде следующими правилами, засчитываются дедупликации
+            for collector in collectors:
+                for later_code, index in collector.after_dedup:
+                    counts[later_code] -= int(index.isin(duplicated_index).sum())
+            drop = result.index.isin(duplicated_index)
+            if drop.any():
+                quarantine.send(table, code, result[drop])
+                result = result[~drop]
+
+        for collector in collectors:
+            for _, rule_code, rows in collector.rejected:
+                if duplicated_index is not None:
+                    moved = rows.index.isin(duplicated_index)
+                    quarantine.send(table, code, rows[moved])
+                    rows = rows[~moved]
+                quarantine.send(table, rule_code, rows)
+
+        # Логи и отчет о запуске - как при обработке в одном процессе
+        for code, count in counts.items():
+            if count:
+                logging.warning(f"{table}: найдено {count} {messages[code]}. Они будут удалены.")
+                metrics.record_drop(code, count)
+
+        result.index = original_index[result.index]
+        logging.info(f"{table}: обработано {len(df)} строк в {len(futures)} процессах, осталось {len(result)}.")
+        return result
+
+    except Exception as e:
+        logging.error(f"Ошибка при параллельной обработке ({func.__name__}): {e}")
+        raise
@@ -0,0 +1,177 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pandas as pd
+import load as l
+
+# Активный карантин: в него validation.apply_rules отправляет отброшенные строки
+_active = None
+
+
+class QuarantineSink:
+    """
+    Карантин отброшенных строк: строки, не прошедшие проверки в transform.py,
+    сохраняются вместе с кодом правила (столбец reject_reason) и идентификатором
+    запуска (run_id), чтобы их можно было проверить и загрузить повторно без
+    новой выгрузки из PostgreSQL.
+    Строки накапливаются в памяти по таблицам и записываются пакетами не меньше
+    batch_rows строк в отдельном потоке, поэтому преобразования не ждут записи.
+    Назначение:
+      каталог   - <directory>/<таблица>/run=<run_id>/part-<N>.<fmt> (fmt - формат из load.WRITERS);
+      SQL-база  - таблицы <table_prefix><таблица> в target_conn_string (дозапись).
+    """
+
+    def __init__(self, directory='quarantine', fmt='parquet', target_conn_string=None,
+                 table_prefix='quarantine_', batch_rows=50000):
+        if fmt not in l.WRITERS:
+            raise ValueError(f"Неизвестный формат: {fmt}")
+        self.directory = directory
+        self.fmt = fmt
+        self.target_conn_string = target_conn_string
+        self.table_prefix = table_prefix
+        self.batch_rows = batch_rows
+        self.run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.counts = {}
+        self._buffers = {}
+        self._parts = {}
+        self._lock = threading.Lock()
+        self._futures = []
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='quarantine')
+
+    def add(self, table, rule, rows):
+        """
+        Добавляет отброшенные строки в буфер таблицы.
+        :param table: Имя таблицы (например, 'amb_visit').
+        :param rule: Код правила (например, 'unknown_patientid').
+        :param rows: DataFrame с отброшенными строками.
+        """
+        if rows.empty:
+            return
+        rows = rows.assign(reject_reason=rule)
+        with self._lock:
+            key = (table, rule)
+            self.counts[key] = self.counts.get(key, 0) + len(rows)
+            buffer = self._buffers.setdefault(table, [])
+            buffer.append(rows)
+            if sum(len(part) for part in buffer) >= self.batch_rows:
+                self._submit(table)
+
+    def _submit(self, table):
+        """
+        Передает буфер таблицы потоку записи (вызывается под блокировкой).
+        """
+        frames = self._buffers.pop(table, None)
+        if not frames:
+            return
+        part = self._parts.get(table, 0)
+        self._parts[table] = part + 1
+        self._futures.append(self._writer.submit(self._write, table, frames, part))
+
+    def _write(self, table, frames, part):
+        try:
+            batch = pd.concat(frames, ignore_index=True)
+            # Имена столбцов в запросах могут повторяться (например, два столбца "text")
+            batch.columns = _unique_names(batch.columns)
+            batch['run_id'] = self.run_id
+            if self.target_conn_string is not None:
+                l.load_data(batch, f"{self.table_prefix}{table}", self.target_conn_string, if_exists='append')
+            else:
+                extension, writer, compression = l.WRITERS[self.fmt]
+                run_dir = os.path.join(self.directory, table, f"run={self.run_id}")
+                os.makedirs(run_dir, exist_ok=True)
+                writer(batch, os.path.join(run_dir, f"part-{part:05d}.{extension}"), compression)
+            logging.info(f"Карантин '{table}': записано {len(batch)} строк.")
+        except Exception as e:
+            logging.error(f"Ошибка при записи карантина '{table}': {e}")
+            raise
+
+    def close(self):
+        """
+        Записывает остатки буферов, дожидается записи и сохраняет сводку.
+        :return: Словарь {(таблица, правило): количество строк}.
+        """
+        with self._lock:
+            for table in list(self._buffers):
+                self._submit(table)
+            futures, self._futures = self._futures, []
+        self._writer.shutdown(wait=True)
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        self._write_summary()
+        logging.info("Карантин, отброшено строк по правилам:\n" + self.summary())
+        if errors:
+            raise errors[0]
+        return dict(self.counts)
+
+    def summary_frame(self):
+        return pd.DataFrame([{'run_id': self.run_id, 'table': table, 'rule': rule, 'rows': count}
+                             for (table, rule), count in sorted(self.counts.items())],
+                            columns=['run_id', 'table', 'rule', 'rows'])
+
+    def summary(self):
+        """
+        Текстовая сводка: количество отброшенных строк по таблицам и правилам.
+        """
+        lines = [f"{'таблица':<16} {'правило':<20} {'строк':>10}"]
+        for (table, rule), count in sorted(self.counts.items()):
+            lines.append(f"{table:<16} {rule:<20} {count:>10}")
+        return '\n'.join(lines)
+
+    def _write_summary(self):
+        """
+        Дописывает сводку запуска в <directory>/summary.csv (история по всем запускам).
+        """
+        if self.target_conn_string is not None or not self.counts:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'summary.csv')
+        self.summary_frame().to_csv(path, mode='a', header=not os.path.exists(path),
+                                    index=False, encoding='utf-8-sig')
+
+
+def _unique_names(columns):
+    seen = {}
+    names = []
+    for col in columns:
+        count = seen.get(col, 0)
+        seen[col] = count + 1
+        names.append(col if count == 0 else f"{col}.{count}")
+    return names
+
+
+def activate(sink):
+    """
+    Делает карантин активным (None - отключает). Возвращает предыдущий.
+    """
+    global _active
+    previous, _active = _active, sink
+    return previous
+
+
+@contextmanager
+def session(sink):
+    """
+    Включает карантин на время блока и по выходу записывает остатки и сводку.
+    sink=None - карантин не ведется.
+    """
+    previous = activate(sink)
+    try:
+        yield sink
+    finally:
+        activate(previous)
+        if sink is not None:
+            sink.close()
+
+
+def send(table, rule, rows):
+    """
+    Отправляет отброшенные строки в активный карантин (если он включен).
+    """
+    if _active is not None:
+        _active.add(table, rule, rows)
+
+
+def enabled():
+    return _active is not None
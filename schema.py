@@ -0,0 +1,103 @@
+import logging
+import pandas as pd
+import metrics
+from dates import ISO_FORMAT, parse
+
+# Схемы типов извлеченных таблиц (имена - как в результатах запросов sql_scripts):
+#   category - текст с небольшим числом различных значений (справочные тексты, коды);
+#   integer  - целочисленные идентификаторы, которые можно хранить в меньшем типе;
+#   dates    - столбцы с датами и формат разбора (ISO_FORMAT - дата/время, которые PostgreSQL отдает текстом);
+#              те же форматы используют проверки дат в transform.py (date_formats).
+SCHEMAS = {
+    'patient': {
+        'category': ['sex', 'social_status', 'prikrep', 'group_lu', 'rezus_lu'],
+        'integer': ['keyid'],
+        'dates': {'birthdate': ISO_FORMAT, 'death_dat': ISO_FORMAT},
+    },
+    'amb_visit': {
+        'category': ['diagnoz', 'text'],
+        'integer': ['keyid', 'patientid', 'agrid', 'doctorid'],
+        'dates': {'dat': ISO_FORMAT},
+    },
+    'stac_visit': {
+        'category': ['text', 'diagnoz', 'ishod', 'department', 'vmp'],
+        'integer': ['visitid', 'patientid', 'doctorid', 'count_day'],
+        'dates': {'dat': ISO_FORMAT, 'dat1': ISO_FORMAT},
+    },
+    'diap': {
+        'category': ['ill_type', 'disp_status', 'diag_code', 'diag_text'],
+        'integer': ['keyid', 'patient_id', 'reg_by', 'confirm_by'],
+        'dates': {'reg_dat': '%d.%m.%Y', 'confirm_dat': '%d.%m.%Y', 'end_dat': '%d.%m.%Y'},
+    },
+    'po': {
+        'category': ['depgosp', 'result', 'giag_code', 'diag_text', 'form_help', 'who'],
+        'integer': ['id', 'pat'],
+        'dates': {'dat_st': ISO_FORMAT, 'dat_fin': ISO_FORMAT},
+    },
+}
+
+# Текст переводится в category, только если различных значений не больше этой доли строк
+CATEGORY_MAX_RATIO = 0.5
+
+
+def date_formats(table, columns=None):
+    """
+    Форматы разбора столбцов с датами таблицы: {столбец: формат}.
+    :param columns: Нужные столбцы (по умолчанию - все столбцы с датами схемы).
+    """
+    formats = SCHEMAS[table]['dates']
+    return {col: formats[col] for col in (columns or formats)}
+
+
+def _memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def optimize_dtypes(df, table):
+    """
+    Приводит извлеченную таблицу к компактным типам по схеме SCHEMAS:
+    1. Текст с повторяющимися значениями -> category.
+    2. Целочисленные идентификаторы -> наименьший целый тип (int32/int16...).
+       Столбцы с пропусками (float64) не меняются, чтобы не менять вид значений в csv.
+    3. Даты разбираются один раз; повторный pd.to_datetime в transform.py
+       для уже разобранного столбца ничего не делает.
+    Столбцы обрабатываются по позиции, так как имена в запросах могут повторяться.
+    :param df: DataFrame, полученный из extract_data.
+    :param table: Имя схемы (ключ SCHEMAS).
+    :return: DataFrame с оптимизированными типами.
+    """
+    try:
+        schema = SCHEMAS[table]
+        before = _memory_mb(df)
+
+        for i, col in enumerate(df.columns):
+            series = df.iloc[:, i]
+            if col in schema['dates']:
+                fmt = schema['dates'][col]
+                df.isetitem(i, parse(series, fmt))
+            elif col in schema['integer']:
+                if pd.api.types.is_integer_dtype(series) and not isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+                    df.isetitem(i, pd.to_numeric(series, downcast='integer'))
+            elif col in schema['category']:
+                is_text = pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+                if is_text and series.nunique(dropna=True) <= len(series) * CATEGORY_MAX_RATIO:
+                    df.isetitem(i, series.astype('category'))
+
+        after = _memory_mb(df)
+        metrics.record('memory_before_mb', round(before, 1))
+        metrics.record('memory_after_mb', round(after, 1))
+        logging.info(f"Оптимизация типов '{table}': {before:.1f} МБ -> {after:.1f} МБ.")
+        return df
+
+    except Exception as e:
+        logging.error(f"Ошибка при оптимизации типов '{table}': {e}")
+        raise
+
+
+def memory_report(df, table):
+    """
+    Память по столбцам (МБ) для анализа, какие столбцы занимают больше всего места.
+    """
+    usage = df.memory_usage(deep=True, index=False) / 1024 ** 2
+    return pd.DataFrame({'table': table, 'column': df.columns, 'dtype': df.dtypes.astype(str).values,
+                         'memory_mb': usage.values}).sort_values('memory_mb', ascending=False)
@@ -1,4 +1,6 @@
 # SQL скрипты для получения данных из БД
+import re
+
 query_get_patient = '''
 select 
 	p.keyid, 
@@ -127,4 +129,186 @@ join solution_med.dep d on v.dep1id = d.keyid
 join solution_med.patdiag p on p.visitid = v.keyid
 join solution_med.diagnos dig on dig.keyid = p.diagid
 where v.vistype = 101 and p.diagtype = 1
-'''
\ No newline at end of file
+'''
+# Режим справочников: запросы фактов без коррелированных подзапросов к lu, dep и agr.
+# Вместо текста выбирается идентификатор, а текст подставляется в pandas из
+# справочников, выгруженных один раз (lookups.DimensionCache).
+dimension_queries = {
+    'lu': 'select l.keyid, l."text" from solution_med.lu l',
+    'dep': 'select d.keyid, d."text" from solution_med.dep d',
+    'agr': 'select a.keyid, a."text" from solution_med.agr a',
+}
+
+query_get_patient_ids = '''
+select 
+	p.keyid, 
+	p.sex, 
+	p.birthdate, 
+	p.death_dat, 
+	p.social_status_id,
+	CASE 
+       WHEN p.areanum_lu_id IS NULL THEN '0' 
+       ELSE '1' 
+    END
+	 as prikrep, 
+	p.group_lu_id,
+	p.rh_lu_id
+from solution_med.patient p
+'''
+
+query_get_doctor_ids = '''
+select 
+	d.keyid,
+	d.positionid,
+	d.depid,
+	d.staff_docdep_id,
+	d.status
+from solution_med.docdep d
+where d.depid in (22, 25, 26, 27, 29) and d.positionid is not null
+'''
+
+amb_query_get_visit_ids = '''
+select v.keyid, v.patientid, v.num, v.dat, v.agrid, v.doctorid, d.code as diagnoz, v.depid
+from solution_med.visit v 
+join solution_med.patdiag p on v.keyid = p.visitid
+join solution_med.diagnos d on p.diagid = d.keyid 
+where v.vistype < 100
+'''
+
+stac_query_get_visit_ids = '''
+SELECT 
+	v.rootid AS visitID, 
+	v.patientid,
+	v.num AS num_b, 
+	v.agrid,
+	v.doctorid, 
+	di.code as diagnoz,
+	v.dep1id,
+	v.dat,
+	v.dat1,
+	DATE(v.dat1) - DATE(v.dat) AS count_day,
+	d.keyid AS department_id,
+	(	SELECT 
+		(SELECT pf_lu.get_text(sh.type_id)
+        FROM serv_ht sh
+        WHERE sh.keyid = coalesce(k.serv_ht_id, hp.serv_ht_id)) AS vmp_type
+  	FROM kvota k
+  	LEFT JOIN ht_profoper hp ON hp.keyid = k.ht_profoperid
+  	LEFT JOIN kvt_opers ko ON ko.kvotaid = k.keyid
+ 	WHERE k.visitid2 = v.rootid) as vmp
+FROM solution_med.visit v
+JOIN solution_med.dep d ON v.depid = d.keyid
+join solution_med.patdiag p on p.visitid = v.keyid
+join solution_med.diagnos di on p.diagid = di.keyid
+where p.diagtype in (1) and v.dep1id IN (SELECT keyid FROM solution_med.dep WHERE out_status=1 AND status=1) AND v.vistype IN (102, 103, 104, 107) 
+'''
+
+# Запросы режима справочников и подстановки: таблица -> (запрос,
+# [(столбец с идентификатором, справочник, имя столбца с текстом), ...]).
+# Имена столбцов с текстом совпадают с именами в исходных запросах.
+lookup_queries = {
+    'patient': (query_get_patient_ids, [('social_status_id', 'lu', 'social_status'),
+                                        ('group_lu_id', 'lu', 'group_lu'),
+                                        ('rh_lu_id', 'lu', 'rezus_lu')]),
+    'doc': (query_get_doctor_ids, [('depid', 'dep', 'text'),
+                                   ('staff_docdep_id', 'lu', 'text')]),
+    'amb_visit': (amb_query_get_visit_ids, [('depid', 'dep', 'text')]),
+    'stac_visit': (stac_query_get_visit_ids, [('agrid', 'agr', 'text'),
+                                              ('dep1id', 'dep', 'ishod'),
+                                              ('department_id', 'dep', 'department')]),
+}
+
+# Пакетный режим для функций, вызываемых на каждую строку: основной запрос выбирает
+# только ключи, а тексты docdep выгружаются отдельным запросом по одному разу
+# на врача и присоединяются в pandas (lookups.join_bulk).
+# Первый столбец пакетного запроса - ключ, остальные - значения; столбец значения
+# с именем, уже существующим в основном запросе, заменяет его на месте.
+# Приемного отделения (po) здесь нет: основной запрос уже дает около одной строки
+# на визит, и отдельный запрос с pkg_protocol_universal.get_answer вызывал бы функции
+# почти столько же раз. Его стоит добавить, когда появится запрос по таблицам протокола
+# без вызова функции на каждую строку, и сравнить формы через lookups.compare_bulk_extract.
+amb_query_get_diagn_pat_main = amb_query_get_diagn_pat.replace(
+    'pf_docdep.get_text(pdc.end_docdep_id) AS end_by', 'pdc.end_docdep_id AS end_by')
+
+docdep_text_query = '''
+select dd.keyid, pf_docdep.get_text(dd.keyid) as end_by
+from solution_med.docdep dd
+where dd.keyid in (select pdc.end_docdep_id from patdiag_confirm pdc)
+'''
+
+# Таблица -> (основной запрос, [(пакетный запрос, столбец-ключ основного запроса), ...])
+bulk_queries = {
+    'diap': (amb_query_get_diagn_pat_main, [(docdep_text_query, 'end_by')]),
+}
+
+# Режим pushdown: очистка дат и проверка ссылок на пациентов выполняются в PostgreSQL
+# до передачи данных по сети. Запрос оборачивается подзапросом с условиями, а в Python
+# пропускаются правила проверки, которые эти условия уже гарантируют.
+# Сравнение с localtimestamp соответствует datetime.now() в transform.py, если часовые
+# пояса сервера и клиента совпадают.
+SQL_NOW = 'localtimestamp'
+SQL_SENTINEL_DATE = "date '1899-12-30'"
+SQL_PATIENT_KEYS = 'select keyid from solution_med.patient'
+
+
+def native_dates(query):
+    """
+    Заменяет to_char(<дата>, 'dd.mm.yyyy') на дату типа date:
+    драйвер возвращает готовые даты, и разбирать строки в pandas не нужно.
+    """
+    return re.sub(r"to_char\(([\w.]+),\s*'dd\.mm\.yyyy'\)", r"\1::date", query)
+
+
+def _where(query, *conditions):
+    return f"select * from ({query}) q\nwhere " + "\n  and ".join(conditions)
+
+
+def pushdown_queries(base=None):
+    """
+    Запросы режима pushdown и коды правил transform.py, которые они гарантируют.
+    Условия на дату и пациента визита одинаковы для всех строк одного визита
+    (значения берутся из solution_med.visit), поэтому фильтрация в БД до
+    дедупликации дает тот же результат, что и фильтрация в Python после нее.
+    Проверка пациента по solution_med.patient равна проверке по PatientIndex,
+    так как query_get_patient выгружает всех пациентов без фильтров.
+    Даты-заглушки в Python по-прежнему заменяются на NaT (это не удаляет строки).
+    :param base: Исходные запросы {имя таблицы: запрос} (по умолчанию - запросы этого модуля),
+                 например запросы режима справочников.
+    :return: Словарь {имя таблицы: (запрос, кортеж гарантированных правил)}.
+    """
+    base = {'amb_visit': amb_query_get_visit, 'stac_visit': stac_query_get_visit,
+            'diap': amb_query_get_diagn_pat, 'po': stac_query_get_PO_visit, **(base or {})}
+    now, patients, sentinel = SQL_NOW, SQL_PATIENT_KEYS, SQL_SENTINEL_DATE
+    dat_st, dat_fin = f"nullif(q.dat_st, {sentinel})", f"nullif(q.dat_fin, {sentinel})"
+    return {
+        'amb_visit': (
+            _where(base['amb_visit'],
+                   f"q.dat <= {now}",
+                   f"q.patientid in ({patients})"),
+            ('invalid_dat', 'missing_patientid', 'unknown_patientid'),
+        ),
+        'stac_visit': (
+            _where(base['stac_visit'],
+                   f"(q.dat is null or q.dat <= {now})",
+                   f"(q.dat1 is null or q.dat1 <= {now})",
+                   f"q.patientid in ({patients})"),
+            ('future_dates', 'missing_patientid', 'unknown_patientid'),
+        ),
+        'diap': (
+            _where(native_dates(base['diap']),
+                   f"(q.reg_dat is null or q.reg_dat <= {now})",
+                   f"(q.confirm_dat is null or q.confirm_dat <= {now})",
+                   f"(q.end_dat is null or q.end_dat <= {now})",
+                   f"q.patient_id in ({patients})"),
+            ('future_dates', 'missing_patientid', 'unknown_patientid'),
+        ),
+        'po': (
+            _where(base['po'],
+                   f"q.pat in ({patients})",
+                   f"(q.dat_st is null or q.dat_st <= {now})",
+                   f"(q.dat_fin is null or q.dat_fin <= {now})",
+                   f"coalesce({dat_st} <= {dat_fin}, true)",
+                   f"({dat_st} is not null or {dat_fin} is not null)"),
+            ('missing_patientid', 'unknown_patientid', 'future_dates', 'invalid_interval', 'missing_dates'),
+        ),
+    }
@@ -0,0 +1,83 @@
+import io
+import time
+from collections import namedtuple
+from decimal import Decimal
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+import extract
+
+Column = namedtuple('Column', 'name type_code')
+
+
+def _read(data, description, batch_size=100):
+    dtypes, parse_dates, numeric = extract._copy_dtypes(description)
+    names = [column.name for column in description]
+    return pd.concat(extract._read_copy_csv(io.StringIO(data), names, dtypes, parse_dates, numeric, batch_size))
+
+
+def test_copy_keeps_text_that_looks_like_null():
+    # Так COPY ... WITH (FORMAT csv, NULL '\N') выгружает NULL, пустую строку и тексты
+    data = 'name,keyid\nNA,1\nNULL,2\n"",3\nnan,4\nN/A,5\n\\N,6\n'
+    df = _read(data, [Column('name', 25), Column('keyid', 20)])
+    assert df['name'].iloc[:5].tolist() == ['NA', 'NULL', '', 'nan', 'N/A']
+    assert pd.isna(df['name'].iloc[5])
+    assert df['keyid'].tolist() == [1, 2, 3, 4, 5, 6]
+
+
+def test_copy_numeric_keeps_precision():
+    data = 'amount,dat\n12345678901234567890.123,2024-01-31\n\\N,\\N\n0.10,2024-02-01\n'
+    df = _read(data, [Column('amount', 1700), Column('dat', 1082)], batch_size=2)
+    assert df['amount'].iloc[0] == Decimal('12345678901234567890.123')
+    assert df['amount'].iloc[2] == Decimal('0.10')
+    assert pd.isna(df['amount'].iloc[1]) and pd.isna(df['dat'].iloc[1])
+    assert df['dat'].iloc[0] == pd.Timestamp('2024-01-31')
+
+
+def test_copy_keeps_duplicate_column_names():
+    df = _read('text,text\na,b\n', [Column('text', 25), Column('text', 25)])
+    assert list(df.columns) == ['text', 'text']
+    assert df.iloc[0].tolist() == ['a', 'b']
+
+
+@pytest.fixture
+def source(tmp_path):
+    conn_string = f"sqlite:///{tmp_path / 'source.db'}"
+    engine = create_engine(conn_string)
+    pd.DataFrame({'keyid': range(1, 1001), 'value': [f"v{i}" for i in range(1, 1001)]}).to_sql(
+        'visit', engine, index=False)
+    engine.dispose()
+    yield conn_string
+    for key in [key for key in extract._engines if key[0] == conn_string]:
+        extract._engines.pop(key).dispose()
+
+
+def test_partitioned_extract_matches_plain(source):
+    query = 'select keyid, value from visit'
+    expected = extract.extract_data(query, source, batch_size=64)
+    result = extract.extract_data(query, source, batch_size=64, pool_size=3, partition_column='keyid', partitions=5)
+    pd.testing.assert_frame_equal(result, expected)
+    streamed = pd.concat(extract.extract_chunks(query, source, 64, 3, partition_column='keyid', partitions=5),
+                         ignore_index=True)
+    pd.testing.assert_frame_equal(streamed, expected)
+    # Части используют пул вызывающего, а не отдельный пул на таблицу
+    assert {key[1] for key in extract._engines if key[0] == source} == {3, 5}
+
+
+def test_partitioned_extract_bounds_buffered_chunks(source, monkeypatch):
+    produced = []
+    read_sql = pd.read_sql
+
+    def counting_read_sql(*args, **kwargs):
+        for chunk in read_sql(*args, **kwargs):
+            produced.append(len(chunk))
+            yield chunk
+
+    monkeypatch.setattr(extract.pd, 'read_sql', counting_read_sql)
+    chunks = extract.extract_chunks('select keyid from visit', source, 10, 2, partition_column='keyid', partitions=4)
+    consumed = [next(chunks)]
+    time.sleep(0.5)
+    # Каждая из 2 выполняемых частей держит не больше очереди и одного чанка в ожидании
+    assert len(produced) - len(consumed) <= 2 * (extract.PARTITION_QUEUE_CHUNKS + 1)
+    consumed += list(chunks)
+    assert sum(len(chunk) for chunk in consumed) == 1000
@@ -0,0 +1,41 @@
+import pandas as pd
+import incremental as inc
+import transform as tr
+
+
+def test_next_watermark_ignores_rejected_future_dates():
+    raw = pd.DataFrame({
+        'visitid': [1, 2, 3],
+        'patientid': [10, 10, 10],
+        'dat': ['2024-01-01 10:00:00', '2024-01-05 10:00:00', '2024-01-07 10:00:00'],
+        'dat1': ['2024-01-03 12:00:00', '2024-01-09 12:00:00', '2099-01-01 00:00:00'],
+        'count_day': [2, 4, 1],
+    })
+    processed = tr.process_hospital_visits(raw, pd.DataFrame({'keyid': [10]}))
+    assert inc.next_watermark(processed, 'dat1', '2024-01-01T00:00:00') == '2024-01-09T12:00:00'
+
+
+def test_next_watermark_caps_dates_at_now():
+    df = pd.DataFrame({'dat1': pd.to_datetime(['2024-01-09', '2099-01-01'])})
+    assert inc.next_watermark(df, 'dat1', None) == '2024-01-09T00:00:00'
+    assert inc.next_watermark(df.iloc[1:], 'dat1', '2024-01-01T00:00:00') == '2024-01-01T00:00:00'
+
+
+def test_next_watermark_keeps_previous_without_rows():
+    assert inc.next_watermark(pd.DataFrame({'keyid': []}), 'keyid', 42) == 42
+    assert inc.next_watermark(pd.DataFrame({'keyid': [40, 57]}), 'keyid', 42) == 57
+
+
+def test_incremental_query_selects_changed_rows():
+    config = inc.INCREMENTAL_QUERIES['diap']
+    query, params = inc.build_incremental_query('select 1', config['column'], 100, config['inclusive'],
+                                                config['changed'], '2024-02-01')
+    assert params == {'watermark': 100, 'changed_since': '2024-02-01'}
+    sql = str(query)
+    assert "q.keyid > :watermark or to_date(q.confirm_dat, 'dd.mm.yyyy') >= cast(:changed_since as date)" in sql
+    assert "to_date(q.end_dat, 'dd.mm.yyyy') >= cast(:changed_since as date)" in sql
+
+    # Первый запуск с отметкой: даты предыдущего запуска еще нет
+    query, params = inc.build_incremental_query('select 1', 'keyid', 100, False, config['changed'], None)
+    assert params == {'watermark': 100}
+    assert inc.build_incremental_query('select 1', 'keyid', None) == ('select 1', None)
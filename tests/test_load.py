@@ -0,0 +1,97 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect, types
+import load as l
+
+
+@pytest.fixture
+def target(tmp_path):
+    return f"sqlite:///{tmp_path / 'target.db'}"
+
+
+def _table(conn_string, name='visit'):
+    return pd.read_sql(f"select * from {name} order by keyid", create_engine(conn_string))
+
+
+def _visits(keys, values):
+    return pd.DataFrame({'keyid': keys, 'text': values, 'count_day': [len(v or '') for v in values]})
+
+
+def test_upsert_initial_load_and_idempotent_reload(target):
+    chunks = [_visits([1, 2], ['a', 'bb']), _visits([3], ['ccc'])]
+    assert l.upsert_chunks(chunks, 'visit', target, 'keyid') == \
+        {'inserted': 3, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+    pd.testing.assert_frame_equal(_table(target), pd.concat(chunks, ignore_index=True))
+
+    assert l.upsert_chunks(chunks, 'visit', target, 'keyid') == \
+        {'inserted': 0, 'updated': 0, 'unchanged': 3, 'deleted': 0}
+    pd.testing.assert_frame_equal(_table(target), pd.concat(chunks, ignore_index=True))
+    assert not inspect(create_engine(target)).has_table('visit_staging')
+
+
+def test_upsert_applies_changes_and_deletes(target):
+    l.upsert_chunks([_visits([1, 2, 3], ['a', 'bb', None])], 'visit', target, 'keyid')
+    # keyid=1 не изменился, 2 и 3 (NULL -> значение) изменились, 4 новый, 5 - повтор в чанке
+    chunks = [_visits([1, 2], ['a', 'xx']), _visits([3, 4, 5, 5], ['c', 'd', 'old', 'new'])]
+    chunks[1]['count_day'] = [1, 1, 3, 3]
+
+    assert l.upsert_chunks(chunks, 'visit', target, 'keyid') == \
+        {'inserted': 2, 'updated': 2, 'unchanged': 1, 'deleted': 0}
+    assert _table(target)['text'].tolist() == ['a', 'xx', 'c', 'd', 'new']
+
+    assert l.upsert_chunks([_visits([2, 5], ['xx', 'new'])], 'visit', target, 'keyid', delete_missing=True) == \
+        {'inserted': 0, 'updated': 0, 'unchanged': 2, 'deleted': 3}
+    assert _table(target)['keyid'].tolist() == [2, 5]
+
+
+def test_upsert_rejects_key_repeated_across_chunks(target):
+    l.upsert_chunks([_visits([1], ['a'])], 'visit', target, 'keyid')
+    with pytest.raises(ValueError, match='повторяются в разных чанках'):
+        l.upsert_chunks([_visits([1, 2], ['x', 'y']), _visits([2], ['z'])], 'visit', target, 'keyid')
+    assert _table(target)['text'].tolist() == ['a']
+    assert not inspect(create_engine(target)).has_table('visit_staging')
+
+
+def test_sql_column_types_sizes_strings_with_headroom_and_explicit_lengths():
+    df = pd.DataFrame({'keyid': [1, 2], 'text': ['abc', None], 'diagnoz': ['I10', 'J01'],
+                       'empty': [None, None], 'long': ['x' * 3000, 'y']})
+    column_types = l.sql_column_types(df, headroom=2, lengths={'diagnoz': 16, 'empty': 50})
+    assert isinstance(column_types['keyid'], types.BigInteger)
+    assert column_types['text'].length == 6
+    assert column_types['diagnoz'].length == 16
+    assert column_types['empty'].length == 50
+    assert column_types['long'].length == 4000
+    assert isinstance(l.sql_column_types(df, fixed_strings=False)['text'], types.UnicodeText)
+
+
+def test_load_chunks_fast_rejects_strings_longer_than_first_chunk(target):
+    chunks = [_visits([1], ['abc']), _visits([2], ['abcdef'])]
+    l.load_data_chunks(iter(chunks), 'visit', target, method='fast')
+    assert _table(target)['text'].tolist() == ['abc', 'abcdef']
+
+    chunks.append(_visits([3], ['abcdefg']))
+    with pytest.raises(ValueError, match='NVARCHAR\\(6\\)'):
+        l.load_data_chunks(iter(chunks), 'visit', target, method='fast')
+    l.load_data_chunks(iter(chunks), 'visit', target, method='fast', string_lengths={'text': 10})
+    assert _table(target)['text'].tolist() == ['abc', 'abcdef', 'abcdefg']
+
+
+@pytest.mark.parametrize('name', ['visits.csv', 'visits.csv.gz'])
+def test_save_chunks_to_csv_pins_datetime_layout(tmp_path, name):
+    dat = pd.to_datetime(['2020-01-01 10:30:00', None, '2020-01-03', '2020-01-04'], format='ISO8601')
+    df = pd.DataFrame({'keyid': [1, 2, 3, 4], 'dat': dat})
+    chunks = [df.iloc[:2], df.iloc[2:]]
+    l.save_chunks_to_csv(iter(chunks), str(tmp_path / name))
+    l.save_to_csv(df, str(tmp_path / f"batch_{name}"))
+    streamed = pd.read_csv(tmp_path / name, dtype=str, keep_default_na=False)
+    batch = pd.read_csv(tmp_path / f"batch_{name}", dtype=str, keep_default_na=False)
+    pd.testing.assert_frame_equal(streamed, batch)
+    assert streamed['dat'].tolist() == ['2020-01-01 10:30:00', '', '2020-01-03 00:00:00', '2020-01-04 00:00:00']
+
+
+def test_save_chunks_to_csv_widens_layout_without_losing_time(tmp_path):
+    chunks = [pd.DataFrame({'dat': pd.to_datetime(['2020-01-01'])}),
+              pd.DataFrame({'dat': pd.to_datetime(['2020-01-02 10:30:00', '2020-01-03'], format='ISO8601')})]
+    l.save_chunks_to_csv(iter(chunks), str(tmp_path / 'visits.csv'))
+    assert pd.read_csv(tmp_path / 'visits.csv')['dat'].tolist() == \
+        ['2020-01-01', '2020-01-02 10:30:00', '2020-01-03 00:00:00']
@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+import extract
+import lookups
+
+
+@pytest.fixture
+def source(tmp_path):
+    conn_string = f"sqlite:///{tmp_path / 'source.db'}"
+    engine = create_engine(conn_string)
+    pd.DataFrame({'keyid': [1, 2, 2], 'text': ['Терапия', 'Хирургия', 'дубль']}).to_sql('dep', engine, index=False)
+    engine.dispose()
+    yield conn_string
+    for key in [key for key in extract._engines if key[0] == conn_string]:
+        extract._engines.pop(key).dispose()
+
+
+def test_dimension_cache_uses_shared_pool(source):
+    dimensions = lookups.DimensionCache(source, directory=None, queries={'dep': 'select keyid, text from dep'},
+                                        pool_size=3)
+    df = pd.DataFrame({'keyid': [10, 11, 12], 'depid': [2, 1, 5]})
+    result = dimensions.resolve(df, [('depid', 'dep', 'text')])
+    assert result.columns.tolist() == ['keyid', 'text']
+    assert result['text'].iloc[:2].tolist() == ['Хирургия', 'Терапия']
+    assert pd.isna(result['text'].iloc[2])
+    # Справочник выгружается в общем пуле размера EXTRACT_WORKERS, а не в отдельном пуле по умолчанию
+    assert [key for key in extract._engines if key[0] == source] == [(source, 3)]
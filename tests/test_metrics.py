@@ -0,0 +1,47 @@
+import threading
+import time
+import numpy as np
+import metrics
+
+
+def test_concurrent_step_keeps_peak_of_running_step():
+    report = metrics.RunReport('test')
+    allocated, released = threading.Event(), threading.Event()
+    baseline = metrics._current_rss_mb()
+
+    def large_step():
+        with report.step('large', 'transform') as record:
+            data = np.ones(100 * 1024 ** 2 // 8)
+            # Ждем выборку фонового потока, а не фиксированное время
+            deadline = time.monotonic() + 5
+            while record['peak_rss_mb'] < baseline + 80 and time.monotonic() < deadline:
+                time.sleep(metrics.RSS_SAMPLE_SECONDS)
+            del data
+            allocated.set()
+            released.wait(5)
+
+    thread = threading.Thread(target=large_step)
+    thread.start()
+    allocated.wait(5)
+    # Шаг, начатый после освобождения памяти, не сбрасывает пик выполняемого шага
+    with report.step('small', 'transform'):
+        pass
+    released.set()
+    thread.join()
+
+    steps = {step['name']: step for step in report.steps}
+    assert steps['large']['peak_rss_mb'] >= baseline + 80
+    assert steps['small']['peak_rss_mb'] < steps['large']['peak_rss_mb']
+    run_peak = report.to_dict()['peak_rss_mb']
+    assert run_peak >= max(step['peak_rss_mb'] for step in report.steps)
+    assert f"пик процесса за запуск: {run_peak:.1f} МБ" in report.summary()
+
+
+def test_run_peak_is_not_below_step_peaks(monkeypatch):
+    # VmHWM и выборки statm - разные источники; пик запуска не может быть меньше пика шага
+    report = metrics.RunReport('test')
+    report.steps.append({'name': 'step', 'kind': 'transform', 'status': 'ok', 'seconds': 0.0, 'rows_in': None,
+                         'rows_out': None, 'dropped': {}, 'peak_rss_mb': 247.4})
+    monkeypatch.setattr(metrics, '_peak_rss_mb', lambda: 247.33)
+    assert report.to_dict()['peak_rss_mb'] == 247.4
+    assert report.summary().endswith('пик процесса за запуск: 247.4 МБ')
@@ -0,0 +1,46 @@
+from contextlib import nullcontext
+import pandas as pd
+import pytest
+import dedup
+import parallel
+import transform as tr
+from benchmarks.synthetic import generate_tables
+
+
+@pytest.fixture(scope='module')
+def tables():
+    tables = generate_tables(4000, seed=1)
+    patient_index = tr.PatientIndex.from_frame(tr.process_patient_data(tables['patient'].copy()))
+    return tables, patient_index
+
+
+def _in_chunks(process, df, chunks=3):
+    """
+    Обработка таблицы по чанкам с общим множеством идентификаторов (как в потоковом режиме).
+    """
+    bounds = [len(df) * i // chunks for i in range(chunks + 1)]
+    return pd.concat([process(df.iloc[start:end].copy()) for start, end in zip(bounds[:-1], bounds[1:])])
+
+
+@pytest.mark.parametrize('make_seen', [lambda: nullcontext(set()), lambda: dedup.KeySet(memory_bytes=512)],
+                         ids=['set', 'KeySet'])
+@pytest.mark.parametrize('func,table', [(tr.process_visits_data, 'amb_visit'), (tr.process_po_visit_data, 'po')])
+def test_process_parallel_seen_ids(tables, monkeypatch, make_seen, func, table):
+    tables, patient_index = tables
+    monkeypatch.setattr(parallel, 'MIN_PARALLEL_ROWS', 0)
+
+    seen = set()
+    expected = _in_chunks(lambda chunk: func(chunk, patient_index, seen_ids=seen), tables[table])
+    with make_seen() as seen_ids:
+        result = _in_chunks(lambda chunk: parallel.process_parallel(func, chunk, patient_index, workers=2,
+                                                                    seen_ids=seen_ids), tables[table])
+    pd.testing.assert_frame_equal(result, expected)
+
+
+
+def test_patient_index_is_built_eagerly():
+    for method in tr.PatientIndex.METHODS:
+        index = tr.PatientIndex.from_frame(pd.DataFrame({'keyid': [3, 1, 3, None]}), method=method)
+        assert index._keys.tolist() == [1, 3]
+        assert (index._index is not None) == (method == 'hash')
+        assert index.contains(pd.Series([1, 2, 3.0])).tolist() == [True, False, True]
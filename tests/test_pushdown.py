@@ -0,0 +1,130 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+import etl_proc
+import extract
+import schema
+import sql_scripts as sql
+
+OUTPUT_FILES = ['Patient_f.csv', 'AMB visit.csv', 'STAC visit.csv', 'AMB diap.csv', 'po_visit.csv',
+                'doc.csv', 'dols.csv']
+
+
+def _dates(rng, start, days, size, fmt='%Y-%m-%d'):
+    return (pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, size), 'D')).strftime(fmt)
+
+
+def build_source(path, patients=500, seed=0):
+    """
+    SQLite-копия источника с результатами исходных запросов: будущие даты, даты-заглушки,
+    пустые и неизвестные пациенты. Как в PostgreSQL, дата и пациент визита одинаковы
+    во всех строках одного визита.
+    """
+    rng = np.random.default_rng(seed)
+    n, m = patients, patients * 3
+    with sqlite3.connect(path) as conn:
+        pd.DataFrame({
+            'keyid': np.arange(1, n + 1), 'sex': rng.choice(['М', 'Ж'], n),
+            'birthdate': _dates(rng, '1940-01-01', 30000, n), 'death_dat': None,
+            'social_status': rng.choice(['Работает', 'Пенсионер'], n), 'prikrep': rng.choice(['0', '1'], n),
+            'group_lu': rng.choice(['A', 'B'], n), 'rezus_lu': rng.choice(['+', '-'], n),
+        }).to_sql('patient', conn, index=False)
+
+        amb = pd.DataFrame({
+            'keyid': rng.integers(1, m, m), 'patientid': rng.integers(1, n + 50, m).astype(float), 'num': '1',
+            'dat': _dates(rng, '2015-01-01', 5000, m), 'agrid': 1, 'doctorid': rng.integers(1, 10, m),
+            'diagnoz': rng.choice(['J01', 'I10'], m), 'text': rng.choice(['Терапия', 'Хирургия'], m),
+        })
+        amb.loc[rng.random(m) < 0.02, 'patientid'] = None
+        amb[['dat', 'patientid']] = amb.groupby('keyid')[['dat', 'patientid']].transform('first')
+        amb.loc[amb.keyid % 97 == 0, 'dat'] = '2031-01-01'
+        amb.to_sql('amb', conn, index=False)
+
+        diap = pd.DataFrame({
+            'keyid': np.arange(m), 'patient_id': rng.integers(1, n + 50, m), 'ill_type': 'Острый',
+            'disp_status': 'Состоит', 'diag_code': 'J01', 'diag_text': 'x',
+            'reg_dat': _dates(rng, '1899-12-25', 50000, m, '%d.%m.%Y'), 'reg_by': rng.integers(1, 9, m),
+            'confirm_dat': '30.12.1899', 'confirm_by': 1, 'end_dat': None, 'end_by': 'Иванов',
+        })
+        diap.to_sql('diap', conn, index=False)
+        # Результат native_dates: даты типа date вместо строк dd.mm.yyyy
+        for col in ['reg_dat', 'confirm_dat', 'end_dat']:
+            diap[col] = pd.to_datetime(diap[col], format='%d.%m.%Y').dt.strftime('%Y-%m-%d')
+        diap.to_sql('diap_native', conn, index=False)
+
+        pd.DataFrame({
+            'visitid': np.arange(m), 'patientid': rng.integers(1, n + 50, m), 'num_b': '1', 'text': 'ОМС',
+            'doctorid': 1, 'diagnoz': 'I10', 'ishod': 'Выписан',
+            'dat': _dates(rng, '2015-01-01', 5000, m, '%Y-%m-%d %H:%M:%S'),
+            'dat1': _dates(rng, '2015-01-10', 5000, m, '%Y-%m-%d %H:%M:%S'),
+            'count_day': 3, 'department': 'Кардиология', 'vmp': None,
+        }).to_sql('stac', conn, index=False)
+
+        po = pd.DataFrame({
+            'id': rng.integers(0, m, m), 'dat_st': _dates(rng, '2015-01-01', 5000, m),
+            'dat_fin': _dates(rng, '2015-01-01', 5000, m), 'depgosp': 'Кардиология', 'result': 'Госпитализация',
+            'pat': rng.integers(1, n + 50, m).astype(float), 'giag_code': 'I10', 'diag_text': 'x',
+            'form_help': 'План', 'who': 'СМП',
+        })
+        po[['dat_st', 'dat_fin', 'pat']] = po.groupby('id')[['dat_st', 'dat_fin', 'pat']].transform('first')
+        po.loc[po.id % 53 == 0, 'dat_fin'] = '1899-12-30'
+        po.loc[po.id % 89 == 0, ['dat_st', 'dat_fin']] = '1899-12-30'
+        po.to_sql('po', conn, index=False)
+
+        pd.DataFrame({'keyid': [1, 2], 'positionid': [1, 2], 'text': ['a', 'b'],
+                      'status': ['1', 'x']}).to_sql('doc', conn, index=False)
+        pd.DataFrame({'keyid': [1, 2], 'text': ['Врач', 'Сестра']}).to_sql('dol', conn, index=False)
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    path = tmp_path / 'source.db'
+    build_source(path)
+    conn_string = f"sqlite:///{path}"
+    monkeypatch.setattr(etl_proc, 'POSTGRES_CONN_STRING', conn_string)
+    for name, query in [('query_get_patient', 'patient'), ('amb_query_get_visit', 'amb'),
+                        ('amb_query_get_diagn_pat', 'diap'), ('stac_query_get_visit', 'stac'),
+                        ('stac_query_get_PO_visit', 'po'), ('query_get_doctor', 'doc'),
+                        ('query_get_dolznost', 'dol')]:
+        monkeypatch.setattr(sql, name, f"select * from {query}")
+    monkeypatch.setattr(etl_proc, 'REPORT_JSON_PATH', None)
+    yield conn_string
+    for key in [key for key in extract._engines if key[0] == conn_string]:
+        extract._engines.pop(key).dispose()
+
+
+def _pushdown_sqlite(monkeypatch):
+    """
+    Диалектные константы pushdown_queries для SQLite; запрос диагнозов
+    возвращает даты так, как их возвращает native_dates в PostgreSQL.
+    """
+    monkeypatch.setattr(etl_proc, 'SQL_PUSHDOWN', True)
+    monkeypatch.setattr(sql, 'SQL_NOW', "datetime('now', 'localtime')")
+    monkeypatch.setattr(sql, 'SQL_SENTINEL_DATE', "'1899-12-30'")
+    monkeypatch.setattr(sql, 'SQL_PATIENT_KEYS', 'select keyid from patient')
+    monkeypatch.setattr(sql, 'amb_query_get_diagn_pat', 'select * from diap_native')
+    monkeypatch.setitem(schema.SCHEMAS['diap'], 'dates',
+                        {col: '%Y-%m-%d' for col in schema.SCHEMAS['diap']['dates']})
+
+
+@pytest.mark.parametrize('streaming', [False, True], ids=['batch', 'streaming'])
+def test_pushdown_matches_plain_output(source, tmp_path, monkeypatch, streaming):
+    def run(name):
+        out = tmp_path / name
+        out.mkdir()
+        monkeypatch.chdir(out)
+        if streaming:
+            etl_proc.etl_process_streaming(batch_size=333)
+        else:
+            etl_proc.etl_process(use_cache=False)
+        return out
+
+    plain = run('plain')
+    _pushdown_sqlite(monkeypatch)
+    pushdown = run('pushdown')
+    for name in OUTPUT_FILES:
+        assert (pushdown / name).read_bytes() == (plain / name).read_bytes(), name
+    # Фильтры pushdown действительно отбрасывают строки в запросе
+    assert (plain / 'quarantine').exists()
+    assert len(list((pushdown / 'quarantine').glob('*'))) < len(list((plain / 'quarantine').glob('*')))
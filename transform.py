@@ -2,6 +2,9 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 import logging
+import dates
+import schema
+import validation as val
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,19 +17,10 @@ def fix_invalid_dates(df, date_columns):
     3. Заменяет даты-заглушки (30.12.1899) на NaT.
     """
     current_year = datetime.now().year
-    
-    for col in date_columns:
-        # Преобразование в datetime с учетом формата ДД.ММ.ГГГГ
-        df[col] = pd.to_datetime(df[col], format='%d.%m.%Y', errors='coerce')
-        
-        # Замена дат с некорректным годом
-        mask = (df[col].dt.year < 1900) | (df[col].dt.year > current_year)
-        df[col] = df[col].mask(mask, pd.NaT)
-        
-        # Удаление даты-заглушки 30.12.1899
-        df[col] = df[col].replace(pd.Timestamp('1899-12-30'), pd.NaT)
-    
-    return df
+
+    # Разбор с учетом формата ДД.ММ.ГГГГ и проверки дат - за один проход по различным значениям
+    formats = dict.fromkeys(date_columns, '%d.%m.%Y')
+    return dates.parse_columns(df, formats, sentinels=val.SENTINEL_DATES[:1], min_year=1900, max_year=current_year)
 
 # Пример использования для диагнозов
 def process_diagnoses_data(df):
@@ -36,6 +30,38 @@ def process_diagnoses_data(df):
 
 
 
+def _date_parts(values):
+    """
+    Раскладывает массив datetime64 на год и код (месяц * 100 + день).
+    """
+    years = values.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = values.astype('datetime64[M]')
+    days = (values.astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64) + 1
+    month_numbers = months.astype(np.int64) % 12 + 1
+    return years, month_numbers * 100 + days
+
+
+def calculate_age(birthdate, death_dat, current_date):
+    """
+    Векторный расчет полного числа лет.
+    Возраст считается на дату смерти, а если ее нет - на current_date.
+    Если день рождения в году окончания еще не наступил, вычитается один год.
+    :param birthdate: Series с датами рождения (datetime64).
+    :param death_dat: Series с датами смерти (datetime64).
+    :param current_date: Дата расчета для живых пациентов.
+    :return: Series с возрастом (Int64, NA при отсутствии даты рождения).
+    """
+    end_date = death_dat.fillna(pd.Timestamp(current_date))
+    birth_values = birthdate.to_numpy()
+    end_values = end_date.to_numpy()
+
+    birth_years, birth_month_days = _date_parts(birth_values)
+    end_years, end_month_days = _date_parts(end_values)
+    age = end_years - birth_years - (end_month_days < birth_month_days)
+
+    return pd.Series(pd.arrays.IntegerArray(age, np.isnat(birth_values)), index=birthdate.index)
+
+
 def process_patient_data(df):
     """
     Обрабатывает данные пациентов:
@@ -45,8 +71,7 @@ def process_patient_data(df):
     """
     try:
         # Преобразуем даты
-        df['birthdate'] = pd.to_datetime(df['birthdate'], errors='coerce')
-        df['death_dat'] = pd.to_datetime(df['death_dat'], errors='coerce')
+        dates.parse_columns(df, schema.date_formats('patient'))
 
         # Очистка некорректных дат рождения
         current_date = datetime.now()
@@ -55,20 +80,8 @@ def process_patient_data(df):
             logger.warning(f"Найдено {invalid_birthdates.sum()} строк с датой рождения больше текущей даты. Они будут очищены.")
             df.loc[invalid_birthdates, 'birthdate'] = pd.NaT
 
-        # Точный расчет возраста (в годах)
-        def calculate_age(row):
-            if pd.isnull(row['birthdate']):  # Если дата рождения отсутствует
-                return None
-            end_date = row['death_dat'] if pd.notnull(row['death_dat']) else current_date
-            return end_date.year - row['birthdate'].year - (
-                (end_date.month, end_date.day) < (row['birthdate'].month, row['birthdate'].day)
-            )
-
-        # Применяем функцию расчета возраста
-        df['age'] = df.apply(calculate_age, axis=1)
-        
-        # Приводим возраст к целому числу (если значение не NaN)
-        df['age'] = df['age'].astype(pd.Int64Dtype())  # Поддержка целых чисел с NaN
+        # Точный расчет возраста (в годах): на дату смерти или на текущую дату
+        df['age'] = calculate_age(df['birthdate'], df['death_dat'], current_date)
 
         return df
 
@@ -77,47 +90,150 @@ def process_patient_data(df):
         raise
 
 
-def process_visits_data(df_visits, df_patients):
+class PatientIndex:
+    """
+    Индекс ключей пациентов для проверки ссылочной целостности.
+    Строится один раз по результату process_patient_data и передается во все
+    преобразования вместо повторного df_patients['keyid'].unique() в каждом из них.
+    Способы проверки принадлежности:
+      'sorted' - отсортированный массив ключей и бинарный поиск (np.searchsorted);
+      'hash'   - хеш-таблица pd.Index (строится один раз и кешируется).
+    Индекс можно пополнять по частям (add) при потоковой обработке пациентов.
+    Ключи сортируются при первом обращении; build() строит индекс сразу, чтобы его
+    можно было читать из нескольких потоков без гонки за ленивое построение.
+    """
+    METHODS = ('sorted', 'hash')
+
+    def __init__(self, keys=None, method='sorted'):
+        if method not in self.METHODS:
+            raise ValueError(f"Неизвестный способ проверки: {method}")
+        self.method = method
+        self._parts = []
+        self._keys = None
+        self._index = None
+        if keys is not None:
+            self.add(keys)
+
+    @classmethod
+    def from_frame(cls, df_patients, column='keyid', method='sorted'):
+        """
+        Строит индекс по DataFrame пациентов (сразу, см. build).
+        """
+        return cls(df_patients[column], method).build()
+
+    @classmethod
+    def from_sorted(cls, keys, method='sorted'):
+        """
+        Индекс по готовому отсортированному массиву уникальных ключей без копирования
+        (например, массиву в разделяемой памяти, см. parallel.SharedPatientIndex).
+        """
+        index = cls(method=method)
+        index._keys = keys
+        index._parts = [keys]
+        return index
+
+    def add(self, keys):
+        """
+        Добавляет ключи в индекс (например, очередной чанк пациентов).
+        """
+        self._parts.append(pd.Series(keys).dropna().to_numpy(dtype=np.int64))
+        self._keys = None
+        self._index = None
+
+    def build(self):
+        """
+        Строит отсортированный массив ключей (и хеш-таблицу для 'hash') сразу, а не при первой проверке.
+        :return: Сам индекс.
+        """
+        keys = self.keys
+        if self.method == 'hash' and self._index is None:
+            self._index = pd.Index(keys)
+        return self
+
+    @property
+    def keys(self):
+        """
+        Отсортированный массив уникальных ключей.
+        """
+        if self._keys is None:
+            self._keys = np.unique(np.concatenate(self._parts)) if self._parts else np.empty(0, dtype=np.int64)
+            self._parts = [self._keys]
+        return self._keys
+
+    @property
+    def empty(self):
+        return len(self.keys) == 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contains(self, values):
+        """
+        Проверяет принадлежность значений индексу (аналог Series.isin).
+        :param values: Series или массив идентификаторов пациентов.
+        :return: Булев массив numpy той же длины; пустые значения - False.
+        """
+        values = pd.Series(values)
+        notna = values.notna().to_numpy()
+        raw = values[notna].to_numpy()
+        candidates = raw.astype(np.int64)
+        # Нецелые значения (например, 1.5) не могут совпасть с ключом
+        integral = candidates == raw
+
+        keys = self.keys
+        if len(keys) == 0:
+            found = np.zeros(len(candidates), dtype=bool)
+        elif self.method == 'hash':
+            if self._index is None:
+                self._index = pd.Index(keys)
+            found = self._index.get_indexer(candidates) >= 0
+        else:
+            positions = np.searchsorted(keys, candidates)
+            positions[positions == len(keys)] = 0
+            found = keys[positions] == candidates
+
+        result = np.zeros(len(values), dtype=bool)
+        result[notna] = found & integral
+        return result
+
+
+def as_patient_index(patients):
+    """
+    Возвращает PatientIndex для DataFrame пациентов (или сам индекс, если он уже построен).
+    """
+    if isinstance(patients, PatientIndex):
+        return patients
+    return PatientIndex.from_frame(patients)
+
+
+def process_visits_data(df_visits, df_patients, seen_ids=None, guaranteed=()):
     """
     Обрабатывает данные о посещениях:
-    1. Проверяет корректность даты посещения.
-    2. Удаляет строки с некорректными датами.
-    3. Проверяет, что у каждого посещения есть корректный patientid.
-    4. Удаляет строки, где patientid отсутствует или не соответствует пациентам.
-    5. Удаляет строки с дубликатами keyid.
+    1. Удаляет строки с дубликатами keyid.
+    2. Удаляет строки с некорректной (пустой или будущей) датой посещения.
+    3. Удаляет строки, где patientid отсутствует или не соответствует пациентам.
+    Правила проверяются за один проход (validation.apply_rules), таблица фильтруется один раз.
+    df_patients - DataFrame пациентов или готовый PatientIndex.
+    Для потоковой обработки в seen_ids передается общее для всех чанков множество keyid.
+    guaranteed - коды правил, уже выполненных запросом-источником (sql_scripts.pushdown_queries).
     """
     try:
         # Проверка на пустые данные
-        if df_visits.empty or df_patients.empty:
+        patient_index = as_patient_index(df_patients)
+        if df_visits.empty or patient_index.empty:
             logger.warning("Один из DataFrame пуст. Проверка невозможна.")
             return df_visits
 
-        # Удаление строк с дубликатами keyid
-        df_visits = df_visits.drop_duplicates(subset=['keyid'], keep='first')
-        logger.info(f"Удалено {len(df_visits) - len(df_visits.drop_duplicates(subset=['keyid']))} дубликатов keyid.")
-
         # Преобразуем дату посещения в datetime
-        df_visits['dat'] = pd.to_datetime(df_visits['dat'], errors='coerce')
+        val.parse_dates(df_visits, schema.date_formats('amb_visit', ['dat']))
 
-        # Очистка некорректных дат (заглушки или будущие даты)
-        current_date = datetime.now()
-        invalid_dates = (df_visits['dat'] > current_date) | (df_visits['dat'].isna())
-        if invalid_dates.any():
-            logger.warning(f"Найдено {invalid_dates.sum()} строк с некорректной датой посещения. Они будут удалены.")
-            df_visits = df_visits[~invalid_dates]
-
-        # Проверка, что patientid не пустой
-        missing_patientid = df_visits['patientid'].isna()
-        if missing_patientid.any():
-            logger.warning(f"Найдено {missing_patientid.sum()} строк с отсутствующим patientid. Они будут удалены.")
-            df_visits = df_visits[~missing_patientid]
-
-        # Проверка, что patientid существует в таблице пациентов
-        valid_patient_ids = df_patients['keyid'].unique()
-        invalid_patients = ~df_visits['patientid'].isin(valid_patient_ids)
-        if invalid_patients.any():
-            logger.warning(f"Найдено {invalid_patients.sum()} строк с некорректным patientid. Они будут удалены.")
-            df_visits = df_visits[~invalid_patients]
+        rules = [
+            val.duplicates('keyid', 'duplicate_keyid', seen_ids),
+            val.future_dates(['dat'], 'invalid_dat', missing=True),
+            val.missing_value('patientid'),
+            val.unknown_key('patientid', patient_index),
+        ]
+        df_visits, _ = val.apply_rules(df_visits, rules, 'amb_visit', skip=guaranteed)
 
         # Преобразуем doctorid в int
         df_visits['doctorid'] = df_visits['doctorid'].astype(pd.Int64Dtype())
@@ -129,57 +245,34 @@ def process_visits_data(df_visits, df_patients):
         raise
 
 
-def process_diagnoses_data(df_diagnoses, df_patients):
+def process_diagnoses_data(df_diagnoses, df_patients, guaranteed=()):
     """
     Обрабатывает данные о диагнозах:
     1. Преобразует даты (reg_dat, confirm_dat, end_dat) в datetime.
     2. Очищает даты-заглушки (заменяет на NaT).
     3. Удаляет строки с будущими датами.
-    4. Проверяет, что patient_id существует в таблице пациентов.
-    5. Удаляет строки с некорректным или отсутствующим patient_id.
-    6. Преобразует столбцы reg_by, confirm_by, end_by в тип int.
+    4. Удаляет строки с некорректным или отсутствующим patient_id.
+    5. Преобразует столбцы reg_by, confirm_by, end_by в тип int.
+    df_patients - DataFrame пациентов или готовый PatientIndex.
+    guaranteed - коды правил, уже выполненных запросом-источником (sql_scripts.pushdown_queries).
     """
     try:
         # Проверка на пустые данные
-        if df_diagnoses.empty or df_patients.empty:
+        patient_index = as_patient_index(df_patients)
+        if df_diagnoses.empty or patient_index.empty:
             logger.warning("Один из DataFrame пуст. Проверка невозможна.")
             return df_diagnoses
 
-        # Преобразуем даты в datetime
-        date_columns = ['reg_dat', 'confirm_dat', 'end_dat']
-        for col in date_columns:
-            df_diagnoses[col] = pd.to_datetime(df_diagnoses[col], format='%d.%m.%Y', errors='coerce')
-
-        # Очистка дат-заглушек (например, 30.12.1899)
+        # Преобразуем даты в datetime и очищаем даты-заглушки (например, 30.12.1899)
         date_columns = ['reg_dat', 'confirm_dat', 'end_dat']
-        for col in date_columns:
-            df_diagnoses[col] = df_diagnoses[col].replace(pd.Timestamp('1899-12-30'), pd.NaT)
-            df_diagnoses[col] = df_diagnoses[col].replace(pd.Timestamp('1899-12-25'), pd.NaT)
-            df_diagnoses[col] = df_diagnoses[col].replace(pd.Timestamp('1899-12-26'), pd.NaT)
+        val.parse_dates(df_diagnoses, schema.date_formats('diap', date_columns), sentinels=val.SENTINEL_DATES)
 
-        # Удаляем строки с будущими датами
-        current_date = datetime.now()
-        future_dates = (
-            (df_diagnoses['reg_dat'] > current_date) |
-            (df_diagnoses['confirm_dat'] > current_date) |
-            (df_diagnoses['end_dat'] > current_date)
-        )
-        if future_dates.any():
-            logger.warning(f"Найдено {future_dates.sum()} строк с будущими датами. Они будут удалены.")
-            df_diagnoses = df_diagnoses[~future_dates]
-
-        # Проверка, что patient_id не пустой
-        missing_patientid = df_diagnoses['patient_id'].isna()
-        if missing_patientid.any():
-            logger.warning(f"Найдено {missing_patientid.sum()} строк с отсутствующим patient_id. Они будут удалены.")
-            df_diagnoses = df_diagnoses[~missing_patientid]
-
-        # Проверка, что patient_id существует в таблице пациентов
-        valid_patient_ids = df_patients['keyid'].unique()
-        invalid_patients = ~df_diagnoses['patient_id'].isin(valid_patient_ids)
-        if invalid_patients.any():
-            logger.warning(f"Найдено {invalid_patients.sum()} строк с некорректным patient_id. Они будут удалены.")
-            df_diagnoses = df_diagnoses[~invalid_patients]
+        rules = [
+            val.future_dates(date_columns),
+            val.missing_value('patient_id'),
+            val.unknown_key('patient_id', patient_index),
+        ]
+        df_diagnoses, _ = val.apply_rules(df_diagnoses, rules, 'diap', skip=guaranteed)
 
         # Преобразуем столбцы в int
         int_columns = ['reg_by', 'confirm_by', 'end_by']
@@ -196,7 +289,7 @@ def process_diagnoses_data(df_diagnoses, df_patients):
         raise
 
 
-def process_hospital_visits(df_visits, df_patients):
+def process_hospital_visits(df_visits, df_patients, guaranteed=()):
     """
     Обрабатывает данные о стационарных визитах:
     1. Проверяет корректность дат (dat, dat1).
@@ -204,40 +297,26 @@ def process_hospital_visits(df_visits, df_patients):
     3. Удаляет строки с будущими датами.
     4. Проверяет, что patientid существует в таблице пациентов.
     5. Удаляет строки с некорректным или отсутствующим patientid.
+    df_patients - DataFrame пациентов или готовый PatientIndex.
+    guaranteed - коды правил, уже выполненных запросом-источником (sql_scripts.pushdown_queries).
     """
     try:
         # Проверка на пустые данные
-        if df_visits.empty or df_patients.empty:
+        patient_index = as_patient_index(df_patients)
+        if df_visits.empty or patient_index.empty:
             logger.warning("Один из DataFrame пуст. Проверка невозможна.")
             return df_visits
 
         # Преобразуем даты в datetime
         date_columns = ['dat', 'dat1']
-        for col in date_columns:
-            df_visits[col] = pd.to_datetime(df_visits[col], errors='coerce')
+        val.parse_dates(df_visits, schema.date_formats('stac_visit', date_columns))
 
-        # Удаляем строки с будущими датами
-        current_date = datetime.now()
-        future_dates = (
-            (df_visits['dat'] > current_date) |
-            (df_visits['dat1'] > current_date)
-        )
-        if future_dates.any():
-            logger.warning(f"Найдено {future_dates.sum()} строк с будущими датами. Они будут удалены.")
-            df_visits = df_visits[~future_dates]
-
-        # Проверка, что patientid не пустой
-        missing_patientid = df_visits['patientid'].isna()
-        if missing_patientid.any():
-            logger.warning(f"Найдено {missing_patientid.sum()} строк с отсутствующим patientid. Они будут удалены.")
-            df_visits = df_visits[~missing_patientid]
-
-        # Проверка, что patientid существует в таблице пациентов
-        valid_patient_ids = df_patients['keyid'].unique()
-        invalid_patients = ~df_visits['patientid'].isin(valid_patient_ids)
-        if invalid_patients.any():
-            logger.warning(f"Найдено {invalid_patients.sum()} строк с некорректным patientid. Они будут удалены.")
-            df_visits = df_visits[~invalid_patients]
+        rules = [
+            val.future_dates(date_columns),
+            val.missing_value('patientid'),
+            val.unknown_key('patientid', patient_index),
+        ]
+        df_visits, _ = val.apply_rules(df_visits, rules, 'stac_visit', skip=guaranteed)
 
         return df_visits
 
@@ -270,7 +349,7 @@ def process_doc_data(df):
         raise
 
 
-def process_po_visit_data(df_visits, df_patients, visit_id_column='id'):
+def process_po_visit_data(df_visits, df_patients, visit_id_column='id', seen_ids=None, guaranteed=()):
     """
     Обрабатывает данные о визитах:
     1. Удаляет строки без ссылки на пациента или с несуществующими пациентами
@@ -281,73 +360,43 @@ def process_po_visit_data(df_visits, df_patients, visit_id_column='id'):
     
     Параметры:
         df_visits (pd.DataFrame): Данные о визитах
-        df_patients (pd.DataFrame): Данные о пациентах (должен содержать столбец 'keyid')
+        df_patients (pd.DataFrame | PatientIndex): Данные о пациентах (столбец 'keyid') или готовый индекс
         visit_id_column (str): Название столбца с идентификатором визита (по умолчанию 'keyid')
+        seen_ids (set или dedup.KeySet): Идентификаторы визитов из предыдущих чанков (для потоковой обработки)
+        guaranteed (tuple): Коды правил, уже выполненных запросом-источником (режим pushdown)
     
     Возвращает:
         pd.DataFrame: Очищенный DataFrame с визитами
     """
     try:
         # Проверка на пустые данные
-        if df_visits.empty or df_patients.empty:
+        patient_index = as_patient_index(df_patients)
+        if df_visits.empty or patient_index.empty:
             logger.warning("Один из DataFrame пуст. Обработка невозможна.")
             return df_visits
 
         # Сохраняем исходное количество строк для логов
         initial_count = len(df_visits)
 
-        # 1. Удаление строк без ссылки на пациента
-        df_visits = df_visits[df_visits['pat'].notna()]
-        removed_missing_pat = initial_count - len(df_visits)
-        if removed_missing_pat > 0:
-            logger.warning(f"Удалено {removed_missing_pat} строк без ссылки на пациента.")
-
-        # 2. Удаление строк с несуществующими пациентами
-        valid_patient_ids = df_patients['keyid'].unique()
-        before_pat_check = len(df_visits)
-        df_visits = df_visits[df_visits['pat'].isin(valid_patient_ids)]
-        removed_invalid_pat = before_pat_check - len(df_visits)
-        if removed_invalid_pat > 0:
-            logger.warning(f"Удалено {removed_invalid_pat} строк с несуществующими пациентами.")
-
-        # 3. Удаление дубликатов по идентификатору визита
+        # Преобразование дат в datetime и очистка дат-заглушек (например, 30.12.1899)
+        date_columns = ['dat_st', 'dat_fin']
+        val.parse_dates(df_visits, schema.date_formats('po', date_columns), sentinels=val.SENTINEL_DATES[:1])
+
+        rules = [
+            val.missing_value('pat'),
+            val.unknown_key('pat', patient_index),
+        ]
         if visit_id_column in df_visits.columns:
-            before_dedup = len(df_visits)
-            # Удаляем дубликаты, оставляя первое вхождение
-            df_visits = df_visits.drop_duplicates(subset=[visit_id_column], keep='first')
-            removed_duplicates = before_dedup - len(df_visits)
-            if removed_duplicates > 0:
-                logger.warning(f"Удалено {removed_duplicates} дубликатов по столбцу '{visit_id_column}'.")
+            # Дубликаты ищутся среди строк с существующими пациентами (оставляется первое вхождение)
+            rules.append(val.duplicates(visit_id_column, 'duplicate_id', seen_ids))
         else:
             logger.error(f"Столбец '{visit_id_column}' не найден. Удаление дубликатов пропущено.")
-
-        # 4. Преобразование дат в datetime
-        date_columns = ['dat_st', 'dat_fin']
-        for col in date_columns:
-            df_visits[col] = pd.to_datetime(df_visits[col], errors='coerce')
-
-        # 5. Очистка дат-заглушек (например, 30.12.1899)
-        df_visits[date_columns] = df_visits[date_columns].replace(pd.Timestamp('1899-12-30'), pd.NaT)
-
-        # 6. Удаление строк с будущими датами
-        current_date = datetime.now()
-        future_dates_mask = (df_visits['dat_st'] > current_date) | (df_visits['dat_fin'] > current_date)
-        if future_dates_mask.any():
-            logger.warning(f"Найдено {future_dates_mask.sum()} строк с будущими датами. Они будут удалены.")
-            df_visits = df_visits[~future_dates_mask]
-
-        # 7. Проверка корректности интервала дат (DAT_ST <= DAT_FIN)
-        valid_dates_mask = df_visits[date_columns].notna().all(axis=1)
-        invalid_interval_mask = (df_visits['dat_st'] > df_visits['dat_fin']) & valid_dates_mask
-        if invalid_interval_mask.any():
-            logger.warning(f"Найдено {invalid_interval_mask.sum()} строк с некорректным интервалом дат (DAT_ST > DAT_FIN). Они будут удалены.")
-            df_visits = df_visits[~invalid_interval_mask]
-
-        # 8. Удаление строк, где обе даты NaT (полностью некорректные записи)
-        both_dates_invalid = df_visits[date_columns].isna().all(axis=1)
-        if both_dates_invalid.any():
-            logger.warning(f"Удалено {both_dates_invalid.sum()} строк с полностью некорректными датами.")
-            df_visits = df_visits[~both_dates_invalid]
+        rules += [
+            val.future_dates(date_columns),
+            val.invalid_interval('dat_st', 'dat_fin'),
+            val.all_missing(date_columns),
+        ]
+        df_visits, _ = val.apply_rules(df_visits, rules, 'po', skip=guaranteed)
 
         logger.info(f"После обработки осталось {len(df_visits)} корректных записей из {initial_count}.")
         return df_visits
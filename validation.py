@@ -0,0 +1,207 @@
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+import dates
+import dedup
+import metrics
+import quarantine
+
+logger = logging.getLogger(__name__)
+
+# Даты-заглушки, которыми в источнике обозначают отсутствие даты
+SENTINEL_DATES = ('1899-12-30', '1899-12-25', '1899-12-26')
+
+
+class Rule:
+    """
+    Правило проверки строк таблицы.
+    check(df, valid) возвращает булев массив numpy: True - строка нарушает правило.
+    valid - строки, прошедшие предыдущие правила (нужно правилам, результат которых
+    зависит от порядка, например дедупликации с keep='first').
+    """
+
+    def __init__(self, code, message, check, key=None):
+        self.code = code
+        self.message = message
+        self.check = check
+        # Столбец ключа у правил дедупликации (keep='first'): в параллельном режиме
+        # такие правила выполняются после объединения шардов
+        self.key = key
+
+
+# Сборщик результатов проверки шарда в параллельном режиме (parallel.py)
+_collector = None
+
+
+class ShardCollector:
+    """
+    Результаты проверки одного шарда таблицы в процессе-исполнителе:
+    количество отброшенных строк по правилам, сами строки (если нужен карантин)
+    и ключи строк, прошедших правила до дедупликации (candidates).
+    Для правил после дедупликации сохраняются индексы отброшенных строк: если строка
+    окажется дубликатом по всей таблице, она засчитывается дедупликации, как в одном процессе.
+    Логи, отчет о запуске и карантин ведет основной процесс.
+    """
+
+    def __init__(self, keep_rows=False):
+        self.keep_rows = keep_rows
+        self.table = None
+        self.counts = {}
+        self.messages = {}
+        self.rejected = []
+        self.after_dedup = []
+        self.candidates = None
+        self.dedup = None
+
+    def reject(self, table, rule, rows):
+        code = rule.code
+        self.counts[code] = self.counts.get(code, 0) + len(rows)
+        self.messages[code] = rule.message
+        if self.dedup is not None:
+            self.after_dedup.append((code, rows.index))
+        if self.keep_rows:
+            self.rejected.append((table, code, rows))
+
+
+@contextmanager
+def collect(keep_rows=False):
+    """
+    Включает сбор результатов проверки в ShardCollector вместо логов, отчета и карантина.
+    """
+    global _collector
+    previous, _collector = _collector, ShardCollector(keep_rows)
+    try:
+        yield _collector
+    finally:
+        _collector = previous
+
+
+def _mask(values):
+    return np.asarray(values, dtype=bool)
+
+
+def parse_dates(df, columns, format=None, sentinels=()):
+    """
+    Преобразует столбцы в datetime и заменяет даты-заглушки на NaT (на месте).
+    Разбор выполняет dates.DateParser: только различные значения, уже разобранные
+    столбцы повторно не разбираются.
+    :param columns: Столбцы с датами или {столбец: формат} (например, schema.date_formats).
+    :param format: Формат разбора для списка столбцов (None - автоматически).
+    :param sentinels: Даты-заглушки (например, SENTINEL_DATES).
+    """
+    if not isinstance(columns, dict):
+        columns = dict.fromkeys(columns, format)
+    return dates.parse_columns(df, columns, sentinels=sentinels)
+
+
+def future_dates(columns, code='future_dates', missing=False):
+    """
+    Даты позже текущего момента в любом из столбцов.
+    :param missing: Считать нарушением и отсутствующую дату (для обязательных дат).
+    """
+    def check(df, valid):
+        current_date = datetime.now()
+        rejected = np.zeros(len(df), dtype=bool)
+        for col in columns:
+            rejected |= _mask(df[col] > current_date)
+            if missing:
+                rejected |= _mask(df[col].isna())
+        return rejected
+    what = 'некорректной датой' if missing else 'будущими датами'
+    return Rule(code, f"строк с {what} ({', '.join(columns)})", check)
+
+
+def missing_value(column, code='missing_patientid'):
+    """
+    Пустое значение в обязательном столбце.
+    """
+    return Rule(code, f"строк с отсутствующим {column}",
+                lambda df, valid: _mask(df[column].isna()))
+
+
+def unknown_key(column, index, code='unknown_patientid'):
+    """
+    Значение отсутствует в индексе ключей (например, PatientIndex пациентов).
+    """
+    return Rule(code, f"строк с некорректным {column}",
+                lambda df, valid: ~index.contains(df[column]))
+
+
+def invalid_interval(start, end, code='invalid_interval'):
+    """
+    Начало интервала позже конца (строки с пустой датой не проверяются).
+    """
+    return Rule(code, f"строк с некорректным интервалом дат ({start} > {end})",
+                lambda df, valid: _mask(df[start] > df[end]))
+
+
+def all_missing(columns, code='missing_dates'):
+    """
+    Все перечисленные столбцы пусты.
+    """
+    return Rule(code, f"строк с полностью некорректными датами ({', '.join(columns)})",
+                lambda df, valid: _mask(df[columns].isna().all(axis=1)))
+
+
+def duplicates(column, code='duplicate_id', seen_ids=None):
+    """
+    Повторы идентификатора среди строк, прошедших предыдущие правила (keep='first').
+    При потоковой обработке seen_ids - общее для всех чанков множество (set или
+    dedup.KeySet с ограничением памяти): строки с уже встречавшимся идентификатором
+    отбрасываются, а новые идентификаторы добавляются в множество.
+    """
+    def check(df, valid):
+        keys = df[column]
+        rejected = np.zeros(len(df), dtype=bool)
+        rejected[valid] = keys[valid].duplicated(keep='first').to_numpy()
+        if seen_ids is not None:
+            rejected |= dedup.isin(keys, seen_ids)
+            dedup.add(seen_ids, keys[valid & ~rejected])
+        return rejected
+    return Rule(code, f"дубликатов {column}", check, key=column)
+
+
+def apply_rules(df, rules, table, skip=()):
+    """
+    Проверяет таблицу набором правил и отфильтровывает строки один раз.
+    Правила применяются по порядку к строкам, прошедшим предыдущие правила,
+    поэтому строка засчитывается только первому нарушенному правилу, а результат
+    совпадает с последовательной фильтрацией, но без копии таблицы на каждом шаге.
+    Количество отброшенных строк по каждому правилу пишется в лог и в отчет о запуске,
+    а сами строки, если включен карантин (quarantine.activate), - в карантин.
+    :param df: DataFrame для проверки.
+    :param rules: Список правил (Rule).
+    :param table: Имя таблицы для логов.
+    :param skip: Коды правил, которые уже гарантирует запрос-источник (режим pushdown).
+    :return: (отфильтрованный DataFrame, словарь {код правила: количество отброшенных строк}).
+    """
+    collector = _collector
+    if collector is not None:
+        collector.table = table
+    valid = np.ones(len(df), dtype=bool)
+    rejected_counts = {}
+    for rule in rules:
+        if rule.code in skip:
+            continue
+        if collector is not None and rule.key is not None:
+            # Дедупликация по всей таблице выполняется после объединения шардов
+            collector.candidates = df[rule.key][valid]
+            collector.dedup = (rule.code, rule.message)
+            continue
+        rejected = rule.check(df, valid) & valid
+        count = int(rejected.sum())
+        rejected_counts[rule.code] = rejected_counts.get(rule.code, 0) + count
+        if count:
+            if collector is not None:
+                collector.reject(table, rule, df[rejected])
+            else:
+                logger.warning(f"{table}: найдено {count} {rule.message}. Они будут удалены.")
+                metrics.record_drop(rule.code, count)
+                if quarantine.enabled():
+                    quarantine.send(table, rule.code, df[rejected])
+            valid &= ~rejected
+
+    if valid.all():
+        return df, rejected_counts
+    return df[valid], rejected_counts